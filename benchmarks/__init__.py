@@ -0,0 +1,17 @@
+#
+# benchmarks/__init__.py
+# Released under LGPL
+
+"""
+Benchmarks of the pyzmail hot paths.
+
+The suites follow the asv conventions: classes with C{setup()},
+C{teardown()}, C{time_*} and C{peakmem_*} methods and optional C{params}.
+Run them with asv (see asv.conf.json) or without any extra dependency::
+
+    python -m benchmarks.run            # everything
+    python -m benchmarks.run -k parse   # only the matching benchmarks
+
+The runner reports the time per call, the throughput and the peak of the
+memory allocated during one call (using tracemalloc).
+"""
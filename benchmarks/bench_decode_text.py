@@ -0,0 +1,106 @@
+#
+# benchmarks/bench_decode_text.py
+# Released under LGPL
+
+"""
+Benchmark decode_text() on multi-MB mislabelled bodies.
+
+The classes follow the asv conventions (C{setup()} and C{time_*} methods),
+run this file directly for a quick comparison with the previous
+implementation that was decoding the whole payload for every charset.
+"""
+
+from __future__ import absolute_import, print_function
+
+import timeit
+
+from pyzmail.parse import decode_text
+
+
+def legacy_decode_text(payload, charset, default_charset):
+    """the implementation before the single pass strategy, for comparison"""
+    charsets = (
+        charset,
+        default_charset,
+        'ascii',
+        'utf-8',
+        'utf-16',
+        'windows-1252',
+        'cp850',
+    )
+    for chset in charsets:
+        if chset:
+            try:
+                return payload.decode(chset), chset
+            except UnicodeError:
+                pass
+    return payload, None
+
+
+def make_body(size, tail):
+    """a mostly us-ascii body of I{size} bytes ending with I{tail}"""
+    line = b'The quick brown fox jumps over the lazy dog, again and again.\n'
+    body = line * (size // len(line))
+    # odd size, like most real bodies, utf-16 cannot decode it
+    if len(body) % 2 == 0:
+        body += b'.'
+    return body + tail
+
+
+class DecodeTextSuite:
+    params = [1, 8]
+    param_names = ['megabytes']
+
+    def setup(self, megabytes):
+        size = megabytes * 1024 * 1024
+        # windows-1252 labelled as utf-8, the accent is at the very end
+        self.latin1_as_utf8 = make_body(size, u'caf\xe9\n'.encode('windows-1252'))
+        # utf-8 labelled as us-ascii
+        self.utf8_as_ascii = make_body(size, u'caf\xe9\n'.encode('utf-8'))
+        # correctly labelled, the common case must not be slower
+        self.utf8_as_utf8 = self.utf8_as_ascii
+
+    def time_latin1_labelled_utf8(self, megabytes):
+        decode_text(self.latin1_as_utf8, 'utf-8', None)
+
+    def time_utf8_labelled_ascii(self, megabytes):
+        decode_text(self.utf8_as_ascii, 'us-ascii', 'us-ascii')
+
+    def time_utf8_labelled_utf8(self, megabytes):
+        decode_text(self.utf8_as_utf8, 'utf-8', None)
+
+
+def main():
+    cases = [
+        ('latin1 labelled utf-8', 'latin1_as_utf8', 'utf-8', None),
+        ('utf-8 labelled us-ascii', 'utf8_as_ascii', 'us-ascii', 'us-ascii'),
+        ('utf-8 labelled utf-8', 'utf8_as_utf8', 'utf-8', None),
+    ]
+    suite = DecodeTextSuite()
+    for megabytes in DecodeTextSuite.params:
+        suite.setup(megabytes)
+        for title, attr, charset, default_charset in cases:
+            payload = getattr(suite, attr)
+            assert decode_text(payload, charset, default_charset) == (
+                legacy_decode_text(payload, charset, default_charset)
+            )
+            for name, func in (
+                ('legacy', legacy_decode_text),
+                ('decode_text', decode_text),
+            ):
+                number = 5
+                elapsed = min(
+                    timeit.repeat(
+                        lambda: func(payload, charset, default_charset),
+                        number=number,
+                        repeat=3,
+                    )
+                )
+                print(
+                    '%2d MB %-25s %-12s %8.2f ms'
+                    % (megabytes, title, name, elapsed / number * 1000)
+                )
+
+
+if __name__ == '__main__':
+    main()
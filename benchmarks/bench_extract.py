@@ -0,0 +1,40 @@
+#
+# benchmarks/bench_extract.py
+# Released under LGPL
+
+"""
+Benchmark the extraction of the attachments of a corpus to disk.
+"""
+
+from __future__ import absolute_import
+
+import shutil
+import tempfile
+
+from pyzmail.extract import extract_attachments, store_attachments
+
+from .corpus import iter_corpus
+
+
+class ExtractSuite:
+    params = [0, 4]
+    param_names = ['workers']
+
+    def setup(self, workers):
+        self.corpus = list(iter_corpus(100, large_size=4 * 1024 * 1024))
+        self.nbytes = sum(len(payload) for payload in self.corpus)
+        self.directories = []
+
+    def teardown(self, workers):
+        for directory in self.directories:
+            shutil.rmtree(directory)
+
+    def time_extract_attachments(self, workers):
+        directory = tempfile.mkdtemp()
+        self.directories.append(directory)
+        extract_attachments(self.corpus, directory, workers=workers)
+
+    def time_store_attachments(self, workers):
+        directory = tempfile.mkdtemp()
+        self.directories.append(directory)
+        store_attachments(self.corpus, directory, workers=workers)
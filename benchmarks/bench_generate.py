@@ -0,0 +1,169 @@
+#
+# benchmarks/bench_generate.py
+# Released under LGPL
+
+"""
+Benchmark the composition of messages with build_mail() and compose_mail().
+"""
+
+from __future__ import absolute_import
+
+import email.utils
+
+from pyzmail import generate
+from pyzmail.generate import build_mail, compose_mail
+
+from .common import random_bytes
+
+
+class ComposeSuite:
+    params = [1, 10]
+    param_names = ['megabytes']
+
+    def setup(self, megabytes):
+        self.nbytes = megabytes * 1024 * 1024
+        self.attachments = [
+            (random_bytes(self.nbytes), 'application', 'pdf', 'big.pdf', None)
+        ]
+        self.text = ('Hello world\n' * 1000, 'us-ascii')
+        self.html = ('<p>Hello world</p>\n' * 1000, 'us-ascii')
+
+    def time_build_mail(self, megabytes):
+        build_mail(self.text, self.html, self.attachments)
+
+    def time_compose_mail(self, megabytes):
+        compose_mail(
+            (u'Me', 'me@foo.com'),
+            [(u'Him', 'him@bar.com')],
+            u'the subject',
+            'us-ascii',
+            self.text,
+            html=self.html,
+            attachments=self.attachments,
+        )
+
+    def peakmem_compose_mail(self, megabytes):
+        self.time_compose_mail(megabytes)
+
+
+class RecipientsSuite:
+    params = [10, 1000, 10000]
+    param_names = ['recipients']
+
+    def setup(self, recipients):
+        self.recipients = [
+            (u'Recipient %d' % (i,), 'rcpt%d@example.com' % (i,))
+            for i in range(recipients)
+        ]
+
+    def time_compose_mail(self, recipients):
+        compose_mail(
+            (u'Me', 'me@foo.com'),
+            self.recipients,
+            u'the subject',
+            'us-ascii',
+            ('Hello world', 'us-ascii'),
+        )
+
+
+def _email_utils_make_msgid(idstring=None, domain=None):
+    # the Message-Id as generated before make_msgid(), getfqdn() every time
+    msg_id = email.utils.make_msgid(idstring)
+    if domain is not None:
+        msg_id = '%s@%s>' % (msg_id.rsplit('@', 1)[0], domain)
+    return msg_id
+
+
+class MessageIdSuite:
+    params = ['pyzmail', 'email.utils']
+    param_names = ['generator']
+
+    def setup(self, generator):
+        self.make_msgid = generate.make_msgid
+        if generator == 'email.utils':
+            generate.make_msgid = _email_utils_make_msgid
+
+    def teardown(self, generator):
+        generate.make_msgid = self.make_msgid
+
+    def time_make_msgid(self, generator):
+        for i in range(100):
+            generate.make_msgid('pyzmail')
+
+    def time_compose_mail(self, generator):
+        for i in range(100):
+            compose_mail(
+                (u'Me', 'me@foo.com'),
+                [(u'Him', 'him@bar.com')],
+                u'the subject',
+                'us-ascii',
+                ('Hello world', 'us-ascii'),
+                message_id_string='pyzmail',
+            )
+
+
+class HeadersSuite:
+    def setup(self):
+        self.headers = [
+            ('User-Agent', u'pyzmail'),
+            ('X-Campaign', u'spring-2024'),
+            ('List-Unsubscribe', u'<mailto:unsubscribe@example.com>'),
+        ]
+
+    def time_compose_mail(self):
+        for i in range(100):
+            compose_mail(
+                (u'Me', 'me@foo.com'),
+                [(u'Him', 'him@bar.com')],
+                u'Our spring offers, only for you',
+                'iso-8859-1',
+                ('Hello world', 'us-ascii'),
+                headers=self.headers,
+            )
+
+
+class BodyEncodingSuite:
+    params = [[1, 10], ['quoted-printable', 'base64']]
+    param_names = ['megabytes', 'encoding']
+
+    def setup(self, megabytes, encoding):
+        # a newsletter, with non ASCII text and long lines
+        row = (
+            u'<tr><td class="item" style="padding: 4px">Caf\xe9 cr\xe8me, '
+            u'10 €</td><td align="right">=</td></tr> \n'
+        )
+        self.html = row * (megabytes * 1024 * 1024 // len(row.encode('utf-8')))
+        self.nbytes = len(self.html.encode('utf-8'))
+
+    def time_build_mail(self, megabytes, encoding):
+        build_mail(
+            (u'Hello world', 'utf-8'),
+            (self.html, 'utf-8'),
+            use_quoted_printable=encoding == 'quoted-printable',
+        )
+
+
+class BoundarySuite:
+    params = [[50], ['build_mail', 'email.generator']]
+    param_names = ['megabytes', 'boundaries']
+
+    def setup(self, megabytes, boundaries):
+        self.nbytes = megabytes * 1024 * 1024
+        # the three multipart levels: mixed, related and alternative
+        self.mail = build_mail(
+            (u'Hello world\n' * 1000, 'us-ascii'),
+            (u'<p>Hello world<img src="cid:logo"></p>\n' * 1000, 'us-ascii'),
+            attachments=[
+                (random_bytes(self.nbytes), 'application', 'pdf', 'big.pdf', None)
+            ],
+            embeddeds=[(random_bytes(4096, 1), 'image', 'png', 'logo', None)],
+        )
+        self.multiparts = [part for part in self.mail.walk() if part.is_multipart()]
+
+    def time_as_string(self, megabytes, boundaries):
+        if boundaries == 'email.generator':
+            # as before, email.generator scans the parts for a free boundary,
+            # and keeps it in the message
+            for part in self.multiparts:
+                part.del_param('boundary')
+        self.mail.as_string()
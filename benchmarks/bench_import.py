@@ -0,0 +1,84 @@
+#
+# benchmarks/bench_import.py
+# Released under LGPL
+
+"""
+Benchmark the import time of pyzmail, each import run in a new interpreter.
+
+Run this file directly to see the cumulated time reported by
+C{python -X importtime} and the slow modules loaded by each import.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import re
+import subprocess
+import sys
+
+# the modules that must only be loaded when they are used
+slow_modules = ('smtplib', 'ssl', 'mimetypes', 'pyzmail.parse', 'pyzmail.generate')
+
+statements = (
+    'import pyzmail',
+    'from pyzmail import PyzMessage',
+    'from pyzmail import compose_mail',
+    'import pyzmail.parse',
+    'import pyzmail.generate',
+)
+
+_importtime_re = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$', re.M)
+
+
+class ImportSuite:
+    def timeraw_import_pyzmail(self):
+        return 'import pyzmail'
+
+    def timeraw_import_parse(self):
+        return 'from pyzmail import PyzMessage'
+
+    def timeraw_import_generate(self):
+        return 'from pyzmail import compose_mail'
+
+
+def importtime(statement):
+    """
+    run I{statement} with C{python -X importtime} in a new interpreter
+
+    @returns: a tuple C{(microseconds, modules)}, the cumulated time of the
+    imports done by I{statement} and the names of all the modules imported
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (root, env.get('PYTHONPATH'))))
+    # import the standard modules imported by the interpreter at startup
+    # first, to only measure what the statement loads
+    code = 'import encodings, site\n' + statement
+    output = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.PIPE,
+        env=env,
+    ).communicate()[1]
+    total, modules, startup = 0, set(), True
+    for self_us, cumulative_us, indent, name in _importtime_re.findall(
+        output.decode('ascii', 'replace')
+    ):
+        modules.add(name)
+        if len(indent) == 1 and name == 'site':
+            startup = False
+        elif len(indent) == 1 and not startup:
+            total += int(cumulative_us)
+    return total, modules
+
+
+def main():
+    for statement in statements:
+        total, modules = min(importtime(statement) for i in range(5))
+        loaded = [name for name in slow_modules if name in modules]
+        print(
+            '%-35s %8.1f ms  %s' % (statement, total / 1000.0, ', '.join(loaded) or '-')
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#
+# benchmarks/bench_parse.py
+# Released under LGPL
+
+"""
+Benchmark the parsing of messages: PyzMessage.factory() on the samples and
+on synthetic messages, and the decoding of the headers.
+"""
+
+from __future__ import absolute_import
+
+import email
+
+from pyzmail.cache import ParseCache
+from pyzmail.parse import PyzMessage, decode_mail_header, get_mail_addresses
+
+from .common import compose_large_message, compose_many_parts_message, load_samples
+from .corpus import iter_corpus
+
+
+class SamplesSuite:
+    def setup(self):
+        self.samples = load_samples()
+        self.nbytes = sum(len(sample) for sample in self.samples)
+
+    def time_factory(self):
+        for sample in self.samples:
+            PyzMessage.factory(sample)
+
+
+class CorpusSuite:
+    def setup(self):
+        self.corpus = list(iter_corpus(200, large_size=256 * 1024))
+        self.nbytes = sum(len(payload) for payload in self.corpus)
+
+    def time_factory(self):
+        for payload in self.corpus:
+            PyzMessage.factory(payload)
+
+
+class ParseCacheSuite:
+    def setup(self):
+        self.corpus = list(iter_corpus(200, large_size=256 * 1024))
+        self.nbytes = sum(len(payload) for payload in self.corpus)
+        self.cache = ParseCache(':memory:')
+        for payload in self.corpus:
+            self.cache.parse(payload)
+
+    def teardown(self):
+        self.cache.close()
+
+    def time_parse_cached(self):
+        for payload in self.corpus:
+            self.cache.parse(payload)
+
+
+class LargeMessageSuite:
+    params = [1, 10]
+    param_names = ['megabytes']
+
+    def setup(self, megabytes):
+        self.payload = compose_large_message(megabytes * 1024 * 1024)
+        self.nbytes = len(self.payload)
+
+    def time_factory(self, megabytes):
+        PyzMessage.factory(self.payload)
+
+    def peakmem_factory(self, megabytes):
+        PyzMessage.factory(self.payload)
+
+    def time_attachment_payload(self, megabytes):
+        msg = PyzMessage.factory(self.payload)
+        for mailpart in msg.mailparts:
+            mailpart.get_payload()
+
+
+class ManyPartsSuite:
+    params = [100, 1000]
+    param_names = ['parts']
+
+    def setup(self, parts):
+        self.payload = compose_many_parts_message(parts)
+        self.nbytes = len(self.payload)
+
+    def time_factory(self, parts):
+        PyzMessage.factory(self.payload)
+
+
+class HeadersSuite:
+    def setup(self):
+        self.encoded = (
+            '=?iso-8859-1?q?Dans_la_=E9lectronique=2C_il_y_a_du_mieux?= '
+            '=?utf-8?b?w6AgZmFpcmUgZXQgZW5jb3JlIGR1IG1pZXV4?='
+        )
+        self.plain = 'A rather common subject without any encoded word'
+        to = ', '.join(
+            '"=?utf-8?q?J=C3=A9r=C3=B4me_%d?=" <jerome%d@example.com>' % (i, i)
+            for i in range(100)
+        )
+        self.message = email.message_from_string('To: %s\n\nbody\n' % (to,))
+
+    def time_decode_encoded_header(self):
+        decode_mail_header(self.encoded)
+
+    def time_decode_plain_header(self):
+        decode_mail_header(self.plain)
+
+    def time_get_mail_addresses(self):
+        get_mail_addresses(self.message, 'to')
+
+
+class ManyHeadersSuite:
+    fields = (
+        'from',
+        'to',
+        'cc',
+        'subject',
+        'date',
+        'message-id',
+        'in-reply-to',
+        'references',
+        'list-id',
+        'x-spam-status',
+    )
+
+    def setup(self):
+        headers = ''.join(
+            'Received: from relay%d.example.com by mx.example.com; '
+            'Mon, 1 Jan 2024 00:00:%02d +0000\n' % (i, i % 60)
+            for i in range(150)
+        )
+        headers += ''.join('X-Header-%d: value %d\n' % (i, i) for i in range(50))
+        headers += (
+            'From: Me <me@foo.com>\nTo: A <a@foo.com>\nCc: B <b@foo.com>\n'
+            'Subject: the subject\nDate: Mon, 1 Jan 2024 00:00:00 +0000\n'
+            'Message-Id: <1@foo.com>\nX-Spam-Status: No\n'
+        )
+        self.message = PyzMessage.factory(headers + '\nbody\n')
+
+    def time_get_decoded_header(self):
+        for name in self.fields:
+            self.message.get_decoded_header(name)
+
+    def time_decoded_headers(self):
+        self.message.decoded_headers(self.fields)
+
+    def time_get_addresses(self):
+        for name in ('from', 'to', 'cc', 'bcc'):
+            self.message.get_addresses(name)
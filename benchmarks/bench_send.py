@@ -0,0 +1,62 @@
+#
+# benchmarks/bench_send.py
+# Released under LGPL
+
+"""
+Benchmark send_mail() and send_mail_file() against a local SMTP server that
+accepts everything, this measures the client side of the SMTP transaction.
+"""
+
+from __future__ import absolute_import
+
+import re
+import tempfile
+
+from pyzmail.generate import send_mail, send_mail_file
+
+from .common import SMTPSink, compose_large_message
+
+
+class SendSuite:
+    """
+    The SMTP sink runs in a thread of the same process and tracemalloc
+    measures the whole process, so the peak memory includes the
+    allocations of the sink receiving the message.
+    """
+
+    params = [0, 10]
+    param_names = ['megabytes']
+
+    def setup(self, megabytes):
+        self.payload = compose_large_message(megabytes * 1024 * 1024)
+        self.nbytes = len(self.payload)
+        # the same message spooled to disk, ready to be sent as is
+        self.spool = tempfile.TemporaryFile()
+        data = re.sub(r'\r?\n', '\r\n', self.payload).replace('\r\n.', '\r\n..')
+        self.spool.write(data.encode('ascii'))
+        self.sink = SMTPSink().start()
+
+    def teardown(self, megabytes):
+        self.sink.stop()
+        self.spool.close()
+
+    def time_send_mail(self, megabytes):
+        ret = send_mail(
+            self.payload,
+            'me@foo.com',
+            ['him@bar.com'],
+            self.sink.host,
+            self.sink.port,
+        )
+        assert ret == {}, ret
+
+    def time_send_mail_file(self, megabytes):
+        self.spool.seek(0)
+        ret = send_mail_file(
+            self.spool,
+            'me@foo.com',
+            ['him@bar.com'],
+            self.sink.host,
+            self.sink.port,
+        )
+        assert ret == {}, ret
@@ -0,0 +1,29 @@
+#
+# benchmarks/bench_utils.py
+# Released under LGPL
+
+"""
+Benchmark the filename sanitization, done once per part of every message.
+"""
+
+from __future__ import absolute_import
+
+from pyzmail.utils import sanitize_filename, sanitize_filenames
+
+
+class SanitizeSuite:
+    params = [100, 10000]
+    param_names = ['parts']
+
+    def setup(self, parts):
+        self.filenames = [
+            (u'r\xe9sum\xe9 %d.doc' % (i,) if i % 3 else None, 'text', '.txt')
+            for i in range(parts)
+        ]
+
+    def time_sanitize_filename(self, parts):
+        for filename, alt_name, alt_ext in self.filenames:
+            sanitize_filename(filename, alt_name, alt_ext)
+
+    def time_sanitize_filenames(self, parts):
+        sanitize_filenames(self.filenames)
@@ -0,0 +1,175 @@
+#
+# benchmarks/common.py
+# Released under LGPL
+
+"""
+Data and services shared by the benchmarks: the samples corpus, synthetic
+messages and a local SMTP server accepting everything.
+"""
+
+from __future__ import absolute_import, print_function
+
+import glob
+import os
+import random
+import socket
+import threading
+
+from six.moves import socketserver
+
+from pyzmail.generate import compose_mail
+
+samples_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'samples')
+
+
+def load_samples():
+    """return the raw content of the samples/*.eml files"""
+    samples = []
+    for filename in sorted(glob.glob(os.path.join(samples_dir, '*.eml'))):
+        with open(filename, 'rb') as fp:
+            samples.append(fp.read())
+    return samples
+
+
+def random_bytes(size, seed=0):
+    """return I{size} pseudo random bytes, always the same for a I{seed}"""
+    rnd = random.Random(seed)
+    block = bytes(bytearray(rnd.getrandbits(8) for i in range(min(size, 65536))))
+    return (block * (size // 65536 + 1))[:size]
+
+
+def compose_large_message(size):
+    """
+    return the payload of a message with a binary attachment of I{size} bytes
+    """
+    payload, mail_from, rcpt_to, msg_id = compose_mail(
+        (u'Me', 'me@foo.com'),
+        [(u'Him', 'him@bar.com')],
+        u'large message',
+        'us-ascii',
+        ('Hello world', 'us-ascii'),
+        html=('<p>Hello world</p>', 'us-ascii'),
+        attachments=[(random_bytes(size), 'application', 'pdf', 'big.pdf', None)],
+    )
+    return payload
+
+
+def compose_many_parts_message(count):
+    """
+    return the payload of a message with I{count} small attachments
+    """
+    attachments = [
+        ('attachment %d\n' % (i,), 'text', 'plain', 'file%d.txt' % (i,), 'us-ascii')
+        for i in range(count)
+    ]
+    payload, mail_from, rcpt_to, msg_id = compose_mail(
+        (u'Me', 'me@foo.com'),
+        [(u'Him', 'him@bar.com')],
+        u'many parts',
+        'us-ascii',
+        ('Hello world', 'us-ascii'),
+        attachments=attachments,
+    )
+    return payload
+
+
+class _SMTPHandler(socketserver.BaseRequestHandler):
+    """speak just enough SMTP to accept any message"""
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+
+    def readline(self):
+        while b'\r\n' not in self.buffer:
+            data = self.request.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line
+
+    def read_data(self):
+        """read the DATA content until the final dot"""
+        data = bytearray(b'\r\n' + self.buffer)
+        start = 0
+        while True:
+            end = data.find(b'\r\n.\r\n', start)
+            if end >= 0:
+                break
+            start = max(0, len(data) - 4)
+            chunk = self.request.recv(1024 * 1024)
+            if not chunk:
+                return None
+            data += chunk
+        self.buffer = bytes(data[end + 5 :])
+        self.server.received_bytes += end
+        return bytes(data[2:end])
+
+    def reply(self, line):
+        self.request.sendall(line + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self.reply(b'220 localhost ESMTP pyzmail benchmark')
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            command = line[:4].upper()
+            if command == b'EHLO':
+                features = [b'localhost', b'8BITMIME']
+                if server.size_limit:
+                    features.append(b'SIZE %d' % (server.size_limit,))
+                for feature in features[:-1]:
+                    self.reply(b'250-' + feature)
+                self.reply(b'250 ' + features[-1])
+            elif command == b'RCPT':
+                server.recipients += 1
+                self.reply(b'250 Ok')
+            elif command == b'DATA':
+                self.reply(b'354 End data with <CR><LF>.<CR><LF>')
+                if self.read_data() is None:
+                    return
+                server.messages += 1
+                self.reply(b'250 Ok: queued')
+            elif command == b'QUIT':
+                self.reply(b'221 Bye')
+                return
+            elif command in (b'HELO', b'MAIL', b'RSET', b'NOOP'):
+                self.reply(b'250 Ok')
+            else:
+                self.reply(b'502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    A local SMTP server that accept and forget every message. It runs in a
+    thread, use L{start()} and L{stop()}. The port is chosen by the system.
+
+    @ivar messages: the number of messages received
+    @ivar recipients: the number of recipients accepted
+    @ivar received_bytes: the number of bytes received in DATA
+    @ivar size_limit: the maximum message size announced in EHLO if not 0
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, size_limit=0):
+        socketserver.TCPServer.__init__(self, (host, port), _SMTPHandler)
+        self.host, self.port = self.server_address[:2]
+        self.size_limit = size_limit
+        self.messages = self.recipients = self.received_bytes = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
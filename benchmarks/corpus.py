@@ -0,0 +1,392 @@
+#
+# benchmarks/corpus.py
+# Released under LGPL
+
+"""
+Generate a synthetic corpus of messages for load testing, using
+L{pyzmail.generate.build_mail()} and L{pyzmail.generate.complete_mail()}.
+
+The corpus is deterministic: the same I{seed} always produces the same
+messages, byte for byte (in a given time zone, the I{Date} is local), and
+message I{i} does not depend on the count.
+It mixes the kind of messages met in real mailboxes:
+
+    - plain text, text+HTML and HTML with embedded images
+    - attachments with RFC 2231 encoded non us-ascii filenames
+    - forwarded messages (message/rfc822) nesting other multiparts
+    - bounces (multipart/report with a message/delivery-status part)
+    - large binary attachments
+
+Headers use RFC 2047 encoded non us-ascii names and subjects. Write the
+corpus to a mbox file or a Maildir directory::
+
+    python -m benchmarks.corpus -n 1000 -f mbox corpus.mbox
+    python -m benchmarks.corpus -s 500M --seed 42 -f maildir corpus/
+"""
+
+from __future__ import absolute_import, print_function
+
+import email
+import email.header
+import email.mime.base
+import email.mime.message
+import email.mime.multipart
+import email.mime.text
+import mailbox
+import optparse
+import random
+import re
+
+import six
+
+from pyzmail.generate import build_mail, complete_mail
+
+from .common import random_bytes
+
+kinds = ('text', 'alternative', 'related', 'attachments', 'forward', 'bounce', 'large')
+# the proportion of each kind of message in the corpus
+kind_weights = (30, 30, 10, 15, 7, 5, 3)
+
+words = (
+    u'the',
+    u'meeting',
+    u'report',
+    u'budget',
+    u'please',
+    u'find',
+    u'attached',
+    u'regards',
+    u'tomorrow',
+    u'caf\xe9',
+    u'r\xe9sum\xe9',
+    u'na\xefve',
+    u'Stra\xdfe',
+    u'\xe0',
+    u'd\xe9j\xe0',
+    u'ni\xf1o',
+    u'fa\xe7ade',
+    u'\xfcber',
+)
+names = (
+    u'John Smith',
+    u'Alice Martin',
+    u'J\xe9r\xf4me Dupont',
+    u'Bj\xf6rn \xc5str\xf6m',
+    u'Fran\xe7oise L\xe9vy',
+    u'Jos\xe9 Mu\xf1oz',
+)
+# need utf-8
+wide_names = (u'Łukasz Wójcik', u'山田 太郎', u'Māori')
+wide_words = (u'ł\xf3dź', u'日本語', u'€')
+filenames = (
+    u'report.pdf',
+    u'budget 2011.xls',
+    u'r\xe9sum\xe9.doc',
+    u'photo d\xe9j\xe0 vu.jpg',
+    u'日本語.txt',
+)
+domains = ('example.com', 'example.org', 'mail.example.net')
+
+
+class MessageGenerator(object):
+    """
+    Build one pseudo random message. Use L{iter_corpus()} to generate many.
+
+    @ivar rnd: the random generator, everything is derived from it
+    @ivar charset: the default charset of the message, I{iso-8859-1} or
+    I{utf-8}
+    """
+
+    def __init__(self, seed, index, large_size=1024 * 1024):
+        self.rnd = random.Random('%s-%d' % (seed, index))
+        self.index = index
+        self.large_size = large_size
+        self.charset = self.rnd.choice(('iso-8859-1', 'utf-8'))
+
+    def words(self, count):
+        vocabulary = words
+        if self.charset == 'utf-8':
+            vocabulary = words + wide_words
+        return u' '.join(self.rnd.choice(vocabulary) for i in range(count))
+
+    def paragraphs(self, count):
+        return (
+            u'\n\n'.join(self.words(self.rnd.randint(20, 120)) for i in range(count))
+            + u'\n'
+        )
+
+    def address(self):
+        pool = names
+        if self.charset == 'utf-8':
+            pool = names + wide_names
+        name = self.rnd.choice(pool)
+        addr = '%s.%d@%s' % (
+            ''.join(c for c in name.split()[0].lower() if c.isalpha() and ord(c) < 128)
+            or 'user',
+            self.rnd.randint(1, 999),
+            self.rnd.choice(domains),
+        )
+        return name, addr
+
+    def text(self):
+        return self.paragraphs(self.rnd.randint(1, 5)), self.charset
+
+    def html(self, text, cids=()):
+        body = u''.join(u'<p>%s</p>\n' % (p,) for p in text[0].split(u'\n\n'))
+        body += u''.join(u'<img src="cid:%s">\n' % (cid,) for cid in cids)
+        return u'<html><body>\n%s</body></html>\n' % (body,), self.charset
+
+    def attachment(self, size):
+        return (
+            random_bytes(size, self.rnd.randint(0, 1 << 30)),
+            'application',
+            'octet-stream',
+            self.rnd.choice(filenames),
+            None,
+        )
+
+    def build(self, kind, depth=0):
+        """return the MIME structure of a message of I{kind}"""
+        rnd = self.rnd
+        text = self.text()
+        if kind == 'text':
+            return build_mail(text, use_quoted_printable=rnd.random() < 0.5)
+        if kind == 'alternative':
+            return build_mail(text, self.html(text))
+        if kind == 'related':
+            cids = ['image%d@corpus' % (i,) for i in range(rnd.randint(1, 3))]
+            embeddeds = [
+                (
+                    random_bytes(rnd.randint(2000, 20000), rnd.randint(0, 1 << 30)),
+                    'image',
+                    'png',
+                    cid,
+                    None,
+                )
+                for cid in cids
+            ]
+            return build_mail(text, self.html(text, cids), embeddeds=embeddeds)
+        if kind == 'attachments':
+            attachments = [
+                self.attachment(rnd.randint(1000, 100000))
+                for i in range(rnd.randint(1, 4))
+            ]
+            attachments.append(
+                (
+                    self.paragraphs(2).encode('utf-8'),
+                    'text',
+                    'plain',
+                    'notes.txt',
+                    'utf-8',
+                )
+            )
+            return build_mail(text, self.html(text), attachments)
+        if kind == 'large':
+            return build_mail(text, attachments=[self.attachment(self.large_size)])
+        if kind == 'forward':
+            message = build_mail(text, attachments=[self.attachment(1000)])
+            inner_kind = rnd.choice(('alternative', 'related', 'attachments'))
+            if depth < 2 and rnd.random() < 0.3:
+                inner_kind = 'forward'
+            inner = self.build(inner_kind, depth + 1)
+            self.complete(inner)
+            message.attach(email.mime.message.MIMEMessage(inner))
+            return message
+        if kind == 'bounce':
+            return self.bounce()
+        raise ValueError('unknown kind of message: %r' % (kind,))
+
+    def bounce(self):
+        recipient = self.address()[1]
+        message = email.mime.multipart.MIMEMultipart(
+            'report', report_type='delivery-status'
+        )
+        message.attach(
+            email.mime.text.MIMEText(
+                'The original message was received at Tue, 21 Jun 2011 17:34:39\n\n'
+                '   ----- The following addresses had permanent fatal errors -----\n'
+                '<%s>\n    (reason: 554 5.4.6 Too many hops)\n' % (recipient,),
+                'plain',
+                'us-ascii',
+            )
+        )
+        status = email.mime.base.MIMEBase('message', 'delivery-status')
+        # the payload of a message/delivery-status is a list of header blocks
+        status.attach(
+            email.message_from_string(
+                'Reporting-MTA: dns; mx.%s\n' % (self.rnd.choice(domains),)
+            )
+        )
+        status.attach(
+            email.message_from_string(
+                'Final-Recipient: RFC822; %s\nAction: failed\nStatus: 5.4.6\n'
+                'Diagnostic-Code: SMTP; 554 5.4.6 Too many hops\n' % (recipient,)
+            )
+        )
+        message.attach(status)
+        original = self.build('alternative', 1)
+        self.complete(original)
+        message.attach(email.mime.message.MIMEMessage(original))
+        return message
+
+    def set_boundaries(self, message):
+        """use predictable boundaries, the email package use random ones"""
+        for part in message.walk():
+            if part.is_multipart():
+                part.set_boundary(
+                    '===============%019d==' % (self.rnd.getrandbits(60),)
+                )
+
+    def complete(self, message):
+        """fill in the headers of I{message} and return its payload"""
+        rnd = self.rnd
+        self.set_boundaries(message)
+        sender = self.address()
+        recipients = [self.address() for i in range(rnd.randint(1, 5))]
+        cc = [self.address() for i in range(rnd.choice((0, 0, 1, 3)))]
+        subject = self.words(rnd.randint(2, 10))
+        msg_id = email.header.Header(
+            '<%d.%016x@corpus.%s>'
+            % (self.index, rnd.getrandbits(64), rnd.choice(domains)),
+            'us-ascii',
+        )
+        payload, mail_from, rcpt_to, msg_id = complete_mail(
+            message,
+            sender,
+            recipients,
+            subject,
+            self.charset,
+            cc=cc,
+            date=1300000000 + self.index * 600 + rnd.randint(0, 599),
+            headers=[('Message-Id', msg_id)],
+        )
+        return payload
+
+    def generate(self, kind=None):
+        """
+        return the payload of the message as bytes, I{kind} is chosen
+        randomly when None
+        """
+        if kind is None:
+            kind = _weighted_choice(self.rnd, kinds, kind_weights)
+        payload = self.complete(self.build(kind))
+        if isinstance(payload, six.text_type):
+            payload = payload.encode('ascii')
+        return payload
+
+
+def _weighted_choice(rnd, values, weights):
+    point = rnd.random() * sum(weights)
+    for value, weight in zip(values, weights):
+        point -= weight
+        if point < 0:
+            return value
+    return values[-1]
+
+
+def iter_corpus(count=None, size=None, seed=0, large_size=1024 * 1024, kind=None):
+    """
+    Generate the messages of the corpus.
+
+    @type count: int or None
+    @param count: stop after I{count} messages
+    @type size: int or None
+    @param size: stop when the total size of the messages reach I{size} bytes
+    @type seed: int or str
+    @param seed: the same I{seed} produce the same messages
+    @type large_size: int
+    @param large_size: the size of the attachment of the I{large} messages
+    @type kind: str or None
+    @param kind: only generate messages of this kind, see L{kinds}
+    @rtype: iterator
+    @returns: the payload of the messages as bytes
+    """
+    total = index = 0
+    while (count is None or index < count) and (size is None or total < size):
+        payload = MessageGenerator(seed, index, large_size).generate(kind)
+        total += len(payload)
+        index += 1
+        yield payload
+
+
+_from_line_re = re.compile(b'^(>*From )', re.MULTILINE)
+
+
+def write_mbox(path, messages):
+    """
+    write I{messages} to a mbox file (in the I{mboxrd} format), every
+    message gets the same constant I{From_} line to stay deterministic
+    """
+    count = 0
+    with open(path, 'wb') as fp:
+        for payload in messages:
+            fp.write(
+                b'From corpus@example.com Thu Jan  1 00:00:00 1970\n'
+                + _from_line_re.sub(b'>\\1', payload)
+            )
+            if not payload.endswith(b'\n'):
+                fp.write(b'\n')
+            fp.write(b'\n')
+            count += 1
+    return count
+
+
+def write_maildir(path, messages):
+    """write I{messages} into the I{new} folder of a Maildir"""
+    maildir = mailbox.Maildir(path, create=True)
+    count = 0
+    for payload in messages:
+        maildir.add(payload)
+        count += 1
+    return count
+
+
+def parse_size(value):
+    """convert '10K', '500M' or '2G' into a number of bytes"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    value = value.strip().upper()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m benchmarks.corpus [options] OUTPUT')
+    parser.add_option('-n', dest='count', type='int', help='number of messages')
+    parser.add_option(
+        '-s', dest='size', help='total size of the corpus, like 10K, 500M or 2G'
+    )
+    parser.add_option('--seed', dest='seed', default='0', help='the random seed')
+    parser.add_option(
+        '-f',
+        dest='format',
+        choices=('mbox', 'maildir'),
+        default='mbox',
+        help='mbox or maildir, default is mbox',
+    )
+    parser.add_option(
+        '--large-size',
+        dest='large_size',
+        default='1M',
+        help='size of the large attachments, default is 1M',
+    )
+    parser.add_option('--kind', dest='kind', choices=kinds, help='only one kind')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('missing OUTPUT')
+    if options.count is None and options.size is None:
+        options.count = 1000
+    messages = iter_corpus(
+        options.count,
+        options.size and parse_size(options.size),
+        options.seed,
+        parse_size(options.large_size),
+        options.kind,
+    )
+    write = write_mbox if options.format == 'mbox' else write_maildir
+    count = write(args[0], messages)
+    print('%d messages written to %s' % (count, args[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#
+# benchmarks/run.py
+# Released under LGPL
+
+"""
+Run the benchmarks without asv, for a quick look at a working copy::
+
+    python -m benchmarks.run [-k PATTERN] [-n NUMBER] [-r REPEAT]
+
+For every C{time_*} method, print the best time per call, the throughput
+when the suite defines C{nbytes} and the peak of the memory allocated
+during one call. C{peakmem_*} methods are covered by the latter.
+C{timeraw_*} methods return code that is run in a new interpreter.
+"""
+
+from __future__ import absolute_import, print_function
+
+import gc
+import importlib
+import inspect
+import itertools
+import optparse
+import os
+import subprocess
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2.x
+    tracemalloc = None
+
+modules = (
+    'bench_decode_text',
+    'bench_extract',
+    'bench_import',
+    'bench_parse',
+    'bench_generate',
+    'bench_send',
+    'bench_utils',
+)
+
+
+def iter_suites():
+    """yield (name, class) for every benchmark suite"""
+    for module_name in modules:
+        module = importlib.import_module('.' + module_name, __package__)
+        for name, cls in inspect.getmembers(module, inspect.isclass):
+            if not name.endswith('Suite') or cls.__module__ != module.__name__:
+                continue
+            yield '%s.%s' % (module_name, name), cls
+
+
+def iter_params(cls):
+    """yield the tuples of parameters to call the suite with"""
+    params = getattr(cls, 'params', None)
+    if params is None:
+        yield ()
+    elif params and isinstance(params[0], (list, tuple)):
+        for args in itertools.product(*params):
+            yield args
+    else:
+        for arg in params:
+            yield (arg,)
+
+
+def peak_memory(func, *args):
+    """return the peak of the memory allocated during func(*args)"""
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+_raw_timer = (
+    'import sys, timeit\n'
+    'start = timeit.default_timer()\n'
+    'exec(sys.argv[1])\n'
+    'print(timeit.default_timer() - start)\n'
+)
+
+
+def time_raw(code):
+    """return the time to run I{code} in a new interpreter"""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (root, env.get('PYTHONPATH'))))
+    output = subprocess.Popen(
+        [sys.executable, '-c', _raw_timer, code], stdout=subprocess.PIPE, env=env
+    ).communicate()[0]
+    return float(output)
+
+
+def format_size(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f GB' % (size,)
+
+
+def run_suite(title, cls, pattern, number, repeat):
+    methods = [
+        name
+        for name, value in inspect.getmembers(cls)
+        if name.startswith(('time_', 'timeraw_')) and callable(value)
+    ]
+    methods = [name for name in methods if not pattern or pattern in title + '.' + name]
+    if not methods:
+        return
+    for args in iter_params(cls):
+        suite = cls()
+        if hasattr(suite, 'setup'):
+            suite.setup(*args)
+        try:
+            nbytes = getattr(suite, 'nbytes', None)
+            for name in methods:
+                func = getattr(suite, name)
+                if name.startswith('timeraw_'):
+                    code = func(*args)
+                    elapsed = min(time_raw(code) for i in range(repeat))
+                    func = None
+                else:
+                    elapsed = (
+                        min(
+                            timeit.repeat(
+                                lambda: func(*args), number=number, repeat=repeat
+                            )
+                        )
+                        / number
+                    )
+                throughput = '-'
+                if nbytes:
+                    throughput = '%.1f MB/s' % (nbytes / elapsed / 1024 / 1024,)
+                label = '%s.%s%s' % (
+                    title,
+                    name,
+                    '(%s)' % (', '.join(map(str, args)),) if args else '',
+                )
+                print(
+                    '%-60s %10.3f ms %12s %10s'
+                    % (
+                        label,
+                        elapsed * 1000,
+                        throughput,
+                        format_size(func and peak_memory(func, *args)),
+                    )
+                )
+                sys.stdout.flush()
+        finally:
+            if hasattr(suite, 'teardown'):
+                suite.teardown(*args)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m benchmarks.run [options]')
+    parser.add_option(
+        '-k',
+        dest='pattern',
+        default=None,
+        help='only run the benchmarks whose name contains PATTERN',
+    )
+    parser.add_option(
+        '-n', dest='number', type='int', default=3, help='calls per measure'
+    )
+    parser.add_option(
+        '-r', dest='repeat', type='int', default=3, help='measures to keep the best'
+    )
+    options, args = parser.parse_args(argv)
+    print('%-60s %13s %12s %10s' % ('benchmark', 'time', 'throughput', 'peakmem'))
+    for title, cls in iter_suites():
+        run_suite(title, cls, options.pattern, options.number, options.repeat)
+
+
+if __name__ == '__main__':
+    main()
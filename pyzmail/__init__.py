@@ -6,25 +6,65 @@
 
 from __future__ import absolute_import, unicode_literals, print_function
 
-from . import utils
-from .generate import compose_mail, send_mail, send_mail2
-from .parse import email_address_re, PyzMessage, PzMessage, decode_text
-from .parse import message_from_string, message_from_file
-from .parse import message_from_bytes, message_from_binary_file
+import sys
+
 from .version import __version__
 
+# the module of the functions available from top of the package, with
+# Python 3.7+ the modules are only imported when one of their functions is
+# used, importing the parser don't load the SMTP stack and the reverse
+_lazy_attributes = {
+    'compose_mail': 'generate',
+    'extract_attachments': 'extract',
+    'send_mail': 'generate',
+    'send_mail2': 'generate',
+    'send_mail_file': 'generate',
+    'store_attachments': 'extract',
+    'ParseCache': 'cache',
+    'Profiler': 'instrument',
+    'SendStats': 'instrument',
+    'email_address_re': 'parse',
+    'PyzMessage': 'parse',
+    'PzMessage': 'parse',
+    'PyzMessageFeedParser': 'parse',
+    'decode_text': 'parse',
+    'message_from_string': 'parse',
+    'message_from_file': 'parse',
+    'message_from_bytes': 'parse',
+    'message_from_binary_file': 'parse',
+}
+_submodules = (
+    'cache',
+    'extract',
+    'generate',
+    'instrument',
+    'parse',
+    'utils',
+    'version',
+)
+
 # to help epydoc to display functions available from top of the package
 __all__ = [
     'compose_mail',
     'send_mail',
     'send_mail2',
+    'send_mail_file',
+    'extract_attachments',
+    'store_attachments',
     'email_address_re',
     'PyzMessage',
     'PzMessage',
+    'PyzMessageFeedParser',
     'decode_text',
+    'ParseCache',
+    'Profiler',
+    'SendStats',
     '__version__',
     'utils',
+    'cache',
+    'extract',
     'generate',
+    'instrument',
     'parse',
     'version',
     'message_from_string',
@@ -32,3 +72,35 @@ __all__ = [
     'message_from_binary_file',
     'message_from_bytes',
 ]
+
+if sys.version_info >= (3, 7):
+
+    def _import(module_name):
+        # __import__() and not importlib, to be visible to -X importtime
+        name = '%s.%s' % (__name__, module_name)
+        __import__(name)
+        return sys.modules[name]
+
+    def __getattr__(name):
+        if name in _submodules:
+            return _import(name)
+        module_name = _lazy_attributes.get(name)
+        if module_name is None:
+            raise AttributeError('module %r has no attribute %r' % (__name__, name))
+        value = getattr(_import(module_name), name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(__all__))
+
+else:
+    from . import utils
+    from .cache import ParseCache
+    from .extract import extract_attachments, store_attachments
+    from .generate import compose_mail, send_mail, send_mail2, send_mail_file
+    from .instrument import Profiler, SendStats
+    from .parse import email_address_re, PyzMessage, PzMessage, decode_text
+    from .parse import PyzMessageFeedParser
+    from .parse import message_from_string, message_from_file
+    from .parse import message_from_bytes, message_from_binary_file
@@ -0,0 +1,363 @@
+#
+# pyzmail/cache.py
+# Released under LGPL
+
+"""
+A persistent cache of the parsing results, for the jobs that process the
+same messages again and again.
+
+The metadata computed by L{PyzMessage<pyzmail.parse.PyzMessage>} (the
+decoded headers, the addresses and the summary of the L{MailPart
+<pyzmail.parse.MailPart>}s with their I{sanitized_filename} and their role)
+are stored in a SQLite database, keyed by the SHA-256 of the raw message.
+When the message is found in the cache, the MIME parsing is skipped
+completely::
+
+    with ParseCache('parse-cache.db') as cache:
+        for path in paths:
+            with open(path, 'rb') as fp:
+                msg = cache.parse(fp.read())
+            print(msg.get_subject(), [p.sanitized_filename for p in msg.mailparts])
+
+@var address_headers: the headers whose addresses are stored in the cache,
+the other ones require a full parsing
+"""
+
+from __future__ import absolute_import, print_function
+
+import hashlib
+import json
+import sqlite3
+
+import six
+
+from .parse import PyzMessage
+
+__all__ = ['CachedMessage', 'ParseCache', 'PartSummary']
+
+address_headers = (
+    'from',
+    'sender',
+    'reply-to',
+    'to',
+    'cc',
+    'bcc',
+    'delivered-to',
+    'return-path',
+)
+
+# changed each time the content of the records changes, the records of
+# the other versions are kept for the processes still using them
+_format_version = 1
+
+_part_attributes = (
+    'type',
+    'filename',
+    'sanitized_filename',
+    'charset',
+    'content_id',
+    'description',
+    'disposition',
+    'is_body',
+)
+
+
+def _text(value):
+    """return I{value} as a string that can be serialized in JSON"""
+    if value is None or isinstance(value, (bool, six.text_type)):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    # email.header.Header
+    return six.text_type(value)
+
+
+class PartSummary(object):
+    """
+    The metadata of a L{MailPart<pyzmail.parse.MailPart>} read from the
+    cache, with the same attributes but without the payload.
+    """
+
+    __slots__ = _part_attributes
+
+    def __init__(self, **attributes):
+        for name in _part_attributes:
+            setattr(self, name, attributes.get(name))
+
+    def __repr__(self):
+        return 'PartSummary<%s%s sanitized_filename=%r>' % (
+            '*' if self.is_body else '',
+            self.type,
+            self.sanitized_filename,
+        )
+
+
+class CachedMessage(object):
+    """
+    The parsing results of a message, read from the cache or computed by
+    L{PyzMessage<pyzmail.parse.PyzMessage>}. Offer the same methods to read
+    the headers and the same attributes to describe the parts.
+
+    @type digest: str
+    @ivar digest: the hexadecimal SHA-256 of the raw message
+    @type headers: list
+    @ivar headers: the C{(name, decoded value)} of the headers, the first
+    one of each name only
+    @type mailparts: list of L{PartSummary}
+    @ivar mailparts: the summary of the parts of the message
+    @type text_part: L{PartSummary} or None
+    @ivar text_part: the text version of the message
+    @type html_part: L{PartSummary} or None
+    @ivar html_part: the HTML version of the message
+    @type limits_exceeded: set
+    @ivar limits_exceeded: see L{PyzMessage<pyzmail.parse.PyzMessage>}
+    @type from_cache: bool
+    @ivar from_cache: True if the MIME parsing has been skipped
+    """
+
+    def __init__(self, digest, record, raw=None, message=None, limits=None):
+        self.digest = digest
+        self.from_cache = message is None
+        self._raw = raw
+        self._message = message
+        self._limits = limits or {}
+        self.headers = [tuple(header) for header in record['headers']]
+        self._first_headers = {}
+        for name, value in self.headers:
+            self._first_headers.setdefault(name.lower(), value)
+        self._addresses = dict(
+            (name, [tuple(address) for address in addresses])
+            for name, addresses in record['addresses'].items()
+        )
+        self.mailparts = [PartSummary(**part) for part in record['parts']]
+        self.text_part = None
+        self.html_part = None
+        for part in self.mailparts:
+            if part.is_body == 'text/plain':
+                self.text_part = part
+            elif part.is_body == 'text/html':
+                self.html_part = part
+        self.limits_exceeded = set(record['limits_exceeded'])
+
+    @staticmethod
+    def record(message):
+        """
+        return the record to store in the cache for I{message}
+
+        @type message: L{PyzMessage<pyzmail.parse.PyzMessage>}
+        @param message: the parsed message
+        @rtype: dict
+        @returns: the serializable metadata of the message
+        """
+        headers = []
+        seen = set()
+        for name in message.keys():
+            if name.lower() not in seen:
+                seen.add(name.lower())
+                headers.append((name, message.get_decoded_header(name)))
+        addresses = {}
+        for name in address_headers:
+            if name in message:
+                addresses[name] = [
+                    (_text(addr_name), _text(addr))
+                    for addr_name, addr in message.get_addresses(name)
+                ]
+        parts = [
+            dict((name, _text(getattr(part, name))) for name in _part_attributes)
+            for part in message.mailparts
+        ]
+        return dict(
+            headers=headers,
+            addresses=addresses,
+            parts=parts,
+            limits_exceeded=sorted(message.limits_exceeded),
+        )
+
+    def get_message(self):
+        """
+        return the L{PyzMessage<pyzmail.parse.PyzMessage>}, the raw message is
+        parsed at first call when it comes from the cache. Use it to read the
+        payloads.
+        """
+        if self._message is None:
+            self._message = PyzMessage.factory(self._raw, **self._limits)
+        return self._message
+
+    def get_decoded_header(self, name, default=''):
+        """
+        return the first decoded header I{name}, see
+        L{PyzMessage.get_decoded_header()<pyzmail.parse.PyzMessage.get_decoded_header>}
+        """
+        return self._first_headers.get(name.lower(), default)
+
+    def get_subject(self, default=''):
+        """
+        return the decoded subject, see
+        L{PyzMessage.get_subject()<pyzmail.parse.PyzMessage.get_subject>}
+        """
+        return self.get_decoded_header('subject', default)
+
+    def get_addresses(self, name):
+        """
+        return the list of addresses, see
+        L{PyzMessage.get_addresses()<pyzmail.parse.PyzMessage.get_addresses>}.
+        The message is parsed if I{name} is not one of L{address_headers}.
+        """
+        name = name.lower()
+        if name in address_headers:
+            return list(self._addresses.get(name, []))
+        return self.get_message().get_addresses(name)
+
+    def get_address(self, name):
+        """
+        return the first address, see
+        L{PyzMessage.get_address()<pyzmail.parse.PyzMessage.get_address>}
+        """
+        value = self.get_addresses(name)
+        if value:
+            return value[0]
+        else:
+            return ('', '')
+
+
+class ParseCache(object):
+    """
+    A persistent cache of the parsing results, in a SQLite database.
+
+    The results depend on the limits passed to
+    L{PyzMessage<pyzmail.parse.PyzMessage>}, the entries computed with other
+    limits are ignored. A L{ParseCache} must be used by one thread only, but
+    many processes can share the same database: it uses the write-ahead log
+    of SQLite, each new entry is committed at once and the writers wait for
+    each other up to I{timeout} seconds.
+
+    @type path: str
+    @ivar path: the path of the database
+    @type hits: int
+    @ivar hits: the number of messages found in the cache
+    @type misses: int
+    @ivar misses: the number of messages parsed
+    """
+
+    def __init__(self, path, timeout=30.0, **limits):
+        """
+        Open or create the database.
+
+        @type path: str
+        @param path: the path of the database, C{':memory:'} for a cache
+        that is not persistent
+        @type timeout: float
+        @keyword timeout: how long to wait in seconds for the lock held by
+        another process writing to the database
+        @keyword limits: the limits passed to
+        L{PyzMessage<pyzmail.parse.PyzMessage>}
+        """
+        self.path = path
+        self.limits = limits
+        self._limits_key = json.dumps(sorted(limits.items()))
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path, timeout=timeout)
+        self._setup()
+
+    def _setup(self):
+        # the readers don't block the writer, and a commit is cheap
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'digest TEXT NOT NULL, version INTEGER NOT NULL, '
+            'limits TEXT NOT NULL, record TEXT NOT NULL, '
+            'PRIMARY KEY (digest, version, limits))'
+        )
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    @staticmethod
+    def digest(raw):
+        """
+        return the key of the I{raw} message
+
+        @type raw: bytes or str
+        @param raw: the raw message
+        @rtype: str
+        @returns: the hexadecimal SHA-256 of the raw message
+        """
+        if isinstance(raw, six.text_type):
+            raw = raw.encode('utf-8', 'surrogateescape' if six.PY3 else 'strict')
+        return hashlib.sha256(raw).hexdigest()
+
+    def get(self, raw):
+        """
+        look for the I{raw} message in the cache, without parsing it
+
+        @type raw: bytes or str
+        @param raw: the raw message
+        @rtype: L{CachedMessage} or None
+        @returns: the parsing results or None if the message is not in the
+        cache
+        """
+        digest = self.digest(raw)
+        row = self._db.execute(
+            'SELECT record FROM messages '
+            'WHERE digest = ? AND version = ? AND limits = ?',
+            (digest, _format_version, self._limits_key),
+        ).fetchone()
+        if row is None:
+            return None
+        return CachedMessage(digest, json.loads(row[0]), raw=raw, limits=self.limits)
+
+    def parse(self, raw):
+        """
+        return the parsing results of the I{raw} message, from the cache or
+        from a full parsing whose results are added to the cache
+
+        @type raw: bytes or str
+        @param raw: the raw message
+        @rtype: L{CachedMessage}
+        @returns: the parsing results
+        """
+        cached = self.get(raw)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        message = PyzMessage.factory(raw, **self.limits)
+        return self.add(raw, message)
+
+    def add(self, raw, message):
+        """
+        store the parsing results of I{message} in the cache
+
+        @type raw: bytes or str
+        @param raw: the raw message
+        @type message: L{PyzMessage<pyzmail.parse.PyzMessage>}
+        @param message: the message parsed from I{raw} with the limits of
+        the cache
+        @rtype: L{CachedMessage}
+        @returns: the parsing results
+        """
+        digest = self.digest(raw)
+        record = CachedMessage.record(message)
+        with self._db:
+            # commit at once, not to block the other processes
+            self._db.execute(
+                'INSERT OR REPLACE INTO messages (digest, version, limits, record) '
+                'VALUES (?, ?, ?, ?)',
+                (digest, _format_version, self._limits_key, json.dumps(record)),
+            )
+        return CachedMessage(
+            digest, record, raw=raw, message=message, limits=self.limits
+        )
+
+    def close(self):
+        """close the database"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
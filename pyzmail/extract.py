@@ -0,0 +1,311 @@
+#
+# pyzmail/extract.py
+# Released under LGPL
+
+"""
+Write the attachments of messages to disk.
+
+The parts are decoded chunk by chunk with
+L{MailPart.iter_payload()<pyzmail.parse.MailPart.iter_payload>} and
+written by a pool of threads, then the disk I/O of one part overlaps with
+the decoding of the others and with the parsing of the next messages.
+
+L{extract_attachments()} writes the attachments under their
+I{sanitized_filename}, L{store_attachments()} writes each distinct content
+only once, in a content-addressed directory.
+
+@var default_workers: the default number of writer threads
+@var spool_size: the parts smaller than this are hashed in memory by
+L{store_attachments()} and only written if their content is new, the
+bigger ones are hashed while written to a temporary file
+"""
+
+from __future__ import absolute_import, print_function
+
+from collections import namedtuple
+import hashlib
+import os
+import threading
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from .parse import PyzMessage
+from .utils import UniqueFilenames
+
+__all__ = ['ManifestEntry', 'extract_attachments', 'store_attachments']
+
+default_workers = 4
+spool_size = 1024 * 1024
+
+
+def _write_part(mailpart, path, chunk_size):
+    """write the decoded payload of I{mailpart} into the new file I{path}"""
+    # never overwrite an existing file
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    with os.fdopen(os.open(path, flags, 0o666), 'wb') as fp:
+        for chunk in mailpart.iter_payload(chunk_size):
+            fp.write(chunk)
+    return path
+
+
+class _Writers(object):
+    """
+    Run the writing tasks in a pool of threads, or in the calling thread
+    if there is no worker.
+    """
+
+    def __init__(self, workers):
+        self.pool = None
+        self.results = []
+        if workers:
+            self.pool = ThreadPool(workers)
+            # limit the number of parts waiting to be written, and then the
+            # number of messages held in memory
+            self.pending = threading.BoundedSemaphore(workers * 4)
+
+    def _run(self, func, args):
+        try:
+            return func(*args)
+        finally:
+            self.pending.release()
+
+    def submit(self, func, *args):
+        if self.pool is None:
+            self.results.append(func(*args))
+        else:
+            self.pending.acquire()
+            self.results.append(self.pool.apply_async(self._run, (func, args)))
+
+    def close(self):
+        """wait for all the tasks and return their results, in order"""
+        if self.pool is None:
+            return self.results
+        self.pool.close()
+        self.pool.join()
+        # raise the exception of the writer if any
+        return [result.get() for result in self.results]
+
+
+def _iter_parts(messages, include_body):
+    """
+    yield the message index and the list of the C{(part index, attachment)}
+    of every message, the list is empty when there is no attachment
+    """
+    for index, message in enumerate(messages):
+        if not isinstance(message, PyzMessage):
+            message = PyzMessage.factory(message)
+        yield index, [
+            (part_index, mailpart)
+            for part_index, mailpart in enumerate(message.mailparts)
+            if include_body or not mailpart.is_body
+        ]
+
+
+def extract_attachments(
+    messages, directory, include_body=False, workers=None, chunk_size=None
+):
+    """
+    Write the attachments of all the I{messages} into I{directory}.
+
+    The files are named from the I{sanitized_filename} of the parts, a
+    sequence number is added to avoid the collisions with the other
+    attachments and with the files already in the I{directory}, the
+    existing files are never overwritten.
+
+    @type messages: iterable
+    @param messages: the messages, L{PyzMessage<pyzmail.parse.PyzMessage>}
+    objects or any source accepted by C{PyzMessage.factory()}, they are
+    parsed as and when the attachments are written.
+    @type directory: str
+    @param directory: an existing directory
+    @type include_body: bool
+    @keyword include_body: write the text and HTML parts too
+    @type workers: int or None
+    @keyword workers: the number of writer threads, default to
+    L{default_workers}, use 0 to write the files in the calling thread
+    @type chunk_size: int or None
+    @keyword chunk_size: see
+    L{MailPart.iter_payload()<pyzmail.parse.MailPart.iter_payload>}
+    @rtype: list
+    @returns: the list of the paths written, one list per message in the
+    order of its parts
+    @raise EnvironmentError: when a file cannot be written, the writer
+    threads write the other files anyway
+    """
+    if workers is None:
+        workers = default_workers
+    unique_filenames = UniqueFilenames(os.listdir(directory))
+
+    extracted = []
+    writers = _Writers(workers)
+    try:
+        for index, mailparts in _iter_parts(messages, include_body):
+            paths = []
+            for part_index, mailpart in mailparts:
+                filename = unique_filenames.add(mailpart.sanitized_filename)
+                path = os.path.join(directory, filename)
+                writers.submit(_write_part, mailpart, path, chunk_size)
+                paths.append(path)
+            extracted.append(paths)
+    finally:
+        writers.close()
+    return extracted
+
+
+ManifestEntryType = namedtuple(
+    'ManifestEntry', ('message', 'part', 'filename', 'digest', 'size')
+)
+
+
+class ManifestEntry(ManifestEntryType):
+    """
+    One part stored by L{store_attachments()}.
+
+    @ivar message: the index of the message in the input
+    @ivar part: the index of the part in the I{mailparts} of the message
+    @ivar filename: the I{sanitized_filename} of the part
+    @ivar digest: the hexadecimal SHA-256 of the decoded payload, the content
+    is stored in C{<directory>/<digest[:2]>/<digest>}
+    @ivar size: the size of the decoded payload
+    """
+
+    __slots__ = ()
+
+
+class _ContentStore(object):
+    """the content-addressed directory, shared by the writer threads"""
+
+    def __init__(self, directory, chunk_size):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        # the digests known to be in the directory
+        self.stored = set()
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _claim(self, digest):
+        """return the path to write I{digest} to, or None if already stored"""
+        with self.lock:
+            if digest in self.stored:
+                return None
+        path = self.path(digest)
+        if os.path.exists(path):
+            self._stored(digest)
+            return None
+        subdir = os.path.dirname(path)
+        if not os.path.isdir(subdir):
+            try:
+                os.mkdir(subdir)
+            except OSError:
+                # created by another thread or process
+                if not os.path.isdir(subdir):
+                    raise
+        return path
+
+    def _stored(self, digest):
+        # only once the file is complete, a failed write is retried by the
+        # next part with the same content
+        with self.lock:
+            self.stored.add(digest)
+
+    def _temp_path(self):
+        return os.path.join(self.directory, '.tmp-%s' % uuid.uuid4().hex)
+
+    def _publish(self, temp_path, path):
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # the same content stored by another process
+            os.remove(temp_path)
+            if not os.path.exists(path):
+                raise
+
+    def store(self, index, part_index, mailpart):
+        """hash and store the decoded payload of I{mailpart}"""
+        sha = hashlib.sha256()
+        chunks = []
+        size = 0
+        fp = temp_path = None
+        try:
+            for chunk in mailpart.iter_payload(self.chunk_size):
+                sha.update(chunk)
+                size += len(chunk)
+                if fp is not None:
+                    fp.write(chunk)
+                    continue
+                chunks.append(chunk)
+                if size > spool_size:
+                    # too big to be held in memory, spool to a temporary file
+                    temp_path = self._temp_path()
+                    fp = open(temp_path, 'wb')
+                    fp.writelines(chunks)
+                    del chunks[:]
+            if fp is not None:
+                fp.close()
+                fp = None
+            digest = sha.hexdigest()
+            path = self._claim(digest)
+            if path is not None:
+                if temp_path is None:
+                    # write the small ones to a temporary file too, the
+                    # content is never seen truncated under its final name
+                    temp_path = self._temp_path()
+                    with open(temp_path, 'wb') as fp:
+                        fp.writelines(chunks)
+                    fp = None
+                self._publish(temp_path, path)
+                temp_path = None
+                self._stored(digest)
+        finally:
+            if fp is not None:
+                fp.close()
+            if temp_path is not None:
+                os.remove(temp_path)
+        return ManifestEntry(
+            index, part_index, mailpart.sanitized_filename, digest, size
+        )
+
+
+def store_attachments(
+    messages, directory, include_body=False, workers=None, chunk_size=None
+):
+    """
+    Store the attachments of all the I{messages} into the content-addressed
+    I{directory}, each distinct content is written only once whatever the
+    number of messages it is attached to.
+
+    The SHA-256 of the decoded payloads is computed while they are decoded,
+    the content is stored in C{<directory>/<digest[:2]>/<digest>}, the
+    directory can be shared by successive runs.
+
+    @type messages: iterable
+    @param messages: the messages, see L{extract_attachments()}
+    @type directory: str
+    @param directory: an existing directory
+    @type include_body: bool
+    @keyword include_body: store the text and HTML parts too
+    @type workers: int or None
+    @keyword workers: the number of hashing and writer threads, default to
+    L{default_workers}, use 0 to work in the calling thread
+    @type chunk_size: int or None
+    @keyword chunk_size: see
+    L{MailPart.iter_payload()<pyzmail.parse.MailPart.iter_payload>}
+    @rtype: list
+    @returns: the manifest, a list of L{ManifestEntry} in the order of the
+    messages and of their parts
+    @raise EnvironmentError: when a file cannot be written
+    """
+    if workers is None:
+        workers = default_workers
+    content_store = _ContentStore(directory, chunk_size)
+
+    writers = _Writers(workers)
+    try:
+        for index, mailparts in _iter_parts(messages, include_body):
+            for part_index, mailpart in mailparts:
+                writers.submit(content_store.store, index, part_index, mailpart)
+    finally:
+        manifest = writers.close()
+    return manifest
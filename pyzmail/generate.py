@@ -15,17 +15,25 @@ For short:
 ... #doctest: +SKIP
 >>> error=send_mail(payload, mail_from, rcpt_to, 'localhost', smtp_port=25)
 ... #doctest: +SKIP
+
+@var message_id_domain: the domain of the I{Message-Id} generated by
+L{make_msgid()} when none is given, None to use the fully qualified name of
+the host, looked up once
 """
 
 from __future__ import absolute_import, print_function
 
+import binascii
 from collections import namedtuple
-import mimetypes
+import functools
+import itertools
 import os
+import re
 import time
-import smtplib, socket
+import socket
 import email.charset
 import email.encoders
+import email.errors
 import email.header
 from email.header import Header
 import email.utils
@@ -37,6 +45,7 @@ import email.mime.nonmultipart
 import six
 
 from . import utils
+from .instrument import SendStats, timer
 
 
 __all__ = [
@@ -45,18 +54,127 @@ __all__ = [
     'compose_mail',
     'format_addresses',
     'guess_mime_type',
+    'make_msgid',
+    'message_size',
     'send_mail',
     'send_mail2',
+    'send_mail_file',
     'Attachment',
+    'ComposedMail',
     'EmbeddedFile',
 ]
 
 
+_fws_split_re = re.compile('([ \t]+)')
+_embedded_header_re = re.compile(r'\n[^ \t]+:')
+
+
+def _find_split(line, splitchars):
+    """
+    return the index in I{line} where to fold, the same as
+    C{email.header._ValueFormatter}, or 0 if none
+    """
+    for ch in splitchars:
+        for i in range(len(line) - 1, 0, -1):
+            if ch.isspace():
+                fws = line[i][0]
+                if fws and fws[0] == ch:
+                    return i
+            prevpart = line[i - 1][1]
+            if prevpart and prevpart[-1] == ch:
+                return i
+    return 0
+
+
+def _fold_ascii(string, headerlen, maxlinelen, splitchars, linesep):
+    """
+    fold the single line of ASCII I{string} like C{email.header.Header}
+    does, but in linear time: the length of the current line is tracked
+    instead of being summed up at each word
+    """
+    parts = _fws_split_re.split(string)
+    if parts[0]:
+        parts[:0] = ['']
+    else:
+        parts.pop(0)
+
+    lines = []
+    # the current line, a list of (fws, part)
+    line = []
+    initial_size = length = headerlen
+
+    def newline(line, initial_size):
+        end_of_line = line.pop() if line else ('', '')
+        if end_of_line != (' ', ''):
+            line.append(end_of_line)
+        if initial_size or any(fws or part for fws, part in line):
+            text = ''.join(fws + part for fws, part in line)
+            if initial_size == 0 and (not line or text.isspace()) and lines:
+                lines[-1] += text
+            else:
+                lines.append(text)
+
+    for i in range(0, len(parts), 2):
+        fws, part = parts[i], parts[i + 1]
+        line.append((fws, part))
+        length += len(fws) + len(part)
+        if length <= maxlinelen:
+            continue
+        split = _find_split(line, splitchars)
+        if split:
+            lines.append(''.join(fws + part for fws, part in line[:split]))
+            line = line[split:]
+            initial_size = 0
+            length = sum(len(fws) + len(part) for fws, part in line)
+        elif initial_size > 0:
+            # a long first word, leave the header name on a line by itself
+            fws, part = line.pop()
+            newline(line, initial_size)
+            line = [(fws or ' ', part)]
+            initial_size = 0
+            length = len(fws or ' ') + len(part)
+
+    line.append((' ', ''))
+    newline(line, initial_size)
+    value = linesep.join(lines)
+    if _embedded_header_re.search(value):
+        raise email.errors.HeaderParseError(
+            'header value appears to contain an embedded header: %r' % (value,)
+        )
+    return value
+
+
+class _AddressHeader(Header):
+    """
+    The header returned by L{format_addresses()} when all the addresses are
+    ASCII. The value is folded in one linear pass, the result is the same
+    as with C{email.header.Header} whose folding is quadratic in the length
+    of the line, and the lines are not folded by C{Message.as_string()}.
+    """
+
+    def encode(self, splitchars=';, \t', maxlinelen=None, linesep='\n'):
+        self._normalize()
+        if len(self._chunks) == 1:
+            string, charset = self._chunks[0]
+            lines = string.splitlines() or ['']
+            if charset.header_encoding is None and len(lines) == 1:
+                if maxlinelen is None:
+                    maxlinelen = self._maxlinelen
+                if maxlinelen == 0:
+                    maxlinelen = 1000000
+                return _fold_ascii(
+                    lines[0], self._headerlen, maxlinelen, splitchars, linesep
+                )
+        return Header.encode(self, splitchars, maxlinelen, linesep)
+
+
 def format_addresses(addresses, header_name=None, charset=None):
     """
     Convert a list of addresses into a MIME-compliant header for a From, To, Cc,
     or any other I{address} related field.
     This mixes the use of email.utils.formataddr() and email.header.Header().
+    With Python 3, a list of ASCII only addresses is encoded at once and
+    folded in linear time, for the messages with thousands of recipients.
 
     @type addresses: list
     @param addresses: list of addresses, can be a mix of string a tuple  of the form
@@ -100,6 +218,27 @@ def format_addresses(addresses, header_name=None, charset=None):
     >>> print(format_addresses(['a@bar.com', ('John', 'john@foo.com') ], 'From', 'us-ascii').encode())
     a@bar.com , John <john@foo.com>
     """
+    if six.PY3:
+        # the common case, all ASCII, is encoded at once
+        formated_addrs = []
+        for address in addresses:
+            if isinstance(address, tuple):
+                name, addr = address
+                if not utils.is_usascii(name) or not utils.is_usascii(addr):
+                    break
+                formated_addrs.append(email.utils.formataddr((name, addr)))
+            elif isinstance(address, str) and utils.is_usascii(address):
+                formated_addrs.append(address)
+            else:
+                break
+        else:
+            header = _AddressHeader(charset=charset, header_name=header_name)
+            if formated_addrs:
+                # the separator is the one of the code below, where the chunks
+                # are joined by a space
+                header.append(' , '.join(formated_addrs), charset='us-ascii')
+            return header
+
     header = email.header.Header(charset=charset, header_name=header_name)
     for i, address in enumerate(addresses):
         if i != 0:
@@ -129,14 +268,91 @@ def format_addresses(addresses, header_name=None, charset=None):
     return header
 
 
+# the Charset objects by name and body encoding, built once
+_charsets = {}
+
+_body_eols_re = re.compile(b'\r\n?')
+_qp_trailing_whitespace_re = re.compile(b'=(?:20|09)$', re.MULTILINE)
+
+
+def _get_charset(name, body_encoding=None):
+    """return a shared C{email.charset.Charset}, that must not be modified"""
+    key = (name, body_encoding)
+    charset = _charsets.get(key)
+    if charset is None:
+        charset = email.charset.Charset(name)
+        if body_encoding is not None:
+            charset.body_encoding = body_encoding
+        _charsets[key] = charset
+    return charset
+
+
+def _native_str(encoded):
+    """return the ASCII bytes I{encoded} as a native string"""
+    return encoded.decode('ascii') if six.PY3 else encoded
+
+
+def _encode_quoted_printable(data):
+    """
+    encode I{data} like C{email.quoprimime.body_encode()} but with
+    C{binascii}, the lines are wrapped at 76 characters
+    """
+    encoded = binascii.b2a_qp(_body_eols_re.sub(b'\n', data), istext=True)
+    # b2a_qp() don't wrap the line when it encodes its trailing whitespace
+    chunks = []
+    start = 0
+    for match in _qp_trailing_whitespace_re.finditer(encoded):
+        end = match.start()
+        if end + 3 - (encoded.rfind(b'\n', 0, end) + 1) > 76:
+            chunks.append(encoded[start:end])
+            chunks.append(b'=\n')
+            start = end
+    if chunks:
+        chunks.append(encoded[start:])
+        encoded = b''.join(chunks)
+    return _native_str(encoded)
+
+
+def _encode_base64(data):
+    """encode I{data} like C{email.encoders.encode_base64()}, in one pass"""
+    if not data:
+        return ''
+    encoded = binascii.b2a_base64(data)[:-1]
+    lines = [encoded[i : i + 76] for i in range(0, len(encoded), 76)]
+    lines.append(b'')
+    return _native_str(b'\n'.join(lines))
+
+
+_body_encoders = {
+    email.charset.QP: ('quoted-printable', _encode_quoted_printable),
+    email.charset.BASE64: ('base64', _encode_base64),
+}
+
+
 def build_mimetext_part(
     content, charset, mime_subtype=u'plain', use_quoted_printable=False
 ):
+    if six.PY3:
+        body_encoding = email.charset.QP if use_quoted_printable else None
+        mime_charset = _get_charset(charset, body_encoding)
+        output_charset = mime_charset.get_output_charset()
+        encoder = _body_encoders.get(mime_charset.body_encoding)
+        if encoder is not None and mime_charset.input_charset == output_charset:
+            # encode the body with binascii, email.charset does it in Python
+            if isinstance(content, str):
+                content = content.encode(output_charset)
+            cte, encode = encoder
+            mime_text = email.mime.nonmultipart.MIMENonMultipart(
+                'text', mime_subtype, charset=output_charset
+            )
+            mime_text['Content-Transfer-Encoding'] = cte
+            mime_text.set_payload(encode(content))
+            return mime_text
+
     if not use_quoted_printable:
         return email.mime.text.MIMEText(content, mime_subtype, charset)
 
-    qp_charset = email.charset.Charset(charset)
-    qp_charset.body_encoding = email.charset.QP
+    qp_charset = _get_charset(charset, email.charset.QP)
 
     # Workaround to get minimal quoted-printable encoding with Python 2 which
     # is surprisingly hard.
@@ -157,8 +373,12 @@ def build_mime_part(data, maintype, subtype, charset, use_quoted_printable=False
         )
     else:
         part = email.mime.base.MIMEBase(maintype, subtype)
-        part.set_payload(data)
-        email.encoders.encode_base64(part)
+        if isinstance(data, bytes):
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.set_payload(_encode_base64(data))
+        else:
+            part.set_payload(data)
+            email.encoders.encode_base64(part)
     return part
 
 
@@ -263,6 +483,10 @@ class EmbeddedFile(EmbeddedFileType):
 
 
 def guess_mime_type(fp, default_type='application/octet-stream'):
+    # slow to import, only load it when needed
+    import mimetypes
+
+    mime_type = None
     filename = getattr(fp, 'name', None)
     if filename:
         guessed_type, guessed_encoding = mimetypes.guess_type(filename)
@@ -273,6 +497,36 @@ def guess_mime_type(fp, default_type='application/octet-stream'):
     return mime_type
 
 
+def _contains(part, token):
+    """return True if I{token} may appear in the rendered I{part}"""
+    if part.is_multipart():
+        return any(_contains(subpart, token) for subpart in part.get_payload()) or any(
+            token in text for text in (part.preamble, part.epilogue) if text
+        )
+    cte = part.get('content-transfer-encoding', '').lower()
+    if cte in ('base64', 'quoted-printable'):
+        # '=_' is never found in the base64 and quoted-printable content
+        return False
+    payload = part.get_payload()
+    return not isinstance(payload, six.string_types) or token in payload
+
+
+def _set_boundaries(main, multiparts):
+    """
+    Give to the I{multiparts} boundaries that cannot collide with the
+    content of I{main}, then C{email.generator} don't search the rendered
+    parts for a free boundary.
+    """
+    if not multiparts:
+        return
+    token = '=_%s' % (_native_str(binascii.hexlify(os.urandom(16))),)
+    if _contains(main, token):
+        # keep the scan of email.generator
+        return
+    for index, multipart in enumerate(multiparts):
+        multipart.set_boundary('===============%s_%d==' % (token, index))
+
+
 def build_mail(
     text, html=None, attachments=(), embeddeds=(), use_quoted_printable=False
 ):
@@ -293,6 +547,10 @@ def build_mail(
          |
          +-- application/msword (where to add attachments)
 
+    The multipart boundaries are chosen here, they contain C{=_} that cannot
+    be found in the base64 and quoted-printable parts, the other parts are
+    checked. Then C{email.generator} don't need to scan the rendered parts.
+
     @param text: the text version of the message, under the form of a tuple:
         C{(encoded_content, encoding)} where I{encoded_content} is a byte string
         encoded using I{encoding}.
@@ -351,6 +609,7 @@ def build_mail(
     """
 
     main = text_part = html_part = None
+    multiparts = []
     if text:
         content, charset = text
         main = text_part = build_mimetext_part(
@@ -370,6 +629,7 @@ def build_mail(
         main = email.mime.multipart.MIMEMultipart(
             'alternative', None, [text_part, html_part]
         )
+        multiparts.append(main)
 
     if embeddeds:
         related = email.mime.multipart.MIMEMultipart('related')
@@ -383,6 +643,7 @@ def build_mail(
                 part = embedded_part.as_mime_part()
             related.attach(part)
         main = related
+        multiparts.append(main)
 
     if attachments:
         mixed = email.mime.multipart.MIMEMultipart('mixed')
@@ -398,10 +659,137 @@ def build_mail(
                 part = attachment.as_mime_part()
             mixed.attach(part)
         main = mixed
+        multiparts.append(main)
 
+    _set_boundaries(main, multiparts)
     return main
 
 
+message_id_domain = None
+
+_fqdn = None
+# the random part of the Message-Ids and the pid it has been drawn for, to
+# draw a new one in the child processes
+_msgid_pid = None
+_msgid_random = None
+_msgid_counter = itertools.count()
+
+
+def make_msgid(idstring=None, domain=None):
+    """
+    Return a unique I{Message-Id}, like C{email.utils.make_msgid()} but the
+    name of the host is looked up once, not for every message, and the
+    unicity comes from a random value drawn once per process and a counter.
+
+    >>> msg_id = make_msgid('pyzmail', 'foo.com')
+    >>> msg_id.startswith('<') and msg_id.endswith('.pyzmail@foo.com>')
+    True
+    >>> msg_id != make_msgid('pyzmail', 'foo.com')
+    True
+
+    @type idstring: str or None
+    @param idstring: a string to make the I{Message-Id} more meaningful,
+    like the name of your application
+    @type domain: str or None
+    @param domain: the right part of the I{Message-Id}, default to
+    L{message_id_domain}
+    @rtype: str
+    @returns: the I{Message-Id}, angle brackets included
+    """
+    global _fqdn, _msgid_pid, _msgid_random
+    if domain is None:
+        domain = message_id_domain
+        if domain is None:
+            if _fqdn is None:
+                _fqdn = socket.getfqdn()
+            domain = _fqdn
+    pid = os.getpid()
+    if pid != _msgid_pid:
+        _msgid_random = binascii.hexlify(os.urandom(8)).decode('ascii')
+        _msgid_pid = pid
+    return '<%d.%d.%s.%d%s@%s>' % (
+        int(time.time() * 100),
+        pid,
+        _msgid_random,
+        next(_msgid_counter),
+        '.' + idstring if idstring else '',
+        domain,
+    )
+
+
+# the values that cannot be written as is in a header: line breaks and
+# control characters, or something looking like a RFC 2047 encoded word
+_raw_header_unsafe_re = re.compile('[\x00-\x08\x0a-\x1f\x7f]|=\\?')
+
+
+def _header_value(value, charset):
+    """
+    return I{value} ready to be set as header: the ASCII strings that are
+    safe as is are not RFC 2047 encoded, the other values are encoded with
+    I{charset} by C{email.header.Header}
+    """
+    if isinstance(value, email.header.Header):
+        return value
+    if (
+        isinstance(value, six.string_types)
+        and utils.is_usascii(value)
+        and not _raw_header_unsafe_re.search(value)
+    ):
+        return str(value)
+    return email.header.Header(value, charset)
+
+
+def message_size(payload):
+    """
+    return the size of I{payload} as sent to the SMTP host, with CRLF line
+    ends, the value to compare with the ESMTP I{SIZE} limit of the host
+
+    >>> message_size('Subject: hello\\n\\nmessage\\n')
+    27
+
+    @type payload: str or bytes
+    @param payload: the message
+    @rtype: int
+    @returns: the size in bytes
+    """
+    if isinstance(payload, six.text_type):
+        newline, carriage_return, crlf = '\n', '\r', '\r\n'
+    else:
+        newline, carriage_return, crlf = b'\n', b'\r', b'\r\n'
+    crlf_count = payload.count(crlf)
+    # every bare \n or \r gets an additional byte
+    return (
+        len(payload)
+        + payload.count(newline)
+        + payload.count(carriage_return)
+        - 2 * crlf_count
+    )
+
+
+ComposedMailType = namedtuple(
+    'ComposedMail', ('payload', 'mail_from', 'rcpt_to', 'msg_id')
+)
+
+
+class ComposedMail(ComposedMailType):
+    """
+    The value returned by L{complete_mail()} and L{compose_mail()}, a
+    tuple B{(payload, mail_from, rcpt_to, msg_id)} whose items are also
+    available by name.
+    """
+
+    __slots__ = ()
+
+    @property
+    def size(self):
+        """
+        the size of the payload as sent by L{send_mail()}, see
+        L{message_size()}. Use it to route the big messages to another
+        host.
+        """
+        return message_size(self.payload)
+
+
 def complete_mail(
     message,
     sender,
@@ -429,7 +817,8 @@ def complete_mail(
     @type subject: str
     @param subject: The subject of the message, can be a unicode string or a
     string encoded using I{default_charset} encoding. Prefert unicode to
-    byte string here.
+    byte string here. An ASCII only subject is written as is, the others
+    are RFC 2047 encoded.
     @type default_charset: str
     @param default_charset: The default charset for this email. Arguments
     that are non unicode string are supposed to be encoded using this charset.
@@ -443,16 +832,17 @@ def complete_mail(
     @type message_id_string: str or None
     @keyword message_id_string: if None, don't append any I{Message-ID} to the
     mail, let the SMTP do the job, else use the string to generate a unique
-    I{ID} using C{email.utils.make_msgid()}. The generated value is
-    returned as last argument. For example use the name of your application.
+    I{ID} using L{make_msgid()}. The generated value is returned as last
+    argument. For example use the name of your application, and append
+    C{'@domain'} to use your own domain instead of L{message_id_domain}.
     @type date: int or None
     @keyword date: utc time in second from the epoch or None. If None then
     use curent time C{time.time()} instead.
     @type headers: iterable of tuple
     @keyword headers: a list of C{(field, value)} tuples to fill in the mail
     header fields. values can be instances of email.header.Header or unicode strings
-    that will be encoded using I{default_charset}.
-    @rtype: tuple
+    that will be encoded using I{default_charset}, unless they are ASCII only.
+    @rtype: L{ComposedMail}
     @return: B{(payload, mail_from, rcpt_to, msg_id)}
         - I{payload} (str) is the content of the email, generated from the message
         - I{mail_from} (str) is the address of the sender to pass to the SMTP host
@@ -463,6 +853,9 @@ def complete_mail(
         the message-id. If not None, this I{Message-ID} is already written
         into the payload.
 
+    The size of the message to send is available as the I{size} attribute
+    of the returned value.
+
     >>> import email.mime.text
     >>> msg=email.mime.text.MIMEText('The text.', 'plain', 'us-ascii')
     >>> # I could use build_mail() instead
@@ -470,7 +863,6 @@ def complete_mail(
     ... [ ('Him', 'him@bar.com'), ], 'Non unicode subject', 'iso-8859-1',
     ... cc=['her@bar.com',], date=1313558269, headers=[('User-Agent', u'pyzmail'), ])
     >>> print(payload)
-    ... # 3.X encode  User-Agent: using 'iso-8859-1' even if it contains only us-asccii
     ... # doctest: +ELLIPSIS
     Content-Type: text/plain; charset="us-ascii"
     MIME-Version: 1.0
@@ -478,9 +870,9 @@ def complete_mail(
     From: Me <me@foo.com>
     To: Him <him@bar.com>
     Cc: her@bar.com
-    Subject: =?iso-8859-1?q?Non_unicode_subject?=
+    Subject: Non unicode subject
     Date: ...
-    User-Agent: ...pyzmail...
+    User-Agent: pyzmail
     <BLANKLINE>
     The text.
     >>> print('mail_from=%r rcpt_to=%r' % (mail_from, rcpt_to))
@@ -511,7 +903,7 @@ def complete_mail(
         )
     if cc:
         message['Cc'] = format_addresses(cc, header_name='cc', charset=default_charset)
-    message['Subject'] = email.header.Header(subject, default_charset)
+    message['Subject'] = _header_value(subject, default_charset)
     if date:
         utc_from_epoch = date
     else:
@@ -521,11 +913,6 @@ def complete_mail(
     if not message_id_string:
         msg_id = None
     else:
-        msg_id = email.utils.make_msgid(message_id_string)
-        # make_msgid() always appends the local host name in Python 2
-        # (in Python 3.2+ there is an additional "domain" parameter which could
-        # be used to simplify this code).
-        #
         # Appending the local host name can expose internal host names which
         # might be unwanted.
         # Example: The web service is behind a DDoS protection service which
@@ -533,23 +920,18 @@ def complete_mail(
         # the real IP without DDoS protection.
         # The following condition enables the user to use a custom hostname by
         # setting message_id_string to something like 'foo@my.host.example'.
-        # The code then removes the automatically appended internal hostname.
         if '@' in message_id_string:
-            msg_id = msg_id.rsplit('@', 1)[0] + '>'
-            # the following assertion should trigger if Python handles
-            # duplicate @ items in make_msgid().
-            assert '@' in msg_id, 'No @ in message id %r' % msg_id
+            msg_id = make_msgid(*message_id_string.rsplit('@', 1))
+        else:
+            msg_id = make_msgid(message_id_string)
         message['Message-Id'] = msg_id
 
     for field, value in headers:
-        if isinstance(value, email.header.Header):
-            message[field] = value
-        else:
-            message[field] = email.header.Header(value, default_charset)
+        message[field] = _header_value(value, default_charset)
 
     payload = message.as_string()
 
-    return payload, mail_from, rcpt_to, msg_id
+    return ComposedMail(payload, mail_from, rcpt_to, msg_id)
 
 
 def compose_mail(
@@ -576,7 +958,7 @@ def compose_mail(
     Returned value is the same as for L{build_mail()} and L{complete_mail()}.
     You can pass the returned values to L{send_mail()} or L{send_mail2()}.
 
-    @rtype: tuple
+    @rtype: L{ComposedMail}
     @return: B{(payload, mail_from, rcpt_to, msg_id)}
 
     >>> payload, mail_from, rcpt_to, msg_id=compose_mail((u'Me', 'me@foo.com'), [(u'Him', 'him@bar.com')], u'the subject', 'iso-8859-1', ('Hello world', 'us-ascii'), attachments=[('attached', 'text', 'plain', 'text.txt', 'us-ascii')])
@@ -596,6 +978,273 @@ def compose_mail(
     )
 
 
+_eols_re = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+
+
+# the SMTP client classes, created at the first connection because smtplib
+# is slow to import and useless to compose or parse messages
+_smtp_classes = None
+
+
+def _get_smtp_classes():
+    """
+    return the subclasses of C{smtplib.SMTP} and C{smtplib.SMTP_SSL} that
+    record the bytes sent and the SSL handshake in a L{SendStats}
+    """
+    global _smtp_classes
+    if _smtp_classes is not None:
+        return _smtp_classes
+
+    import smtplib
+
+    class _SMTP(smtplib.SMTP):
+        """a SMTP client that count the bytes sent into a L{SendStats}"""
+
+        def __init__(self, stats, *args, **kwargs):
+            self.stats = stats
+            smtplib.SMTP.__init__(self, *args, **kwargs)
+
+        def send(self, s):
+            self.stats.bytes_sent += len(s)
+            return smtplib.SMTP.send(self, s)
+
+    class _SMTP_SSL(smtplib.SMTP_SSL):
+        """a SMTP_SSL client that time the SSL handshake apart from connecting"""
+
+        def __init__(self, stats, *args, **kwargs):
+            self.stats = stats
+            smtplib.SMTP_SSL.__init__(self, *args, **kwargs)
+
+        def send(self, s):
+            self.stats.bytes_sent += len(s)
+            return smtplib.SMTP_SSL.send(self, s)
+
+        def _get_socket(self, host, port, timeout):
+            context = getattr(self, 'context', None)
+            if context is None:
+                # python 2.x, the handshake is part of the connection
+                return smtplib.SMTP_SSL._get_socket(self, host, port, timeout)
+            sock = smtplib.SMTP._get_socket(self, host, port, timeout)
+            with self.stats.stage('tls'):
+                return context.wrap_socket(sock, server_hostname=self._host)
+
+    _smtp_classes = (_SMTP, _SMTP_SSL)
+    return _smtp_classes
+
+
+def _connect(smtp_host, smtp_port, smtp_mode, stats):
+    """
+    Connect to the SMTP host, the bytes sent and the SSL handshake are
+    recorded in I{stats}, the time spent is recorded even if the connection
+    fails.
+    """
+    SMTP, SMTP_SSL = _get_smtp_classes()
+    start, tls = timer(), stats.tls
+    try:
+        if smtp_mode == 'ssl':
+            return SMTP_SSL(stats, smtp_host, smtp_port)
+        else:
+            return SMTP(stats, smtp_host, smtp_port)
+    finally:
+        # the SSL handshake is already in stats.tls
+        stats.record('connect', timer() - start - (stats.tls - tls))
+
+
+def _rset(smtp):
+    """reset the SMTP session, ignore a disconnection"""
+    import smtplib
+
+    try:
+        smtp.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+class _SpooledMessage(object):
+    """
+    A message already CRLF-normalized and dot-stuffed, read from a binary
+    file by L{send_mail_file()}
+    """
+
+    # the end of the message is sent with the final dot, this last write
+    # alone would be delayed by the Nagle algorithm
+    tail_size = 64 * 1024
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.start = fp.tell()
+        fp.seek(0, os.SEEK_END)
+        self.size = fp.tell() - self.start
+        fp.seek(self.start)
+
+    def send(self, smtp, stats):
+        """do like C{smtplib.SMTP.data()}"""
+        import smtplib
+
+        smtp.putcmd('data')
+        code, resp = smtp.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        head = self.size - min(self.size, self.tail_size)
+        self.fp.seek(self.start)
+        sendfile = getattr(smtp.sock, 'sendfile', None)
+        if sendfile is not None:
+            # the SSL sockets fall back to chunked writes by themselves
+            if head:
+                stats.bytes_sent += sendfile(self.fp, self.start, head)
+        else:
+            # Python 2
+            remaining = head
+            while remaining > 0:
+                chunk = self.fp.read(min(remaining, self.tail_size))
+                if not chunk:
+                    break
+                smtp.send(chunk)
+                remaining -= len(chunk)
+        self.fp.seek(self.start + head)
+        tail = self.fp.read(self.size - head)
+        if tail[-2:] != b'\r\n':
+            tail += b'\r\n'
+        smtp.send(tail + b'.\r\n')
+        return smtp.getreply()
+
+
+def _unique_recipients(rcpt_to):
+    """
+    return the recipients without the duplicates, compared without regard
+    to the case, in the same order
+    """
+    if isinstance(rcpt_to, six.string_types):
+        return [rcpt_to]
+    seen = set()
+    recipients = []
+    for recipient in rcpt_to:
+        key = recipient.lower()
+        if key not in seen:
+            seen.add(key)
+            recipients.append(recipient)
+    return recipients
+
+
+def _sendmail(smtp, mail_from, rcpt_to, payload, stats, max_recipients=None):
+    """
+    Do like C{smtplib.SMTP.sendmail()}, but time the envelope and the DATA
+    transfer apart in I{stats}. The duplicate recipients are removed and
+    the recipients are sent in transactions of at most I{max_recipients}.
+    When the server answers I{452 too many recipients}, the message is sent
+    to the recipients accepted so far, the others are sent in the next
+    transactions, with the number of recipients accepted by the server.
+    When a transaction fails after the message has been delivered to some
+    recipients, the recipients not reached are returned as refused with
+    the reply of the server, instead of raising an exception.
+    """
+    import smtplib
+
+    if isinstance(payload, _SpooledMessage):
+        size = payload.size
+        send_data = functools.partial(payload.send, smtp, stats)
+    else:
+        if isinstance(payload, six.text_type):
+            payload = _eols_re.sub('\r\n', payload).encode('ascii')
+        size = len(payload)
+        send_data = functools.partial(smtp.data, payload)
+    recipients = _unique_recipients(rcpt_to)
+    pending = recipients
+
+    refused = {}
+    delivered = set()
+
+    def refuse(recipients, code, resp):
+        for recipient in recipients:
+            if recipient not in delivered and recipient not in refused:
+                refused[recipient] = (code, resp)
+                stats.refused[recipient] = (code, resp)
+
+    with stats.stage('envelope'):
+        smtp.ehlo_or_helo_if_needed()
+        esmtp_opts = []
+        if smtp.does_esmtp and smtp.has_extn('size'):
+            esmtp_opts.append('size=%d' % size)
+            size_limit = smtp.esmtp_features['size']
+            if size_limit.isdigit() and 0 < int(size_limit) < size:
+                # fail before to send anything, with the reply of the servers
+                # checking the size of the MAIL FROM command
+                raise smtplib.SMTPSenderRefused(
+                    552,
+                    b'5.3.4 Message size exceeds fixed maximum message size',
+                    mail_from,
+                )
+    # a 452 reply to the first recipient of a transaction is retried once,
+    # in a new transaction
+    retry_452 = True
+    while pending:
+        accepted = []
+        with stats.stage('envelope'):
+            code, resp = smtp.mail(mail_from, esmtp_opts)
+            if code != 250:
+                if code == 421:
+                    smtp.close()
+                else:
+                    _rset(smtp)
+                if not delivered:
+                    raise smtplib.SMTPSenderRefused(code, resp, mail_from)
+                refuse(recipients, code, resp)
+                return refused
+            batch = pending[:max_recipients] if max_recipients else pending
+            deferred = pending[len(batch) :]
+            for i, recipient in enumerate(batch):
+                code, resp = smtp.rcpt(recipient)
+                if code in (250, 251):
+                    accepted.append(recipient)
+                    continue
+                if code == 452 and (accepted or retry_452):
+                    # too many recipients, the others go to the next transaction
+                    if accepted:
+                        # the server limit is known now
+                        max_recipients = len(accepted)
+                    else:
+                        retry_452 = False
+                    deferred = batch[i:] + deferred
+                    break
+                if code == 452:
+                    # still refused by a new transaction
+                    refuse(batch[i:] + deferred, code, resp)
+                    deferred = []
+                    break
+                refuse([recipient], code, resp)
+                if code == 421:
+                    smtp.close()
+                    if not delivered:
+                        raise smtplib.SMTPRecipientsRefused(refused)
+                    refuse(recipients, code, resp)
+                    return refused
+            if not accepted:
+                # the server refused all the recipients of this transaction
+                _rset(smtp)
+        pending = deferred
+        if not accepted:
+            continue
+
+        with stats.stage('data'):
+            code, resp = send_data()
+        if code != 250:
+            if code == 421:
+                smtp.close()
+            else:
+                _rset(smtp)
+            if not delivered:
+                raise smtplib.SMTPDataError(code, resp)
+            refuse(recipients, code, resp)
+            return refused
+        delivered.update(accepted)
+        retry_452 = True
+
+    if not delivered:
+        # the server refused all our recipients
+        raise smtplib.SMTPRecipientsRefused(refused)
+    return refused
+
+
 def send_mail2(
     payload,
     mail_from,
@@ -605,6 +1254,8 @@ def send_mail2(
     smtp_mode='normal',
     smtp_login=None,
     smtp_password=None,
+    stats=None,
+    max_recipients=None,
 ):
     """
     Send the message to a SMTP host. Look at the L{send_mail()} documentation.
@@ -613,12 +1264,31 @@ def send_mail2(
     is always a dictionary. It can be empty if all recipients have been
     accepted.
 
+    @type stats: L{SendStats<pyzmail.instrument.SendStats>} or None
+    @keyword stats: if not None, the time spent in each stage of the SMTP
+    session, the bytes sent and the refused recipients are added to it,
+    even when an exception is raised.
+    @type max_recipients: int or None
+    @keyword max_recipients: the maximum number of recipients per SMTP
+    transaction, None for no limit. The message is sent again on the same
+    connection to the next recipients. When the server refuses a recipient
+    with the code I{452} (too many recipients) the number of recipients it
+    accepted is used as limit, the recipients refused with I{452} by a new
+    transaction are retried once more.
+
+    The duplicate recipients are removed, the addresses are compared without
+    regard to the case.
+
     @rtype: dict
     @return: This function return the value returnd by C{smtplib.SMTP.sendmail()}
-    or raise the same exceptions.
+    or raise the same exceptions. The refused recipients of all the SMTP
+    transactions are combined.
 
     This method will return normally if the mail is accepted for at least one
-    recipient. Otherwise it will raise an exception. That is, if this
+    recipient. When a later transaction fails, the recipients not reached
+    are returned as refused with the reply of the server, then the message
+    can be sent again to the refused recipients only. Otherwise it will
+    raise an exception. That is, if this
     method does not raise an exception, then someone should get your mail.
     If this method does not raise an exception, it returns a dictionary,
     with one entry for each recipient that was refused. Each entry contains a
@@ -627,23 +1297,28 @@ def send_mail2(
     @raise smtplib.SMTPException: Look at the standard C{smtplib.SMTP.sendmail()} documentation.
 
     """
-    if smtp_mode == 'ssl':
-        smtp = smtplib.SMTP_SSL(smtp_host, smtp_port)
-    else:
-        smtp = smtplib.SMTP(smtp_host, smtp_port)
-        if smtp_mode == 'tls':
-            smtp.starttls()
+    if stats is None:
+        stats = SendStats()
 
-    if smtp_login and smtp_password:
-        if six.PY2:
-            # login and password must be encoded
-            # because HMAC used in CRAM_MD5 require non unicode string
-            smtp.login(smtp_login.encode('utf-8'), smtp_password.encode('utf-8'))
-        else:
-            # python 3.x
-            smtp.login(smtp_login, smtp_password)
+    smtp = _connect(smtp_host, smtp_port, smtp_mode, stats)
     try:
-        ret = smtp.sendmail(mail_from, rcpt_to, payload)
+        if smtp_mode == 'tls':
+            with stats.stage('tls'):
+                smtp.starttls()
+
+        if smtp_login and smtp_password:
+            with stats.stage('login'):
+                if six.PY2:
+                    # login and password must be encoded
+                    # because HMAC used in CRAM_MD5 require non unicode string
+                    smtp.login(
+                        smtp_login.encode('utf-8'), smtp_password.encode('utf-8')
+                    )
+                else:
+                    # python 3.x
+                    smtp.login(smtp_login, smtp_password)
+
+        ret = _sendmail(smtp, mail_from, rcpt_to, payload, stats, max_recipients)
     finally:
         try:
             smtp.quit()
@@ -653,6 +1328,65 @@ def send_mail2(
     return ret
 
 
+def send_mail_file(
+    message_file,
+    mail_from,
+    rcpt_to,
+    smtp_host,
+    smtp_port=25,
+    smtp_mode='normal',
+    smtp_login=None,
+    smtp_password=None,
+    stats=None,
+    max_recipients=None,
+):
+    """
+    Send a message already serialized on disk, like L{send_mail2()}. The
+    message is not loaded in memory, it is transmitted with
+    C{socket.sendfile()} that use the C{sendfile} system call when
+    possible. In I{ssl} and I{tls} modes and with Python 2 the file is sent
+    by chunks.
+
+    The content is sent as is after the I{DATA} command, it must use CRLF
+    line ends and the lines starting with a dot must already be
+    dot-stuffed. Its size in the file is compared with the I{SIZE} limit
+    of the server.
+
+    @type message_file: str or file
+    @param message_file: the path of the message or a file opened in binary
+    mode, the message is read from the current position to the end.
+    @rtype: dict
+    @return: the refused recipients, see L{send_mail2()}
+    @raise smtplib.SMTPException: see L{send_mail2()}
+    """
+    if isinstance(message_file, six.string_types):
+        with open(message_file, 'rb') as fp:
+            return send_mail_file(
+                fp,
+                mail_from,
+                rcpt_to,
+                smtp_host,
+                smtp_port,
+                smtp_mode,
+                smtp_login,
+                smtp_password,
+                stats,
+                max_recipients,
+            )
+    return send_mail2(
+        _SpooledMessage(message_file),
+        mail_from,
+        rcpt_to,
+        smtp_host,
+        smtp_port,
+        smtp_mode,
+        smtp_login,
+        smtp_password,
+        stats,
+        max_recipients,
+    )
+
+
 def send_mail(
     payload,
     mail_from,
@@ -662,6 +1396,8 @@ def send_mail(
     smtp_mode='normal',
     smtp_login=None,
     smtp_password=None,
+    stats=None,
+    max_recipients=None,
 ):
     """
     Send the message to a SMTP host. Handle SSL, TLS and authentication.
@@ -691,6 +1427,10 @@ def send_mail(
     @keyword smtp_password: If authentication is required, this is the password.
                           Be carefull to I{UTF8} encode your password if it
                           contains non I{us-ascii} characters.
+    @type stats: L{SendStats<pyzmail.instrument.SendStats>} or None
+    @keyword stats: see L{send_mail2()}
+    @type max_recipients: int or None
+    @keyword max_recipients: see L{send_mail2()}
 
     @rtype: dict or str
     @return: This function return a dictionary of failed recipients
@@ -731,6 +1471,8 @@ def send_mail(
 
     """
 
+    import smtplib
+
     error = dict()
     try:
         ret = send_mail2(
@@ -742,8 +1484,10 @@ def send_mail(
             smtp_mode,
             smtp_login,
             smtp_password,
+            stats,
+            max_recipients,
         )
-    except (socket.error,) as e:
+    except (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected) as e:
         error = 'server %s:%s not responding: %s' % (smtp_host, smtp_port, e)
     except smtplib.SMTPAuthenticationError as e:
         error = 'authentication error: %s' % (e,)
@@ -752,13 +1496,20 @@ def send_mail(
         error = 'all recipients refused: ' + ', '.join(e.recipients.keys())
     except smtplib.SMTPSenderRefused as e:
         # e.sender, e.smtp_code, e.smtp_error
-        error = 'sender refused: %s' % (e.sender,)
+        if e.smtp_code == 552:
+            error = 'message too large: %s' % (e.smtp_error,)
+        else:
+            error = 'sender refused: %s' % (e.sender,)
     except smtplib.SMTPDataError as e:
         error = 'SMTP protocol mismatch: %s' % (e,)
     except smtplib.SMTPHeloError as e:
         error = "server didn't reply properly to the HELO greeting: %s" % (e,)
     except smtplib.SMTPException as e:
         error = 'SMTP error: %s' % (e,)
+    except (socket.error,) as e:
+        # after the SMTP exceptions, that inherit from socket.error since
+        # Python 3.4
+        error = 'server %s:%s not responding: %s' % (smtp_host, smtp_port, e)
     else:
         # failed addresses and error messages
         error = ret
@@ -0,0 +1,252 @@
+#
+# pyzmail/instrument.py
+# Released under LGPL
+
+"""
+Optional instrumentation of pyzmail, to know where the time goes.
+
+Activate a L{Profiler} as a context manager, then every stage of
+L{PyzMessage<pyzmail.parse.PyzMessage>} parsing and every
+L{decode_mail_header()<pyzmail.parse.decode_mail_header>} call done by the
+same thread is timed and counted::
+
+    with Profiler() as profiler:
+        for raw in messages:
+            PyzMessage.factory(raw)
+    print(profiler.as_counters())
+
+When no profiler is active, the instrumented code only test a global
+counter. Pass a L{SendStats} to L{send_mail2()<pyzmail.generate.send_mail2>}
+to get the breakdown of the time spent in the SMTP session.
+
+@var timer: the clock used to measure the stages
+"""
+
+from __future__ import absolute_import, print_function
+
+import threading
+import time
+
+__all__ = ['Profiler', 'SendStats', 'current_profiler', 'stage']
+
+timer = getattr(time, 'perf_counter', time.time)
+
+_local = threading.local()
+_lock = threading.Lock()
+# the number of active profilers, all threads together
+_active_count = 0
+
+
+def current_profiler():
+    """
+    return the profiler active in the current thread
+
+    @rtype: L{Profiler} or None
+    @returns: the innermost active profiler or None
+    """
+    if not _active_count:
+        return None
+    return getattr(_local, 'profiler', None)
+
+
+class _NullStage(object):
+    """a context manager doing nothing, when no profiler is active"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage(object):
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.record(self.name, timer() - self.start)
+        return False
+
+
+def stage(name):
+    """
+    return a context manager that time the I{name} stage in the active
+    profiler, or that does nothing if there is no active profiler
+    """
+    profiler = current_profiler()
+    if profiler is None:
+        return _null_stage
+    return _Stage(profiler, name)
+
+
+class Profiler(object):
+    """
+    Record the number of calls and the time spent in each stage.
+
+    The stages recorded by pyzmail are:
+        - C{smart_parser}: the parsing by the C{email} package, in
+        L{PyzMessage.factory()<pyzmail.parse.PyzMessage.factory>}
+        - C{get_mail_parts}: the walk of the MIME structure, including the
+        search for the body parts
+        - C{sanitize_filenames}: the computation of the
+        I{sanitized_filename} of the parts
+        - C{decode_mail_header}: every header decoded
+        - C{smtp_connect}, C{smtp_tls}, C{smtp_login}, C{smtp_envelope} and
+        C{smtp_data}: the stages of L{SendStats}
+
+    @ivar stats: a dictionary C{{stage: [count, seconds]}}
+    @ivar callback: None or a function called with C{(stage, seconds)} each
+    time a stage complete, to forward them to a metric system
+    """
+
+    def __init__(self, callback=None):
+        """
+        @type callback: callable or None
+        @keyword callback: called with C{(stage, seconds)} each time a stage
+        complete
+        """
+        self.callback = callback
+        self.stats = {}
+        self._previous = None
+
+    def __enter__(self):
+        global _active_count
+        self._previous = getattr(_local, 'profiler', None)
+        _local.profiler = self
+        with _lock:
+            _active_count += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active_count
+        _local.profiler = self._previous
+        self._previous = None
+        with _lock:
+            _active_count -= 1
+        return False
+
+    def stage(self, name):
+        """return a context manager that time the I{name} stage"""
+        return _Stage(self, name)
+
+    def record(self, name, seconds, count=1):
+        """add I{count} calls and I{seconds} to the I{name} stage"""
+        stat = self.stats.get(name)
+        if stat is None:
+            self.stats[name] = [count, seconds]
+        else:
+            stat[0] += count
+            stat[1] += seconds
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def reset(self):
+        """forget everything recorded"""
+        self.stats.clear()
+
+    def as_counters(self, prefix='pyzmail', separator='.'):
+        """
+        return the stats as flat counters, ready for I{StatsD} or
+        I{Prometheus} (use C{separator='_'})
+
+        >>> profiler = Profiler()
+        >>> profiler.record('smart_parser', 0.25)
+        >>> sorted(profiler.as_counters().items())
+        [('pyzmail.smart_parser.count', 1), ('pyzmail.smart_parser.seconds', 0.25)]
+
+        @type prefix: str
+        @keyword prefix: prepended to all the names
+        @type separator: str
+        @keyword separator: join the parts of the names
+        @rtype: dict
+        @returns: a dictionary C{{name: value}} with a I{count} and a
+        I{seconds} counter for each stage
+        """
+        counters = {}
+        for name, (count, seconds) in self.stats.items():
+            base = separator.join(filter(None, (prefix, name)))
+            counters[base + separator + 'count'] = count
+            counters[base + separator + 'seconds'] = seconds
+        return counters
+
+
+class SendStats(object):
+    """
+    The breakdown of one or more SMTP sessions of
+    L{send_mail2()<pyzmail.generate.send_mail2>}, the times are in seconds
+    and add up when the same object is reused. The stages are also recorded
+    in the active L{Profiler} if any, prefixed by C{smtp_}.
+
+    @ivar connect: the TCP connection and the greeting of the server
+    @ivar tls: the STARTTLS command and handshake in I{tls} mode or the
+    SSL handshake in I{ssl} mode (included in I{connect} with Python 2)
+    @ivar login: the authentication
+    @ivar envelope: the I{EHLO}, I{MAIL FROM} and I{RCPT TO} commands
+    @ivar data: the I{DATA} command and the transfer of the message
+    @ivar bytes_sent: the number of bytes sent to the server, commands
+    included
+    @ivar refused: the refused recipients, in the same form as the value
+    returned by L{send_mail2()<pyzmail.generate.send_mail2>}
+    """
+
+    stages = ('connect', 'tls', 'login', 'envelope', 'data')
+
+    def __init__(self):
+        for name in self.stages:
+            setattr(self, name, 0.0)
+        self.bytes_sent = 0
+        self.refused = {}
+
+    def __repr__(self):
+        return '<SendStats %s bytes_sent=%d refused=%d>' % (
+            ' '.join('%s=%.6f' % (name, getattr(self, name)) for name in self.stages),
+            self.bytes_sent,
+            len(self.refused),
+        )
+
+    @property
+    def total(self):
+        """the sum of all the stages"""
+        return sum(getattr(self, name) for name in self.stages)
+
+    def stage(self, name):
+        """return a context manager that time the I{name} stage"""
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        """add I{seconds} to the I{name} stage"""
+        setattr(self, name, getattr(self, name) + seconds)
+        profiler = current_profiler()
+        if profiler is not None:
+            profiler.record('smtp_' + name, seconds)
+
+    def as_counters(self, prefix='pyzmail.smtp', separator='.'):
+        """
+        return the stats as flat counters, like L{Profiler.as_counters()}
+
+        >>> stats = SendStats()
+        >>> stats.record('data', 0.5)
+        >>> counters = stats.as_counters()
+        >>> counters['pyzmail.smtp.data.seconds'], counters['pyzmail.smtp.refused']
+        (0.5, 0)
+        """
+        counters = {}
+        for name in self.stages:
+            base = separator.join(filter(None, (prefix, name)))
+            counters[base + separator + 'seconds'] = getattr(self, name)
+        for name in ('bytes_sent', 'refused'):
+            value = getattr(self, name)
+            if isinstance(value, dict):
+                value = len(value)
+            counters[separator.join(filter(None, (prefix, name)))] = value
+        return counters
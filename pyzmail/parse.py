@@ -7,7 +7,14 @@
 """
 Useful functions to parse emails
 
-@var email_address_re: a regex that match a well formed email address (from perlfaq9)
+@var email_address_re: a regex that match a well formed email address (from perlfaq9),
+compiled at first use
+@var text_charsets: the charsets tried by L{decode_text()} after the ones
+specified by the caller
+@var text_sample_size: the number of bytes L{decode_text()} use to discard
+a charset before trying to decode the full payload
+@var payload_chunk_size: the default size of the chunks returned by
+L{MailPart.iter_payload()} and L{PyzMessage.iter_text()}
 @undocumented: atom_rfc2822
 @undocumented: atom_posfix_restricted
 @undocumented: atom
@@ -26,15 +33,23 @@ try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
+import binascii
+import codecs
 import email.errors
+import email.feedparser
 import email.header
 import email.message
+import email.parser
 import email.utils
-import mimetypes
+import itertools
+import quopri
 import sys
 
 import six
+from six.moves import html_entities
+from six.moves.html_parser import HTMLParser
 
+from . import instrument
 from .utils import *
 
 
@@ -48,6 +63,7 @@ __all__ = [
     'message_from_file',
     'message_from_string',
     'PyzMessage',
+    'PyzMessageFeedParser',
 ]
 
 # email address REGEX matching the RFC 2822 spec from perlfaq9
@@ -69,8 +85,83 @@ local = "(?:" + dot_atom + "|" + quoted + ")"
 domain_lit = r"\[(?:\\\S|[\x21-\x5a\x5e-\x7e])*\]"
 domain = "(?:" + dot_atom + "|" + domain_lit + ")"
 addr_spec = local + "@" + domain
-# and the result
-email_address_re = re.compile('^' + addr_spec + '$')
+# and the result, compiled when used, to not slow down the import
+_email_address_re = None
+
+
+def _compile_email_address_re():
+    global email_address_re, _email_address_re
+    _email_address_re = email_address_re = re.compile('^' + addr_spec + '$')
+    return _email_address_re
+
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        if name == 'email_address_re':
+            return _compile_email_address_re()
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+else:
+    _compile_email_address_re()
+
+payload_chunk_size = 8 * 1024
+
+_base64_junk_re = re.compile(b'[^A-Za-z0-9+/=]+')
+
+
+def _payload_to_bytes(payload):
+    """
+    convert a raw payload as stored by the Python 3 email package into bytes,
+    the same way C{email.message.Message.get_payload(decode=True)} does
+    """
+    if isinstance(payload, bytes):
+        return payload
+    try:
+        # surrogates are used to store non us-ascii bytes
+        return payload.encode('ascii', 'surrogateescape')
+    except UnicodeError:
+        return payload.encode('raw-unicode-escape')
+
+
+def _iter_transfer_decoded(payload, cte, chunk_size):
+    """
+    split the raw I{payload} in chunks of about I{chunk_size} characters,
+    and yield them decoded according to the Content-Transfer-Encoding I{cte}.
+    Chunks are cut where the encoding allows it: on a multiple of 4 significant
+    characters for base64 and at the end of a line for quoted-printable.
+    """
+    pending = b''
+    for start in range(0, len(payload), chunk_size):
+        data = pending + _payload_to_bytes(payload[start : start + chunk_size])
+        if cte == 'base64':
+            data = _base64_junk_re.sub(b'', data)
+            end = len(data) - len(data) % 4
+        elif cte == 'quoted-printable':
+            end = data.rfind(b'\n') + 1
+        else:
+            end = len(data)
+        data, pending = data[:end], data[end:]
+        if data:
+            yield _transfer_decode(data, cte)
+    if pending:
+        yield _transfer_decode(pending, cte, final=True)
+
+
+def _transfer_decode(data, cte, final=False):
+    if cte == 'base64':
+        padded = data
+        if final:
+            # be tolerant with the missing padding, like the email package
+            padded += b'==='[: -len(data) % 4]
+        try:
+            return binascii.a2b_base64(padded)
+        except binascii.Error:
+            # keep the undecodable data, like get_payload(decode=True)
+            return data
+    elif cte == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
 
 
 class MailPart:
@@ -164,6 +255,48 @@ class MailPart:
             payload = self.part.get_payload(decode=True)
         return payload
 
+    def iter_payload(self, chunk_size=None):
+        """
+        decode the part payload chunk by chunk, and yield the decoded
+        bytes as and when. This is the same content as returned by
+        L{get_payload()} but the payload is never decoded at once, then
+        the caller can stop when he has read enough.
+
+        @type chunk_size: int or None
+        @keyword chunk_size: the approximate size of the encoded data decoded
+        at each step, default to L{payload_chunk_size}
+        @rtype: iterator
+        @returns: an iterator over the decoded chunks (bytes)
+        """
+        if chunk_size is None:
+            chunk_size = payload_chunk_size
+
+        cte = str(self.part.get('content-transfer-encoding', '')).lower()
+        if (
+            self.type.startswith('message/')
+            or self.part.is_multipart()
+            or cte not in ('', '7bit', '8bit', 'binary', 'base64', 'quoted-printable')
+        ):
+            # uuencode, unknown encoding and messages are not worth the effort
+            payload = self.get_payload()
+            if payload:
+                for start in range(0, len(payload), chunk_size):
+                    yield payload[start : start + chunk_size]
+            return
+
+        if cte not in ('base64', 'quoted-printable'):
+            # nothing to decode, but get_payload() without decode would
+            # return the non us-ascii bytes decoded with the charset
+            payload = self.part.get_payload(decode=True)
+            for start in range(0, len(payload), chunk_size):
+                yield payload[start : start + chunk_size]
+            return
+
+        payload = self.part.get_payload()
+        for data in _iter_transfer_decoded(payload, cte, chunk_size):
+            if data:
+                yield data
+
     def __repr__(self):
         st = 'MailPart<'
         if self.is_body:
@@ -219,7 +352,15 @@ def decode_mail_header(value, default_charset='us-ascii'):
     >>> decode_mail_header('=?iso-8859-1?q?Courrier_=E8lectronique_en_Fran=E7ais?=')
     u'Courrier \\xe8lectronique en Fran\\xe7ais'
     """
+    profiler = instrument.current_profiler()
+    if profiler is None:
+        return _decode_mail_header(value, default_charset)
+    with profiler.stage('decode_mail_header'):
+        return _decode_mail_header(value, default_charset)
+
 
+def _decode_mail_header(value, default_charset):
+    """the implementation of L{decode_mail_header()}"""
     try:
         headers = email.header.decode_header(value)
     except email.errors.HeaderParseError:
@@ -255,7 +396,24 @@ def decode_mail_header(value, default_charset='us-ascii'):
         return u"".join(headers)
 
 
-def get_mail_addresses(message, header_name):
+def _truncated_header(value, max_length, exceeded):
+    """
+    truncate the header I{value} to I{max_length} characters if required
+    """
+    if max_length is None:
+        return value
+    text = value
+    if isinstance(value, email.header.Header):
+        # header containing invalid characters (Python 3)
+        text = six.text_type(value)
+    if len(text) > max_length:
+        if exceeded is not None:
+            exceeded.add('max_header_length')
+        return text[:max_length]
+    return value
+
+
+def get_mail_addresses(message, header_name, max_length=None, exceeded=None):
     """
     retrieve all email addresses from one message header
 
@@ -264,6 +422,12 @@ def get_mail_addresses(message, header_name):
     @type header_name: str
     @param header_name: the name of the header, can be 'from', 'to', 'cc' or
     any other header containing one or more email addresses
+    @type max_length: int or None
+    @keyword max_length: the headers longer than that are truncated before
+    to be parsed
+    @type exceeded: set or None
+    @keyword exceeded: C{'max_header_length'} is added to this set when a
+    header is truncated
     @rtype: list
     @returns: a list of the addresses in the form of tuples
     C{[(u'Name', 'addresse@domain.com'), ...]}
@@ -287,8 +451,12 @@ def get_mail_addresses(message, header_name):
     [(u'A', 'a@foo.com'), (u'B', 'b@foo.com')]
     """
     addrs = email.utils.getaddresses(
-        [_friendly_header(h) for h in message.get_all(header_name, [])]
+        [
+            _friendly_header(_truncated_header(h, max_length, exceeded))
+            for h in message.get_all(header_name, [])
+        ]
     )
+    address_re = _email_address_re or _compile_email_address_re()
     for i, (addr_name, addr) in enumerate(addrs):
         if not addr_name and addr:
             # only one string! Is it the address or the  address name ?
@@ -297,7 +465,7 @@ def get_mail_addresses(message, header_name):
 
         if is_usascii(addr):
             # address must be ascii only and must match address regex
-            if not email_address_re.match(addr):
+            if not address_re.match(addr):
                 addr = ''
         else:
             addr = ''
@@ -341,9 +509,37 @@ def get_filename(part):
     <BLANKLINE>
     The text.
     """
-    filename = part.get_param('filename', None, 'content-disposition')
+    return _get_filename(_PartParams(part))
+
+
+class _PartParams(object):
+    """
+    The parameters of the I{Content-Type} and I{Content-Disposition} headers
+    of one part, each header is parsed once at first use. I{get()} returns
+    the same values as C{part.get_param(param, None, header)}.
+    """
+
+    __slots__ = ('part', 'headers')
+
+    def __init__(self, part):
+        self.part = part
+        self.headers = dict()
+
+    def get(self, param, header='content-type'):
+        params = self.headers.get(header)
+        if params is None:
+            params = dict()
+            for k, v in self.part.get_params([], header):
+                params.setdefault(k.lower(), v)
+            self.headers[header] = params
+        return params.get(param)
+
+
+def _get_filename(params):
+    """see L{get_filename()}, I{params} is the L{_PartParams} of the part"""
+    filename = params.get('filename', 'content-disposition')
     if not filename:
-        filename = part.get_param('name', None)  # default is 'content-type'
+        filename = params.get('name')  # default is 'content-type'
 
     if filename:
         if isinstance(filename, tuple):
@@ -357,75 +553,200 @@ def get_filename(part):
     return filename
 
 
-def _search_message_content(contents, part):
-    """
-    recursive search of message content (text or HTML) inside
-    the structure of the email. Used by L{search_message_content()}
-
-    @type contents: dict
-    @param contents: contents already found in parents or brothers I{parts}.
-    The dictionary will be completed as and when. key is the MIME type of the part.
-    @type part: inherit email.mime.base.MIMEBase
-    @param part: the part of the mail to look inside recursively.
-    """
-    type = part.get_content_type()
-    if part.is_multipart():  # type.startswith('multipart/'):
-        # explore only True 'multipart/*'
-        # because 'messages/rfc822' are 'multipart/*' too but
-        # must not be explored here
-        if type == 'multipart/related':
-            # the first part or the one pointed by start
-            start = part.get_param('start', None)
-            related_type = part.get_param('type', None)
-            for i, subpart in enumerate(part.get_payload()):
-                if (not start and i == 0) or (
-                    start and start == subpart.get('Content-Id')
-                ):
-                    _search_message_content(contents, subpart)
-                    return
-        elif type == 'multipart/alternative':
-            # all parts are candidates and latest is the best
-            for subpart in part.get_payload():
-                _search_message_content(contents, subpart)
-        elif type in ('multipart/report', 'multipart/signed'):
-            # only the first part is candidate
-            try:
-                subpart = part.get_payload()[0]
-            except IndexError:
-                return
-            else:
-                _search_message_content(contents, subpart)
-                return
+# markers used in the stack of _walk_message()
+_open_frame = object()
+_merge_frame = object()
 
-        elif type == 'multipart/encrypted':
-            # the second part is the good one, but we need to de-crypt it
-            # using the first part. Do nothing
-            return
 
-        else:
-            # unknown types must be handled as 'multipart/mixed'
-            # This is the peace of code that could probably be improved,
-            # I use a heuristic : if not already found, use first valid non
-            # 'attachment' parts found
-            for subpart in part.get_payload():
-                tmp_contents = dict()
-                _search_message_content(tmp_contents, subpart)
-                for k, v in tmp_contents.items():
-                    param_cd = subpart.get_param(
-                        'attachment', None, 'content-disposition'
+def _walk_message(msg, collect, max_parts, max_depth, max_decoded_size, exceeded):
+    """
+    Explore the structure of the message once, without recursion, to both
+    collect the L{MailPart}s and search the message content (text or HTML).
+
+    The content is searched like this:
+        - I{multipart/related}: the first part or the one pointed by I{start}
+        - I{multipart/alternative}: all parts are candidates and latest is the best
+        - I{multipart/report} and I{multipart/signed}: only the first part
+        - I{multipart/encrypted}: nothing, the parts must be decrypted first
+        - unknown types, I{message/*} included, are handled as
+        I{multipart/mixed}: the content of the first non attachment part
+        containing one is used if not already found.
+
+    Each part of a I{multipart/mixed} has its own I{frame} where its contents
+    are stored before to be merged into the frame of its parent. A frame
+    is only allocated when a content is found, and non multipart parts are
+    merged directly.
+
+    @type msg: inherit email.message.Message
+    @param msg: the message
+    @type collect: bool
+    @param collect: if False, only search the message content
+    @rtype: tuple
+    @returns: C{(mailparts, contents)} see L{get_mail_parts()} and
+    L{search_message_content()}
+    """
+    mailparts = []
+    # the leaf mail parts, to set is_body at the end
+    leaves = dict()
+    contents = dict()
+    frames = [contents]
+    decoded_size = 0
+    # the parsed parameters of the parts, shared by all the lookups
+    all_params = dict()
+
+    def part_params(part):
+        params = all_params.get(part)
+        if params is None:
+            params = all_params[part] = _PartParams(part)
+        return params
+
+    # the stack items are (part, depth, collect, frame, overwrite) where frame
+    # is the index in frames where the content goes or None to not search,
+    # and overwrite tells if a content found replaces the one already in the
+    # frame. The next part to explore is at the end (deep first search).
+    stack = [(msg, 0, collect, 0, True)]
+    while stack:
+        part, depth, collected, frame, overwrite = stack.pop()
+        if part is _open_frame:
+            frames.append(None)
+            continue
+        if part is _merge_frame:
+            found = frames.pop()
+            if found:
+                parent = frames[frame]
+                if parent is None:
+                    frames[frame] = found
+                else:
+                    for k, v in found.items():
+                        parent.setdefault(k, v)
+            continue
+
+        if max_depth is not None and depth > max_depth:
+            exceeded.add('max_depth')
+            continue
+
+        type = part.get_content_type()
+        is_multipart = part.is_multipart()
+
+        if collected:
+            if max_parts is not None and len(mailparts) >= max_parts:
+                exceeded.add('max_parts')
+                break
+            if max_decoded_size is not None and not is_multipart:
+                decoded_size += _estimated_size(part)
+                if decoded_size > max_decoded_size:
+                    exceeded.add('max_decoded_size')
+                    break
+
+            if type.startswith('message/'):
+                # ('message/delivery-status', 'message/rfc822', 'message/disposition-notification'):
+                # I don't want to explore the tree deeper her and just save source using msg.as_string()
+                # but I don't use msg.as_string() because I want to use mangle_from_=False
+                params = part_params(part)
+                filename = _get_filename(params)
+                filename = filename if filename else 'message.eml'
+                mailparts.append(
+                    MailPart(
+                        part,
+                        filename=filename,
+                        type=type,
+                        charset=params.get('charset'),
+                        description=part.get('Content-Description'),
+                    )
+                )
+                collected = False
+            elif not is_multipart:
+                params = part_params(part)
+                charset = params.get('charset')
+                filename = _get_filename(params)
+
+                disposition = None
+                if params.get('inline', 'content-disposition') == '':
+                    disposition = 'inline'
+                elif params.get('attachment', 'content-disposition') == '':
+                    disposition = 'attachment'
+
+                mailpart = MailPart(
+                    part,
+                    filename=filename,
+                    type=type,
+                    charset=charset,
+                    content_id=part.get('Content-Id'),
+                    description=part.get('Content-Description'),
+                    disposition=disposition,
+                    is_body=False,
+                )
+                mailparts.append(mailpart)
+                leaves[part] = mailpart
+
+        if not is_multipart:
+            if frame is not None:
+                if frames[frame] is None:
+                    frames[frame] = dict()
+                if overwrite:
+                    frames[frame][type] = part
+                else:
+                    frames[frame].setdefault(type, part)
+            continue
+
+        subparts = part.get_payload()
+        # the frame of each sub part, None if not searched
+        subframes = [None] * len(subparts)
+        if frame is not None:
+            if type == 'multipart/related':
+                # the first part or the one pointed by start
+                start = part_params(part).get('start')
+                for i, subpart in enumerate(subparts):
+                    if (not start and i == 0) or (
+                        start and start == subpart.get('Content-Id')
+                    ):
+                        subframes[i] = frame
+                        break
+            elif type == 'multipart/alternative':
+                # all parts are candidates and latest is the best
+                subframes = [frame] * len(subparts)
+            elif type in ('multipart/report', 'multipart/signed'):
+                # only the first part is candidate
+                subframes[:1] = [frame]
+            elif type == 'multipart/encrypted':
+                # the second part is the good one, but we need to de-crypt it
+                # using the first part. Do nothing
+                pass
+            else:
+                # unknown types must be handled as 'multipart/mixed'
+                # This is the peace of code that could probably be improved,
+                # I use a heuristic : if not already found, use first valid non
+                # 'attachment' parts found
+                for i, subpart in enumerate(subparts):
+                    param_cd = part_params(subpart).get(
+                        'attachment', 'content-disposition'
                     )
                     if param_cd != '':
-                        # if not an attachment, initiate value if not already found
-                        contents.setdefault(k, v)
-            return
-    else:
-        contents[part.get_content_type().lower()] = part
-        return
+                        subframes[i] = -1
+
+        for subpart, subframe in zip(reversed(subparts), reversed(subframes)):
+            if subframe is None:
+                if collected:
+                    stack.append((subpart, depth + 1, collected, None, True))
+            elif subframe != -1:
+                stack.append((subpart, depth + 1, collected, subframe, True))
+            elif subpart.is_multipart():
+                # sub part of a multipart/mixed, gets its own frame
+                stack.append((_merge_frame, depth, False, frame, True))
+                stack.append((subpart, depth + 1, collected, frame + 1, True))
+                stack.append((_open_frame, depth, False, None, True))
+            else:
+                # if not already found
+                stack.append((subpart, depth + 1, collected, frame, False))
 
-    return
+    for type, part in contents.items():
+        if part in leaves:
+            leaves[part].is_body = type
 
+    return mailparts, contents
 
-def search_message_content(mail):
+
+def search_message_content(mail, max_depth=None, exceeded=None):
     """
     search of message content (text or HTML) inside
     the structure of the mail. This function is used by L{get_mail_parts()}
@@ -433,6 +754,11 @@ def search_message_content(mail):
 
     @type mail: inherit from email.message.Message
     @param mail: the message to search in.
+    @type max_depth: int or None
+    @keyword max_depth: ignore the parts nested deeper than that
+    @type exceeded: set or None
+    @keyword exceeded: the name of the limit is added to this set if
+    some parts have been ignored
     @rtype: dict
     @returns: a dictionary of the form C{{'text/plain': text_part, 'text/html': html_part}}
     where text_part and html_part inherite from C{email.mime.text.MIMEText}
@@ -440,18 +766,49 @@ def search_message_content(mail):
     One part can be missing. The dictionay can aven be empty if none of the
     parts math the requirements to be considered as the content.
     """
-    contents = dict()
-    _search_message_content(contents, mail)
+    if exceeded is None:
+        exceeded = set()
+    mailparts, contents = _walk_message(mail, False, None, max_depth, None, exceeded)
     return contents
 
 
-def get_mail_parts(msg):
+def _estimated_size(part):
+    """
+    estimate the decoded size of a non multipart I{part} without decoding it
+    """
+    payload = part.get_payload()
+    if not isinstance(payload, (six.text_type, bytes)):
+        return 0
+    cte = str(part.get('content-transfer-encoding', '')).lower()
+    if cte == 'base64':
+        return len(payload) * 3 // 4
+    return len(payload)
+
+
+def get_mail_parts(
+    msg, max_parts=None, max_depth=None, max_decoded_size=None, exceeded=None
+):
     """
     return a list of all parts of the message as a list of L{MailPart}.
     Retrieve parts attributes to fill in L{MailPart} object.
 
+    The optional limits protect against hostile messages, when one is hit
+    the exploration stop and the parts found so far are returned.
+
     @type msg: inherit email.message.Message
     @param msg: the message
+    @type max_parts: int or None
+    @keyword max_parts: the maximum number of parts to return
+    @type max_depth: int or None
+    @keyword max_depth: ignore the parts nested deeper than that, the
+    top level message is at depth 0.
+    @type max_decoded_size: int or None
+    @keyword max_decoded_size: stop when the total size of the decoded parts
+    would exceed this number of bytes. The size is estimated from the
+    encoded payloads, nothing is decoded here.
+    @type exceeded: set or None
+    @keyword exceeded: the names of the limits that have been hit are added
+    to this set
     @rtype: list
     @returns: list of mail parts
 
@@ -493,77 +850,103 @@ def get_mail_parts(msg):
     (u'image.png', 4)
 
     """
-    mailparts = []
+    if exceeded is None:
+        exceeded = set()
+    mailparts, contents = _walk_message(
+        msg, True, max_parts, max_depth, max_decoded_size, exceeded
+    )
+    return mailparts
 
-    # retrieve messages of the email
-    contents = search_message_content(msg)
-    # reverse contents dict
-    parts = dict((v, k) for k, v in contents.items())
 
-    # organize the stack to handle deep first search
-    stack = [
-        msg,
-    ]
-    while stack:
-        part = stack.pop(0)
-        type = part.get_content_type()
-        if type.startswith('message/'):
-            # ('message/delivery-status', 'message/rfc822', 'message/disposition-notification'):
-            # I don't want to explore the tree deeper her and just save source using msg.as_string()
-            # but I don't use msg.as_string() because I want to use mangle_from_=False
-            filename = get_filename(part)
-            filename = filename if filename else 'message.eml'
-            mailparts.append(
-                MailPart(
-                    part,
-                    filename=filename,
-                    type=type,
-                    charset=part.get_param('charset'),
-                    description=part.get('Content-Description'),
-                )
-            )
-        elif part.is_multipart():
-            # insert new parts at the beginning of the stack (deep first search)
-            stack[:0] = part.get_payload()
-        else:
-            charset = part.get_param('charset')
-            filename = get_filename(part)
+text_charsets = ('ascii', 'utf-8', 'utf-16', 'windows-1252', 'cp850')
+text_sample_size = 64 * 1024
 
-            disposition = None
-            if part.get_param('inline', None, 'content-disposition') == '':
-                disposition = 'inline'
-            elif part.get_param('attachment', None, 'content-disposition') == '':
-                disposition = 'attachment'
+_ascii_bytes = bytes(bytearray(range(128)))
+_ascii_compatible_codecs = dict()
+# the payload length must be a multiple of the code unit of these codecs
+_codec_unit_sizes = {
+    'utf-16': 2,
+    'utf-16-be': 2,
+    'utf-16-le': 2,
+    'utf-32': 4,
+    'utf-32-be': 4,
+    'utf-32-le': 4,
+}
 
-            mailparts.append(
-                MailPart(
-                    part,
-                    filename=filename,
-                    type=type,
-                    charset=charset,
-                    content_id=part.get('Content-Id'),
-                    description=part.get('Content-Description'),
-                    disposition=disposition,
-                    is_body=parts.get(part, False),
-                )
-            )
 
-    return mailparts
+def _codec_name(charset):
+    """
+    return the normalized name of the codec for I{charset} or None if
+    Python doesn't know this charset
+    """
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+def _is_ascii_compatible(codec_name):
+    """
+    check if every us-ascii byte decode to the same character using this codec
+    without any state, then an us-ascii prefix never need to be checked again
+    """
+    try:
+        return _ascii_compatible_codecs[codec_name]
+    except KeyError:
+        try:
+            compatible = _ascii_bytes.decode(codec_name) == _ascii_bytes.decode('ascii')
+        except UnicodeError:
+            compatible = False
+        _ascii_compatible_codecs[codec_name] = compatible
+        return compatible
 
 
-def decode_text(payload, charset, default_charset):
+def _sample_decodes(sample, codec_name, final):
+    """
+    return False if I{sample} contains a sequence that is invalid for this codec.
+    Only reliable for us-ascii compatible codecs, other ones like utf-16 can
+    require a BOM at the beginning of an incremental decoding.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(codec_name)()
+    except LookupError:
+        # no incremental decoder, the full payload must be tried
+        return True
+    try:
+        decoder.decode(sample, final)
+    except UnicodeError:
+        return False
+    return True
+
+
+def decode_text(payload, charset, default_charset, charsets=None, sample_size=None):
     """
     Try to decode text content by trying multiple charset until success.
     First try I{charset}, else try I{default_charset} finally
     try popular charsets in order : ascii, utf-8, utf-16, windows-1252, cp850
     If all fail then use I{default_charset} and replace wrong characters
 
+    Each charset is tried only once. When the first attempt fails, the
+    length of the us-ascii prefix of the payload is computed, then the
+    next us-ascii compatible candidates are checked against a sample of at
+    most I{sample_size} bytes starting at the first non us-ascii character.
+    Only the candidates that pass this check are used to decode the
+    whole I{payload}, this avoid one full decoding for each wrong charset
+    when big bodies are mislabelled. The result is the same as trying the
+    candidates one after the other.
+
     @type payload: str
     @param payload: the content to decode
     @type charset: str or None
     @param charset: the first charset to try if != C{None}
     @type default_charset: str or None
     @param default_charset: the second charset to try if != C{None}
+    @type charsets: iterable or None
+    @keyword charsets: the charsets to try after I{charset} and
+    I{default_charset}, default to L{text_charsets}
+    @type sample_size: int or None
+    @keyword sample_size: the size of the sample used to discard wrong
+    charsets, default to L{text_sample_size}
 
     @rtype: tuple
     @returns: a tuple of the form C{(payload, charset)}
@@ -574,30 +957,206 @@ def decode_text(payload, charset, default_charset):
         invalid characters have been replaced and the used charset is I{default_charset}
         else, if I{payload} is still byte string then nothing has been done.
 
-
+    >>> decode_text(b'Fran\\xe7aise', 'utf-8', None)
+    (u'Fran\\xe7aise', 'windows-1252')
     """
-    charsets = (
-        charset,
-        default_charset,
-        'ascii',
-        'utf-8',
-        'utf-16',
-        'windows-1252',
-        'cp850',
-    )
-    for chset in charsets:
-        if chset:
+    if charsets is None:
+        charsets = text_charsets
+    if sample_size is None:
+        sample_size = text_sample_size
+
+    ascii_text = sample = None
+    tried = set()
+    for chset in (charset, default_charset) + tuple(charsets):
+        if not chset:
+            continue
+        codec_name = _codec_name(chset)
+        if codec_name is None or codec_name in tried:
+            continue
+        tried.add(codec_name)
+
+        if len(payload) % _codec_unit_sizes.get(codec_name, 1):
+            # truncated data, don't waste time decoding the full payload
+            continue
+        if sample is not None and _is_ascii_compatible(codec_name):
+            if ascii_text is not None:
+                # the payload is pure us-ascii
+                return ascii_text, chset
+            if not _sample_decodes(sample, codec_name, final):
+                continue
+
+        try:
+            return payload.decode(chset), chset
+        except UnicodeError:
+            pass
+
+        if sample is None:
+            # the charsets can only disagree after the us-ascii prefix
             try:
-                return payload.decode(chset), chset
-            except UnicodeError:
-                pass
+                ascii_text = payload.decode('ascii')
+            except UnicodeDecodeError as e:
+                ascii_end = e.start
+            else:
+                ascii_end = len(payload)
+            sample = payload[ascii_end : ascii_end + sample_size]
+            final = ascii_end + sample_size >= len(payload)
 
     if default_charset:
-        return (payload.decode(chset, 'replace'), None)
+        return (payload.decode(default_charset, 'replace'), None)
 
     return payload, None
 
 
+def _iter_truncated(chunks, max_bytes):
+    """
+    yield the byte I{chunks} until I{max_bytes} bytes have been returned
+    """
+    for chunk in chunks:
+        if len(chunk) >= max_bytes:
+            if max_bytes:
+                yield chunk[:max_bytes]
+            return
+        max_bytes -= len(chunk)
+        yield chunk
+
+
+def _iter_text_decoder(chunks, charset, final=True):
+    """
+    decode the byte I{chunks} into unicode. The charset is chosen like
+    L{decode_text()} does, in I{charset} then L{text_charsets}, when the
+    first non us-ascii byte is found: the first candidate able to decode
+    a sample of L{text_sample_size} bytes from this byte is used, the
+    us-ascii text before is decoded as is. Then invalid characters are
+    replaced. If not I{final}, an incomplete character at the end of the
+    last chunk is dropped.
+    """
+    candidates = []
+    for chset in (charset,) + tuple(text_charsets):
+        codec_name = chset and _codec_name(chset)
+        if codec_name and codec_name not in candidates:
+            candidates.append(codec_name)
+
+    decoder = None
+    if candidates and not _is_ascii_compatible(candidates[0]):
+        # like utf-16, the declared charset is used when it decodes the
+        # first chunk, its us-ascii bytes don't mean us-ascii text
+        first = next(chunks, None)
+        if first is None:
+            return
+        try:
+            if _sample_decodes(first, candidates[0], False):
+                decoder = codecs.getincrementaldecoder(candidates[0])('replace')
+        except LookupError:
+            pass
+        chunks = itertools.chain([first], chunks)
+
+    chunks = iter(chunks)
+    ascii_seen = False
+    for chunk in chunks:
+        if decoder is None:
+            try:
+                text = chunk.decode('ascii')
+            except UnicodeDecodeError as e:
+                ascii_end = e.start
+            else:
+                # the charset is not known yet
+                ascii_seen = ascii_seen or bool(chunk)
+                if text:
+                    yield text
+                continue
+            if ascii_end:
+                ascii_seen = True
+                yield chunk[:ascii_end].decode('ascii')
+            # read enough to check the candidates on a full sample
+            chunk = chunk[ascii_end:]
+            sample_final = False
+            while len(chunk) < text_sample_size:
+                more = next(chunks, None)
+                if more is None:
+                    sample_final = final
+                    break
+                chunk += more
+            sample = chunk[:text_sample_size]
+            sample_final = sample_final and len(chunk) == len(sample)
+            for codec_name in candidates:
+                if ascii_seen and not _is_ascii_compatible(codec_name):
+                    continue
+                try:
+                    decoder = codecs.getincrementaldecoder(codec_name)('replace')
+                except LookupError:
+                    continue
+                if _sample_decodes(sample, codec_name, sample_final):
+                    break
+            else:
+                decoder = codecs.getincrementaldecoder('ascii')('replace')
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    if final and decoder is not None:
+        text = decoder.decode(b'', True)
+        if text:
+            yield text
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """
+    Convert HTML into text as and when data is fed. Tags, scripts and styles
+    are removed, and block tags are replaced by a newline.
+    """
+
+    skipped_tags = frozenset(('script', 'style'))
+    block_tags = frozenset(
+        'address blockquote br dd div dl dt h1 h2 h3 h4 h5 h6 hr li ol p pre'
+        ' table td th title tr ul'.split()
+    )
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.skip = 0
+        self.texts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipped_tags:
+            self.skip += 1
+        elif tag in self.block_tags:
+            self.texts.append(u'\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.block_tags:
+            self.texts.append(u'\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.skipped_tags:
+            self.skip = max(0, self.skip - 1)
+        elif tag in self.block_tags:
+            self.texts.append(u'\n')
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.texts.append(data)
+
+    # Python 2 don't know about convert_charrefs
+    def handle_entityref(self, name):
+        codepoint = html_entities.name2codepoint.get(name)
+        self.handle_data(six.unichr(codepoint) if codepoint else u'&%s;' % name)
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in ('x', 'X'):
+                char = six.unichr(int(name[1:], 16))
+            else:
+                char = six.unichr(int(name))
+        except ValueError:
+            char = u'&#%s;' % name
+        self.handle_data(char)
+
+    def pop_text(self):
+        """return and forget the text collected so far"""
+        text = u''.join(self.texts)
+        del self.texts[:]
+        return text
+
+
 class PyzMessage(email.message.Message):
     """
     Inherit from email.message.Message. Combine L{get_mail_parts()},
@@ -615,6 +1174,10 @@ class PyzMessage(email.message.Message):
     @type html_part: L{MailPart} or None
     @ivar html_part: the L{MailPart} object that contains the I{HTML}
     version of the message, None if the mail has not I{HTML} content.
+    @type limits_exceeded: set
+    @ivar limits_exceeded: the names of the limits (C{'max_parts'},
+    C{'max_depth'}, C{'max_header_length'}, C{'max_decoded_size'}) that
+    have been hit. The message is only partially explored when not empty.
 
     @note: Sample:
 
@@ -682,52 +1245,191 @@ class PyzMessage(email.message.Message):
                 raise ValueError('input must be a string a bytes, a file or a Message')
 
     @staticmethod
-    def factory(input):
+    def factory(input, **limits):
         """
         Use the appropriate parser and return a L{PyzMessage} object
         see L{smart_parser}
         @type input: string, file, bytes, binary_file or  email.message.Message
         @param input: the source of the message
+        @keyword limits: the limits passed to L{PyzMessage.__init__()}
         @rtype: L{PyzMessage}
         @returns: the L{PyzMessage} message
         """
-        return PyzMessage(PyzMessage.smart_parser(input))
+        with instrument.stage('smart_parser'):
+            message = PyzMessage.smart_parser(input)
+        return PyzMessage(message, **limits)
 
-    def __init__(self, message):
+    def __init__(
+        self,
+        message,
+        max_parts=None,
+        max_depth=None,
+        max_header_length=None,
+        max_decoded_size=None,
+    ):
         """
         Initialize the object with data coming from I{message}.
 
+        The limits bound the resources used by hostile messages. When one is
+        hit, the exploration of the message stop early, the object is only
+        partially populated and the name of the limit is added to
+        I{limits_exceeded}. Use None for no limit.
+
         @type message: inherit email.message.Message
         @param message: The message
+        @type max_parts: int or None
+        @keyword max_parts: the maximum number of L{MailPart}s
+        @type max_depth: int or None
+        @keyword max_depth: the maximum nesting level of the parts
+        @type max_header_length: int or None
+        @keyword max_header_length: the headers are truncated to this number of
+        characters before to be decoded
+        @type max_decoded_size: int or None
+        @keyword max_decoded_size: the maximum total size of the decoded
+        L{MailPart}s
         """
         if not isinstance(message, email.message.Message):
             raise ValueError(
                 "message must inherit from email.message.Message use PyzMessage.factory() instead"
             )
         self.__dict__.update(message.__dict__)
+        self._header_index = None
 
-        self.mailparts = get_mail_parts(self)
+        self.max_header_length = max_header_length
+        self.limits_exceeded = set()
+        with instrument.stage('get_mail_parts'):
+            self.mailparts = get_mail_parts(
+                self, max_parts, max_depth, max_decoded_size, self.limits_exceeded
+            )
         self.text_part = None
         self.html_part = None
 
-        filenames = []
-        for part in self.mailparts:
-            ext = mimetypes.guess_extension(part.type)
-            if not ext:
-                # default to .bin
-                ext = '.bin'
-            elif ext == '.ksh':
-                # guess_extension() is not very accurate, .txt is more
-                # appropriate than .ksh
-                ext = '.txt'
-
-            sanitized_filename = sanitize_filename(
-                part.filename, part.type.split('/', 1)[0], ext
-            )
-            sanitized_filename = handle_filename_collision(
-                sanitized_filename, filenames
-            )
-            filenames.append(sanitized_filename.lower())
+        with instrument.stage('sanitize_filenames'):
+            self._sanitize_filenames()
+
+    def _get_header_index(self):
+        """
+        return a dictionary C{{lower case name: [(name, value), ...]}} of the
+        headers, built in one pass at first use and rebuilt when the headers
+        have been changed
+        """
+        index = self._header_index
+        headers = self._headers
+        if (
+            index is None
+            or self._indexed_headers is not headers
+            or self._indexed_length != len(headers)
+        ):
+            index = dict()
+            for header in headers:
+                key = header[0].lower()
+                fields = index.get(key)
+                if fields is None:
+                    index[key] = [header]
+                else:
+                    fields.append(header)
+            self._header_index = index
+            # detect the changes not done through the methods below, like
+            # set_boundary() that replace the list
+            self._indexed_headers = headers
+            self._indexed_length = len(headers)
+        return index
+
+    def _fetch_header(self, name, value):
+        if six.PY2:
+            return value
+        return self.policy.header_fetch_parse(name, value)
+
+    def __setitem__(self, name, val):
+        email.message.Message.__setitem__(self, name, val)
+        self._header_index = None
+
+    def __delitem__(self, name):
+        email.message.Message.__delitem__(self, name)
+        self._header_index = None
+
+    def __contains__(self, name):
+        return name.lower() in self._get_header_index()
+
+    def add_header(self, _name, _value, **_params):
+        email.message.Message.add_header(self, _name, _value, **_params)
+        self._header_index = None
+
+    def replace_header(self, _name, _value):
+        email.message.Message.replace_header(self, _name, _value)
+        self._header_index = None
+
+    if hasattr(email.message.Message, 'set_raw'):
+        # Python 3 only
+
+        def set_raw(self, name, value):
+            email.message.Message.set_raw(self, name, value)
+            self._header_index = None
+
+    def get(self, name, failobj=None):
+        """
+        Like C{email.message.Message.get()}, but use the index of the headers
+        instead of scanning all of them.
+        """
+        fields = self._get_header_index().get(name.lower())
+        if fields is None:
+            return failobj
+        return self._fetch_header(*fields[0])
+
+    def get_all(self, name, failobj=None):
+        """
+        Like C{email.message.Message.get_all()}, but use the index of the
+        headers instead of scanning all of them.
+        """
+        fields = self._get_header_index().get(name.lower())
+        if fields is None:
+            return failobj
+        return [self._fetch_header(k, v) for k, v in fields]
+
+    def decoded_headers(self, names=None):
+        """
+        return many RFC2047 decoded headers at once, like
+        L{get_decoded_header()} does for one.
+
+        >>> msg = PyzMessage.factory('Subject: =?utf-8?q?Caf=C3=A9?=\\nX-Spam: no\\n\\n')
+        >>> sorted(msg.decoded_headers().items()) == [('subject', u'Caf\\xe9'), ('x-spam', u'no')]
+        True
+        >>> msg.decoded_headers(['X-Spam', 'To']) == {'X-Spam': u'no'}
+        True
+
+        @type names: iterable or None
+        @param names: the names of the headers to decode, None for all of them
+        @rtype: dict
+        @returns: a dictionary C{{name: decoded value}} of the first header
+        of each name, the names are in lower case when I{names} is None, as
+        given in I{names} otherwise. The headers missing in the message are
+        not in the dictionary.
+        """
+        index = self._get_header_index()
+        if names is None:
+            names = list(index)
+        decoded = dict()
+        for name in names:
+            fields = index.get(name.lower())
+            if fields is not None:
+                value = _truncated_header(
+                    self._fetch_header(*fields[0]),
+                    self.max_header_length,
+                    self.limits_exceeded,
+                )
+                decoded[name] = decode_mail_header(value)
+        return decoded
+
+    def _sanitize_filenames(self):
+        """
+        set the I{sanitized_filename} of the L{MailPart}s, and find
+        the text and HTML parts
+        """
+        sanitized_filenames = sanitize_filenames(
+            (part.filename, part.type.split('/', 1)[0], mime_extension(part.type))
+            for part in self.mailparts
+        )
+        for part, sanitized_filename in zip(self.mailparts, sanitized_filenames):
             part.sanitized_filename = sanitized_filename
 
             if part.is_body == 'text/plain':
@@ -736,6 +1438,74 @@ class PyzMessage(email.message.Message):
             if part.is_body == 'text/html':
                 self.html_part = part
 
+    def iter_text(self, max_bytes=None, chunk_size=None):
+        """
+        yield the text content of the message in unicode chunks, as and when
+        the body part is decoded. Use the I{text} version of the message, or
+        the I{HTML} version converted into text if their is no I{text} version.
+        Useful for indexing, the payload is not decoded at once and only
+        the first I{max_bytes} are decoded when specified.
+
+        @type max_bytes: int or None
+        @keyword max_bytes: stop after that many bytes of the body part
+        have been decoded, None to read everything.
+        @type chunk_size: int or None
+        @keyword chunk_size: see L{MailPart.iter_payload()}
+        @rtype: iterator
+        @returns: an iterator over unicode chunks of text, nothing if the
+        message has no text or HTML content.
+        """
+        part = self.text_part or self.html_part
+        if part is None:
+            return
+
+        chunks = part.iter_payload(chunk_size)
+        if max_bytes is not None:
+            chunks = _iter_truncated(chunks, max_bytes)
+        texts = _iter_text_decoder(chunks, part.charset, final=max_bytes is None)
+
+        if part is self.text_part:
+            for text in texts:
+                yield text
+            return
+
+        parser = _HTMLTextExtractor()
+        for text in texts:
+            parser.feed(text)
+            text = parser.pop_text()
+            if text:
+                yield text
+        parser.close()
+        text = parser.pop_text()
+        if text:
+            yield text
+
+    def extract_attachments(
+        self, directory, include_body=False, workers=None, chunk_size=None
+    ):
+        """
+        Write the attachments into I{directory}, using their
+        I{sanitized_filename}. Look at
+        L{extract_attachments()<pyzmail.extract.extract_attachments>} for the
+        details and to extract the attachments of many messages at once.
+
+        @type directory: str
+        @param directory: an existing directory
+        @type include_body: bool
+        @keyword include_body: write the text and HTML parts too
+        @type workers: int or None
+        @keyword workers: the number of writer threads
+        @type chunk_size: int or None
+        @keyword chunk_size: see L{MailPart.iter_payload()}
+        @rtype: list
+        @returns: the paths written, in the order of the L{MailPart}s
+        """
+        from .extract import extract_attachments
+
+        return extract_attachments(
+            [self], directory, include_body, workers, chunk_size
+        )[0]
+
     def get_addresses(self, name):
         """
         return the I{name} header value as an list of addresses tuple as
@@ -748,7 +1518,9 @@ class PyzMessage(email.message.Message):
         @returns: a tuple of the form C{('Sender Name', 'sender.address@domain.com')}
         or C{('', '')} if no header match that I{name}.
         """
-        return get_mail_addresses(self, name)
+        return get_mail_addresses(
+            self, name, self.max_header_length, self.limits_exceeded
+        )
 
     def get_address(self, name):
         """
@@ -762,7 +1534,9 @@ class PyzMessage(email.message.Message):
         @returns: a list of tuple of the form C{[('Recipient Name', 'recipient.address@domain.com'), ...]}
         or an empty list if no header match that I{name}.
         """
-        value = get_mail_addresses(self, name)
+        value = get_mail_addresses(
+            self, name, self.max_header_length, self.limits_exceeded
+        )
         if value:
             return value[0]
         else:
@@ -801,6 +1575,9 @@ class PyzMessage(email.message.Message):
         if value is None:
             value = default
         else:
+            value = _truncated_header(
+                value, self.max_header_length, self.limits_exceeded
+            )
             value = decode_mail_header(value)
         return value
 
@@ -822,6 +1599,112 @@ class PzMessage(PyzMessage):
         PyzMessage.__init__(self, self.smart_parser(input))
 
 
+class PyzMessageFeedParser(object):
+    """
+    Incremental parser for messages coming from the network. Data are pushed
+    using L{feed()} as and when they arrive, and the decoded headers are
+    available as soon as the header block is complete, before the body is
+    received. L{close()} return the L{PyzMessage}.
+
+    @type headers: email.message.Message or None
+    @ivar headers: None until the underlying feed parser has read the
+    header block, that ends at the blank line or at the first line that
+    is not a header, then the message being parsed. Until then the methods
+    reading the headers return their default value, as if the headers
+    were missing. A message without any header gets them at L{close()}.
+    @type limits: dict
+    @ivar limits: the limits passed to the L{PyzMessage} returned by L{close()}
+
+    >>> parser = PyzMessageFeedParser()
+    >>> parser.feed(b'Subject: The subject\\nFrom: Me <me@foo.com>\\n')
+    >>> print(parser.headers)
+    None
+    >>> parser.feed(b'\\nThe text.\\n')
+    >>> print('Subject: %r' % (parser.get_subject(), ))
+    Subject: u'The subject'
+    >>> print('From: %r' % (parser.get_address('from'), ))
+    From: (u'Me', 'me@foo.com')
+    >>> msg = parser.close()
+    >>> msg.text_part.get_payload()
+    'The text.\\n'
+    """
+
+    def __init__(self, **limits):
+        if six.PY2:
+            self._parser = email.feedparser.FeedParser()
+        else:
+            self._parser = email.feedparser.BytesFeedParser()
+        self.headers = None
+        self.limits = limits
+
+    def feed(self, data):
+        """
+        Push more data to the parser.
+
+        @type data: bytes
+        @param data: the next chunk of the raw message
+        """
+        self._parser.feed(data)
+        if self.headers is None:
+            # the feed parser stores the headers in the top level message
+            # at once, when the header block is complete
+            stack = self._parser._msgstack
+            if stack and len(stack[0]):
+                self.headers = stack[0]
+
+    def close(self):
+        """
+        Complete the parsing.
+
+        @rtype: L{PyzMessage}
+        @returns: the message
+        """
+        message = self._parser.close()
+        if self.headers is None:
+            # the message has no body or no headers
+            self.headers = message
+        return PyzMessage(message, **self.limits)
+
+    def get_decoded_header(self, name, default=''):
+        """
+        return the decoded header I{name}, see L{PyzMessage.get_decoded_header()}.
+        Return I{default} while the header block is not complete.
+        """
+        if self.headers is None:
+            return default
+        value = self.headers.get(name)
+        if value is None:
+            return default
+        max_length = self.limits.get('max_header_length')
+        return decode_mail_header(_truncated_header(value, max_length, None))
+
+    def get_subject(self, default=''):
+        """
+        return the decoded subject, see L{PyzMessage.get_subject()}
+        """
+        return self.get_decoded_header('subject', default)
+
+    def get_addresses(self, name):
+        """
+        return the list of addresses, see L{PyzMessage.get_addresses()}.
+        Return an empty list while the header block is not complete.
+        """
+        if self.headers is None:
+            return []
+        max_length = self.limits.get('max_header_length')
+        return get_mail_addresses(self.headers, name, max_length)
+
+    def get_address(self, name):
+        """
+        return the first address, see L{PyzMessage.get_address()}
+        """
+        value = self.get_addresses(name)
+        if value:
+            return value[0]
+        else:
+            return ('', '')
+
+
 def message_from_string(s, *args, **kws):
     """
     Parse a string into a L{PyzMessage} object model.
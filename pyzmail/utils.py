@@ -8,6 +8,10 @@
 Various functions used by other modules
 @var invalid_chars_in_filename: a mix of characters not permitted in most used filesystems
 @var invalid_windows_name: a list of unauthorized filenames under Windows
+@var mime_extensions: the filename extension of the usual MIME types, used
+to name the parts without filename. Unlike C{mimetypes.guess_extension()}
+the result doesn't depend on the host. Use L{register_mime_extension()}
+to add or change an extension.
 """
 
 from __future__ import absolute_import, print_function
@@ -15,7 +19,15 @@ from __future__ import absolute_import, print_function
 import six
 
 
-__all__ = ['handle_filename_collision', 'is_usascii', 'sanitize_filename']
+__all__ = [
+    'UniqueFilenames',
+    'handle_filename_collision',
+    'is_usascii',
+    'mime_extension',
+    'register_mime_extension',
+    'sanitize_filename',
+    'sanitize_filenames',
+]
 
 invalid_chars_in_filename = (
     b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f'
@@ -48,6 +60,147 @@ invalid_windows_name = [
     b'LPT9',
 ]
 
+mime_extensions = {
+    'application/gzip': '.gz',
+    'application/ics': '.ics',
+    'application/javascript': '.js',
+    'application/json': '.json',
+    'application/ms-tnef': '.dat',
+    'application/msword': '.doc',
+    'application/octet-stream': '.bin',
+    'application/pdf': '.pdf',
+    'application/pgp-encrypted': '.pgp',
+    'application/pgp-keys': '.asc',
+    'application/pgp-signature': '.asc',
+    'application/pkcs7-mime': '.p7m',
+    'application/pkcs7-signature': '.p7s',
+    'application/postscript': '.ps',
+    'application/rtf': '.rtf',
+    'application/vnd.ms-excel': '.xls',
+    'application/vnd.ms-outlook': '.msg',
+    'application/vnd.ms-powerpoint': '.ppt',
+    'application/vnd.oasis.opendocument.presentation': '.odp',
+    'application/vnd.oasis.opendocument.spreadsheet': '.ods',
+    'application/vnd.oasis.opendocument.text': '.odt',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation': (
+        '.pptx'
+    ),
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': '.xlsx',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': (
+        '.docx'
+    ),
+    'application/x-7z-compressed': '.7z',
+    'application/x-bzip2': '.bz2',
+    'application/x-gzip': '.gz',
+    'application/x-pkcs7-mime': '.p7m',
+    'application/x-pkcs7-signature': '.p7s',
+    'application/x-rar-compressed': '.rar',
+    'application/x-sh': '.sh',
+    'application/x-shockwave-flash': '.swf',
+    'application/x-tar': '.tar',
+    'application/x-zip-compressed': '.zip',
+    'application/xml': '.xml',
+    'application/zip': '.zip',
+    'audio/aac': '.aac',
+    'audio/basic': '.au',
+    'audio/midi': '.mid',
+    'audio/mp4': '.m4a',
+    'audio/mpeg': '.mp3',
+    'audio/ogg': '.ogg',
+    'audio/wav': '.wav',
+    'audio/x-aiff': '.aif',
+    'audio/x-wav': '.wav',
+    'image/bmp': '.bmp',
+    'image/gif': '.gif',
+    'image/heic': '.heic',
+    'image/jpeg': '.jpg',
+    'image/jpg': '.jpg',
+    'image/pjpeg': '.jpg',
+    'image/png': '.png',
+    'image/svg+xml': '.svg',
+    'image/tiff': '.tiff',
+    'image/vnd.microsoft.icon': '.ico',
+    'image/webp': '.webp',
+    'image/x-icon': '.ico',
+    'image/x-png': '.png',
+    'message/rfc822': '.eml',
+    'text/calendar': '.ics',
+    'text/css': '.css',
+    'text/csv': '.csv',
+    'text/enriched': '.txt',
+    'text/html': '.html',
+    'text/javascript': '.js',
+    'text/markdown': '.md',
+    'text/plain': '.txt',
+    'text/richtext': '.rtx',
+    'text/rtf': '.rtf',
+    'text/tab-separated-values': '.tsv',
+    'text/vcard': '.vcf',
+    'text/x-vcard': '.vcf',
+    'text/xml': '.xml',
+    'video/mp4': '.mp4',
+    'video/mpeg': '.mpeg',
+    'video/ogg': '.ogv',
+    'video/quicktime': '.mov',
+    'video/webm': '.webm',
+    'video/x-msvideo': '.avi',
+}
+
+if six.PY3:
+    _invalid_windows_names = frozenset(
+        name.decode('ascii') for name in invalid_windows_name
+    )
+    _invalid_chars_table = dict.fromkeys(bytearray(invalid_chars_in_filename))
+else:
+    _invalid_windows_names = frozenset(invalid_windows_name)
+
+if hasattr(str, 'isascii'):
+    _isascii = str.isascii
+else:
+
+    def _isascii(value):
+        return is_usascii(value)
+
+
+def register_mime_extension(mime_type, extension):
+    """
+    Set the extension used by L{mime_extension()} for I{mime_type}.
+
+    >>> register_mime_extension('application/x-custom', '.cst')
+    >>> mime_extension('application/x-custom')
+    '.cst'
+
+    @type mime_type: str
+    @param mime_type: the MIME type, like C{'application/pdf'}
+    @type extension: str
+    @param extension: the extension, including the '.'
+    """
+    mime_extensions[mime_type.lower()] = extension
+
+
+def mime_extension(mime_type, default='.bin'):
+    """
+    Return the filename extension for I{mime_type}, see L{mime_extensions}.
+
+    >>> mime_extension('text/plain')
+    '.txt'
+    >>> mime_extension('Image/JPEG')
+    '.jpg'
+    >>> mime_extension('application/x-unknown')
+    '.bin'
+
+    @type mime_type: str
+    @param mime_type: the MIME type, like C{'application/pdf'}
+    @type default: str
+    @keyword default: the extension when the type is unknown
+    @rtype: str
+    @returns: the extension, including the '.'
+    """
+    extension = mime_extensions.get(mime_type)
+    if extension is None:
+        extension = mime_extensions.get(mime_type.lower(), default)
+    return extension
+
 
 def sanitize_filename(filename, alt_name, alt_ext):
     """
@@ -87,24 +240,21 @@ def sanitize_filename(filename, alt_name, alt_ext):
     if not filename:
         return alt_name + alt_ext
 
-    if isinstance(filename, six.text_type):
-        filename = filename.encode('ascii', 'ignore')
-
-    filename = filename.translate(None, invalid_chars_in_filename)
-    filename = filename.strip()
-
-    upper = filename.upper()
-    for name in invalid_windows_name:
-        if upper == name:
-            filename = filename + b'A'
-            break
-        if upper.startswith(name + b'.'):
-            filename = filename[: len(name)] + b'A' + filename[len(name) :]
-            break
-
     if six.PY3:
-        # back to string
-        filename = filename.decode('us-ascii')
+        if isinstance(filename, bytes):
+            filename = filename.decode('ascii', 'ignore')
+        elif not _isascii(filename):
+            filename = filename.encode('ascii', 'ignore').decode('ascii')
+        filename = filename.translate(_invalid_chars_table).strip()
+    else:
+        if isinstance(filename, six.text_type):
+            filename = filename.encode('ascii', 'ignore')
+        filename = filename.translate(None, invalid_chars_in_filename).strip()
+
+    # the reserved names are invalid, with or without extension
+    name = filename.split('.', 1)[0]
+    if name.upper() in _invalid_windows_names:
+        filename = name + 'A' + filename[len(name) :]
 
     if filename.rfind('.') == 0:
         filename = alt_name + filename
@@ -112,6 +262,81 @@ def sanitize_filename(filename, alt_name, alt_ext):
     return filename
 
 
+def sanitize_filenames(parts):
+    """
+    Sanitize the filenames of many parts at once, like L{sanitize_filename()}
+    does, and avoid the collisions between them, like
+    L{handle_filename_collision()} does.
+
+    >>> sanitize_filenames([('a.txt', 'file', '.txt'), ('A.TXT', 'file', '.txt'),
+    ... (None, 'text', '.txt'), (None, 'text', '.txt'), (u'\xe9.txt', 'text', '.txt')])
+    ['a.txt', 'A-01.TXT', 'text.txt', 'text-01.txt', 'text-02.txt']
+
+    @type parts: iterable
+    @param parts: the tuples C{(filename, alt_name, alt_ext)} of the
+    parts, see the arguments of L{sanitize_filename()}
+    @rtype: list
+    @returns: the sanitized filenames, in the same order, unique regardless
+    of the case
+    """
+    unique_filenames = UniqueFilenames()
+    return [
+        unique_filenames.add(sanitize_filename(filename, alt_name, alt_ext))
+        for filename, alt_name, alt_ext in parts
+    ]
+
+
+class UniqueFilenames(object):
+    """
+    Give unique filenames regardless of the case, like
+    L{handle_filename_collision()} but the cost of a collision doesn't
+    grow with the number of files of the same name.
+
+    >>> unique_filenames = UniqueFilenames(['file.txt'])
+    >>> unique_filenames.add('File.txt'), unique_filenames.add('file.txt')
+    ('File-01.txt', 'file-02.txt')
+
+    @ivar used: the lower case of the filenames already used
+    """
+
+    def __init__(self, used=()):
+        """
+        @type used: iterable
+        @param used: the filenames already used, for example the files of
+        the target directory
+        """
+        self.used = set(filename.lower() for filename in used)
+        # the last sequence number used for a filename
+        self._last_numbers = {}
+
+    def add(self, filename):
+        """
+        @type filename: str
+        @param filename: the filename
+        @rtype: str
+        @returns: the I{filename} or the appropriately I{indexed} I{filename},
+        that is now used
+        """
+        lower = filename.lower()
+        if lower in self.used:
+            try:
+                basename, ext = filename.rsplit('.', 1)
+                ext = '.' + ext
+            except ValueError:
+                basename, ext = filename, ''
+            # the numbers up to the last one are already used
+            i = self._last_numbers.get(lower, 0)
+            while True:
+                i += 1
+                candidate = '%s-%02d%s' % (basename, i, ext)
+                if candidate.lower() not in self.used:
+                    break
+            self._last_numbers[lower] = i
+            filename, lower = candidate, candidate.lower()
+        self.used.add(lower)
+        return filename
+
+
 def handle_filename_collision(filename, filenames):
     """
     Avoid filename collision, add a sequence number to the name when required.
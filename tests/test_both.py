@@ -1,6 +1,12 @@
 from __future__ import absolute_import, print_function
 
 import email
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import time
 import unittest
 
@@ -113,3 +119,149 @@ class TestBoth(unittest.TestCase):
                     self.assertEqual(payload, attach[0])
                 else:
                     self.fail('found unknown attachment')
+
+    def test_extract_attachments(self):
+        """test writing the attachments to disk"""
+        data = bytes(bytearray(range(256))) * 1000
+        payload, mail_from, rcpt_to, msg_id = pyzmail.compose_mail(
+            (u'Me', 'me@foo.com'),
+            [(u'Him', 'him@bar.com')],
+            u'the subject',
+            'iso-8859-1',
+            (u'Hello world', 'us-ascii'),
+            attachments=[
+                (data, 'application', 'octet-stream', 'data.bin', None),
+                (b'second', 'application', 'octet-stream', 'DATA.bin', None),
+                (u'Fran\xe7ais', 'text', 'plain', None, 'iso-8859-1'),
+            ],
+        )
+        directory = tempfile.mkdtemp()
+        try:
+            msg = PyzMessage.factory(payload)
+            paths = msg.extract_attachments(directory, chunk_size=1000)
+            self.assertEqual(
+                [os.path.basename(path) for path in paths],
+                ['data.bin', 'DATA-01.bin', 'text-01.txt'],
+            )
+            contents = []
+            for path in paths:
+                with open(path, 'rb') as fp:
+                    contents.append(fp.read())
+            self.assertEqual(
+                contents, [data, b'second', u'Fran\xe7ais'.encode('iso-8859-1')]
+            )
+
+            # existing files are never overwritten
+            extracted = pyzmail.extract_attachments(
+                [payload, msg], directory, include_body=True, workers=0
+            )
+            self.assertEqual(
+                [[os.path.basename(path) for path in paths] for paths in extracted],
+                [
+                    ['text.txt', 'data-02.bin', 'DATA-01-01.bin', 'text-01-01.txt'],
+                    ['text-02.txt', 'data-03.bin', 'DATA-01-02.bin', 'text-01-02.txt'],
+                ],
+            )
+            self.assertEqual(len(os.listdir(directory)), 11)
+
+            # one list per message, even without attachment
+            no_attachment = PyzMessage.factory('Subject: x\n\nhello\n')
+            self.assertEqual(no_attachment.extract_attachments(directory), [])
+            self.assertEqual(
+                pyzmail.extract_attachments([no_attachment] * 2, directory), [[], []]
+            )
+            self.assertEqual(len(os.listdir(directory)), 11)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_store_attachments(self):
+        """test the content-addressed storage of the attachments"""
+        from pyzmail import extract
+
+        data = bytes(bytearray(range(256))) * 1000
+        payloads = []
+        for name in ('data.bin', 'copy.bin'):
+            payload, mail_from, rcpt_to, msg_id = pyzmail.compose_mail(
+                'me@foo.com',
+                ['him@bar.com'],
+                u'the subject',
+                'iso-8859-1',
+                (u'Hello world', 'us-ascii'),
+                attachments=[
+                    (data, 'application', 'octet-stream', name, None),
+                    (name.encode('ascii'), 'text', 'plain', None, 'us-ascii'),
+                ],
+            )
+            payloads.append(payload)
+        directory = tempfile.mkdtemp()
+        old_spool_size = extract.spool_size
+        try:
+            for workers in (0, 2):
+                # the big payload is spooled to disk, the others not
+                extract.spool_size = 100000
+                manifest = pyzmail.store_attachments(
+                    payloads, directory, workers=workers, chunk_size=4096
+                )
+                digest = hashlib.sha256(data).hexdigest()
+                self.assertEqual(
+                    [(entry.message, entry.part, entry.filename) for entry in manifest],
+                    [(0, 1, 'data.bin'), (0, 2, 'text-01.txt')]
+                    + [(1, 1, 'copy.bin'), (1, 2, 'text-01.txt')],
+                )
+                self.assertEqual(manifest[0].digest, digest)
+                self.assertEqual(manifest[2].digest, digest)
+                self.assertEqual(manifest[0].size, len(data))
+                self.assertEqual(
+                    manifest[3].digest, hashlib.sha256(b'copy.bin').hexdigest()
+                )
+                with open(os.path.join(directory, digest[:2], digest), 'rb') as fp:
+                    self.assertEqual(fp.read(), data)
+                stored = [
+                    filename
+                    for dirpath, dirnames, filenames in os.walk(directory)
+                    for filename in filenames
+                ]
+                self.assertEqual(len(stored), 3)
+
+            # a failed write is not taken for a stored content
+            shutil.rmtree(directory)
+            os.mkdir(directory)
+            store = extract._ContentStore(directory, 4096)
+            publish = store._publish
+
+            def failing_publish(temp_path, path):
+                store._publish = publish
+                raise OSError('disk full')
+
+            store._publish = failing_publish
+            mailpart = PyzMessage.factory(payloads[0]).mailparts[1]
+            self.assertRaises(OSError, store.store, 0, 1, mailpart)
+            self.assertEqual(store.stored, set())
+            store.store(0, 1, mailpart)
+            with open(store.path(digest), 'rb') as fp:
+                self.assertEqual(fp.read(), data)
+        finally:
+            extract.spool_size = old_spool_size
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'lazy imports require Python 3.7')
+    def test_lazy_import(self):
+        """importing the parser don't load the SMTP stack and the reverse"""
+        code = (
+            'import sys\n'
+            'import pyzmail\n'
+            'loaded = set(sys.modules)\n'
+            'from pyzmail import %s\n'
+            'print(" ".join(sorted(set(sys.modules) - loaded)))\n'
+        )
+        for name, unwanted in (
+            ('PyzMessage', ('smtplib', 'pyzmail.generate')),
+            ('compose_mail', ('smtplib', 'pyzmail.parse')),
+        ):
+            output = subprocess.check_output([sys.executable, '-c', code % (name,)])
+            loaded = output.decode('ascii').split()
+            for module in unwanted:
+                self.assertFalse(module in loaded, module)
+        self.assertTrue(pyzmail.email_address_re.match('a@foo.com'))
+        self.assertTrue('PyzMessage' in dir(pyzmail))
+        self.assertRaises(AttributeError, getattr, pyzmail, 'unknown')
@@ -3,8 +3,12 @@
 from __future__ import absolute_import, print_function
 
 import unittest, doctest
+import email.utils
+
+import six
 
 import pyzmail
+import pyzmail.generate
 from pyzmail.generate import build_mail, complete_mail, format_addresses, Attachment
 
 
@@ -46,6 +50,29 @@ class TestGenerate(unittest.TestCase):
             ),
         )
 
+    @unittest.skipIf(six.PY2, 'the fast path is for Python 3')
+    def test_format_many_addresses(self):
+        """the ASCII addresses encoded at once give the same header"""
+        import email.header
+
+        addresses = ['a@foo.com', ('Doe, John', 'john@foo.com')] + [
+            (u'Recipient %d' % (i,), 'rcpt%d@example.com' % (i,)) for i in range(300)
+        ]
+        header = format_addresses(addresses, 'to', 'us-ascii')
+        expected = email.header.Header(header_name='to')
+        for i, address in enumerate(addresses):
+            if i != 0:
+                expected.append(',', charset='us-ascii')
+            if isinstance(address, tuple):
+                address = email.utils.formataddr(address)
+            expected.append(address, charset='us-ascii')
+        self.assertEqual(str(header), str(expected))
+        for maxlinelen in (None, 0, 20):
+            self.assertEqual(
+                header.encode(maxlinelen=maxlinelen),
+                expected.encode(maxlinelen=maxlinelen),
+            )
+
     def test_build_mail_with_attachment(self):
         attachment = Attachment(
             data=b'pdf-content',
@@ -70,6 +97,127 @@ class TestGenerate(unittest.TestCase):
         text_part, attachment_part = msg.mailparts
         self.assertEqual(u'äöü.pdf', attachment_part.filename)
 
+    def test_body_encoding(self):
+        """the bodies are encoded with binascii and decoded unchanged"""
+        from pyzmail.generate import build_mime_part
+
+        text = u'caf\xe9 = 1\t\n' + u'\u20ac' * 100 + u' \n' + u'x' * 74 + u' \n.\n'
+        for use_quoted_printable, cte in (
+            (True, 'quoted-printable'),
+            (False, 'base64'),
+        ):
+            part = build_mime_part(
+                text, 'text', 'html', 'utf-8', use_quoted_printable=use_quoted_printable
+            )
+            msg = pyzmail.message_from_string(part.as_string())
+            self.assertEqual(msg['Content-Transfer-Encoding'], cte)
+            self.assertEqual(msg.get_param('charset'), 'utf-8')
+            self.assertEqual(msg.mailparts[0].get_payload().decode('utf-8'), text)
+            if six.PY3:
+                # email.charset makes longer lines with Python 2
+                for line in part.get_payload().splitlines():
+                    self.assertTrue(len(line) <= 76, line)
+
+        data = bytes(bytearray(range(256))) * 10
+        part = build_mime_part(data, 'application', 'pdf', None)
+        self.assertEqual(part['Content-Transfer-Encoding'], 'base64')
+        self.assertEqual(part.get_payload(decode=True), data)
+
+    def test_boundaries(self):
+        """build_mail() sets boundaries that are not in the parts"""
+        mail = build_mail(
+            ('text', 'us-ascii'),
+            ('<p>html</p>', 'utf-8'),
+            attachments=[(b'pdf-content', 'application', 'pdf', 'a.pdf', None)],
+            embeddeds=[(b'png-content', 'image', 'png', 'logo', None)],
+            use_quoted_printable=True,
+        )
+        boundaries = [
+            part.get_boundary() for part in mail.walk() if part.is_multipart()
+        ]
+        self.assertEqual(len(set(boundaries)), 3)
+        self.assertTrue(all('=_' in boundary for boundary in boundaries))
+        msg = pyzmail.message_from_string(mail.as_string())
+        self.assertEqual(
+            [part.get_payload() for part in msg.mailparts],
+            [b'text', b'<p>html</p>', b'png-content', b'pdf-content'],
+        )
+
+    def test_ascii_headers(self):
+        """the ASCII values are written as is, the others are encoded"""
+        import email.mime.text
+
+        cases = [
+            (u'Plain subject', 'Subject: Plain subject\n'),
+            (u'Caf\xe9', 'Subject: =?iso-8859-1?q?Caf=E9?=\n'),
+        ]
+        if six.PY3:
+            cases += [
+                (
+                    u'not =?encoded?=',
+                    'Subject: =?iso-8859-1?q?not_=3D=3Fencoded=3F=3D?=\n',
+                ),
+                (u'two\nlines', 'Subject: =?iso-8859-1?q?two?=\n'),
+            ]
+        else:
+            # the email.header of Python 2 don't encode them
+            cases += [
+                (u'not =?encoded?=', 'Subject: not =?encoded?=\n'),
+                (u'two\nlines', 'Subject: two\n'),
+            ]
+        for subject, expected in cases:
+            msg = email.mime.text.MIMEText('The text.', 'plain', 'us-ascii')
+            payload = complete_mail(
+                msg,
+                'me@foo.com',
+                ['him@bar.com'],
+                subject,
+                'iso-8859-1',
+                headers=[('X-Mailer', u'pyzmail')],
+            )[0]
+            self.assertTrue(expected in payload, payload)
+            self.assertTrue('X-Mailer: pyzmail\n' in payload)
+
+    def test_composed_mail_size(self):
+        """the size is the one of the payload sent to the SMTP host"""
+        composed = pyzmail.compose_mail(
+            'me@foo.com',
+            ['him@bar.com'],
+            u'the subject',
+            'us-ascii',
+            ('Hello\nworld\r\n', 'us-ascii'),
+        )
+        payload, mail_from, rcpt_to, msg_id = composed
+        self.assertEqual(payload, composed.payload)
+        self.assertEqual(rcpt_to, ['him@bar.com'])
+        crlf_payload = pyzmail.generate._eols_re.sub('\r\n', payload)
+        self.assertEqual(composed.size, len(crlf_payload.encode('ascii')))
+
+    def test_message_id(self):
+        """test the domain of the generated Message-Ids"""
+        import email.mime.text
+
+        def msg_id(message_id_string):
+            msg = email.mime.text.MIMEText('The text.', 'plain', 'us-ascii')
+            return complete_mail(
+                msg,
+                'me@foo.com',
+                ['him@bar.com'],
+                u'subject',
+                'us-ascii',
+                message_id_string=message_id_string,
+            )[3]
+
+        self.assertTrue(msg_id('app@my.host.example').endswith('.app@my.host.example>'))
+        old_domain = pyzmail.generate.message_id_domain
+        try:
+            pyzmail.generate.message_id_domain = 'example.org'
+            self.assertTrue(msg_id('app').endswith('.app@example.org>'))
+            self.assertNotEqual(msg_id('app'), msg_id('app'))
+        finally:
+            pyzmail.generate.message_id_domain = old_domain
+        self.assertEqual(msg_id(None), None)
+
 
 # Add doctest
 def load_tests(loader, tests, ignore):
@@ -1,7 +1,12 @@
 from __future__ import absolute_import, print_function
 
 import email.charset
+import email.mime.text
 from io import BytesIO
+import os
+import shutil
+import sys
+import tempfile
 
 try:
     from StringIO import StringIO
@@ -12,15 +17,19 @@ import unittest, doctest
 import six
 
 import pyzmail
+import pyzmail.instrument
+from pyzmail.cache import ParseCache
 from pyzmail import (
     message_from_binary_file,
     message_from_bytes,
     message_from_file,
     message_from_string,
     PyzMessage,
+    PyzMessageFeedParser,
 )
 from pyzmail.parse import (
     decode_mail_header,
+    decode_text,
     get_filename,
     get_mail_addresses,
     get_mail_parts,
@@ -85,6 +94,43 @@ class TestParse(unittest.TestCase):
                 u'h_subject_q_iso_8858_1 :Fran\xe7ais\xe20accentu\xe9!',
             )
 
+    def test_decode_text(self):
+        """test decode_text()"""
+        text = u'Fran\xe7aise'
+        self.assertEqual(
+            decode_text(text.encode('utf-8'), 'utf-8', None), (text, 'utf-8')
+        )
+        # mislabelled
+        self.assertEqual(
+            decode_text(text.encode('windows-1252'), 'utf-8', None),
+            (text, 'windows-1252'),
+        )
+        self.assertEqual(
+            decode_text(text.encode('utf-8'), 'us-ascii', 'us-ascii'),
+            (text, 'utf-8'),
+        )
+        # unknown charset
+        self.assertEqual(
+            decode_text(text.encode('utf-8'), 'x-unknown', None), (text, 'utf-8')
+        )
+        # non us-ascii characters far behind the sample
+        payload = b'a' * 1000 + text.encode('windows-1252')
+        self.assertEqual(
+            decode_text(payload, 'utf-8', None, sample_size=10),
+            (u'a' * 1000 + text, 'windows-1252'),
+        )
+        self.assertEqual(
+            decode_text(b'abc\xff', 'utf-8', None, charsets=('latin-1',)),
+            (u'abc\xff', 'latin-1'),
+        )
+        self.assertEqual(
+            decode_text(b'abc\xff', 'utf-8', 'us-ascii', charsets=()),
+            (u'abc\ufffd', None),
+        )
+        self.assertEqual(
+            decode_text(b'abc\xff', 'utf-8', None, charsets=()), (b'abc\xff', None)
+        )
+
     def test_get_mail_addresses(self):
         """test get_mail_addresses()"""
         self.assertEqual(
@@ -188,6 +234,28 @@ class TestParse(unittest.TestCase):
         attach.set_param('name', 'image_wrong.png')
         self.assertEqual('image.png', get_filename(attach))
 
+    def test_part_params(self):
+        """the parameters parsed once are the ones of get_param()"""
+        from pyzmail.parse import _PartParams
+
+        part = email.message_from_string(
+            'Content-Type: text/plain; Charset="utf-8"; charset=latin1;'
+            ' name*=utf-8\'\'caf%C3%A9.txt\n'
+            'Content-Disposition: INLINE; filename="a \\"b\\".txt"\n\n'
+        )
+        params = _PartParams(part)
+        for param, header in (
+            ('charset', 'content-type'),
+            ('name', 'content-type'),
+            ('inline', 'content-disposition'),
+            ('attachment', 'content-disposition'),
+            ('filename', 'content-disposition'),
+            ('filename', 'content-location'),
+        ):
+            self.assertEqual(
+                params.get(param, header), part.get_param(param, None, header)
+            )
+
     def test_get_mailparts(self):
         """test get_mailparts()"""
         import email.mime.multipart
@@ -380,6 +448,255 @@ bo\xc3\xaete mail = mailbox
             check(PyzMessage.factory(StringIO(input)))
             check(message_from_file(StringIO(input)))
 
+    def test_iter_text(self):
+        """test PyzMessage.iter_text()"""
+        msg = PyzMessage.factory(self.raw_1)
+        self.assertEqual(u''.join(msg.iter_text()), u'The text.\n')
+        self.assertEqual(u''.join(msg.iter_text(max_bytes=3)), u'The')
+
+        html = (
+            u'<html><head><style>p {color: red}</style></head>'
+            u'<body><p>Caf\xe9 &amp; th\xe9</p><script>var x;</script>'
+            u'<div>Fran\xe7ais</div></body></html>'
+        )
+        raw = email.mime.text.MIMEText(html.encode('utf-8'), 'html', 'utf-8')
+        msg = PyzMessage.factory(raw.as_string())
+        self.assertEqual(msg.html_part.part['Content-Transfer-Encoding'], 'base64')
+        self.assertEqual(msg.html_part.get_payload(), html.encode('utf-8'))
+        for chunk_size in (1, 3, 5, 1000):
+            payload = b''.join(msg.html_part.iter_payload(chunk_size))
+            self.assertEqual(msg.html_part.get_payload(), payload)
+            text = u''.join(msg.iter_text(chunk_size=chunk_size))
+            self.assertEqual(text, u'\nCaf\xe9 & th\xe9\n\nFran\xe7ais\n')
+
+        # without charset, the charset is chosen at the first non us-ascii byte
+        for text, charset in ((u'Caf\xe9 \u20ac', 'utf-8'), (u'Caf\xe9', 'cp1252')):
+            raw = b'Content-Type: text/plain\n\nThe text. ' + text.encode(charset)
+            msg = PyzMessage.factory(raw)
+            self.assertEqual(msg.text_part.charset, None)
+            for chunk_size in (1, 3, 1000):
+                self.assertEqual(
+                    u''.join(msg.iter_text(chunk_size=chunk_size)), u'The text. ' + text
+                )
+
+        # the data that is not valid base64 is kept
+        raw = (
+            'Content-Type: application/octet-stream\n'
+            'Content-Transfer-Encoding: base64\n\naGVsbG8gd29ybGQhA\n'
+        )
+        part = PyzMessage.factory(raw).mailparts[0]
+        self.assertEqual(b''.join(part.iter_payload(8)), b'hello world!A')
+
+    def test_feed_parser(self):
+        """test PyzMessageFeedParser"""
+        raw = self.raw_1.replace('\n', '\r\n').encode('us-ascii')
+        header_end = raw.index(b'\r\n\r\n') + 4
+        parser = PyzMessageFeedParser()
+        for i in range(len(raw)):
+            parser.feed(raw[i : i + 1])
+            if i + 1 < header_end:
+                self.assertEqual(parser.headers, None)
+                self.assertEqual(parser.get_subject(), u'')
+                self.assertEqual(parser.get_decoded_header('to', None), None)
+                self.assertEqual(parser.get_addresses('to'), [])
+                self.assertEqual(parser.get_address('from'), ('', ''))
+            else:
+                self.assertNotEqual(parser.headers, None)
+                self.assertEqual(parser.get_subject(), u'simple test')
+                self.assertEqual(
+                    parser.get_addresses('to'),
+                    [(u'A', 'a@foo.com'), (u'B', 'b@foo.com')],
+                )
+        self.check_message_1(parser.close())
+
+        # no body at all
+        parser = PyzMessageFeedParser()
+        parser.feed(b'Subject: no body\n')
+        self.assertEqual(parser.headers, None)
+        msg = parser.close()
+        self.assertEqual(parser.get_subject(), u'no body')
+        self.assertEqual(msg.get_subject(), u'no body')
+
+        # the header block ends at the first line that is not a header
+        parser = PyzMessageFeedParser()
+        parser.feed(b'Subject: no separator\nFrom: a@foo.com\n')
+        self.assertEqual(parser.headers, None)
+        parser.feed(b'The text.\n')
+        self.assertEqual(parser.get_subject(), u'no separator')
+        self.assertEqual(parser.get_address('from'), (u'a@foo.com', 'a@foo.com'))
+        msg = parser.close()
+        self.assertEqual(msg.text_part.get_payload(), b'The text.\n')
+
+    def test_get_mailparts_deep_nesting(self):
+        """test get_mailparts() don't use recursion"""
+        import email.mime.multipart
+        import email.mime.text
+
+        text = email.mime.text.MIMEText('The text.', 'plain', 'us-ascii')
+        html = email.mime.text.MIMEText('<p>The text.</p>', 'html', 'us-ascii')
+        msg = email.mime.multipart.MIMEMultipart('alternative', None, [text, html])
+        for i in range(3 * sys.getrecursionlimit()):
+            msg = email.mime.multipart.MIMEMultipart('mixed', None, [msg])
+
+        parts = get_mail_parts(msg)
+        self.assertEqual([part.is_body for part in parts], ['text/plain', 'text/html'])
+
+    def test_limits(self):
+        """test the PyzMessage limits"""
+        raw = 'Subject: %s\nContent-Type: multipart/mixed; boundary=b\n\n' % (
+            'x' * 1000,
+        )
+        for i in range(100):
+            raw += '--b\nContent-Type: text/plain\n\npart %d\n' % (i,)
+        raw += '--b--\n'
+
+        msg = PyzMessage.factory(raw)
+        self.assertEqual(len(msg.mailparts), 100)
+        self.assertEqual(len(msg.get_subject()), 1000)
+        self.assertEqual(msg.limits_exceeded, set())
+
+        msg = PyzMessage.factory(raw, max_parts=10, max_header_length=100)
+        self.assertEqual(len(msg.mailparts), 10)
+        self.assertEqual(msg.text_part, msg.mailparts[0])
+        self.assertEqual(msg.get_subject(), u'x' * 100)
+        self.assertEqual(msg.limits_exceeded, set(['max_parts', 'max_header_length']))
+
+        msg = PyzMessage.factory(raw, max_decoded_size=65)
+        self.assertEqual(len(msg.mailparts), 10)
+        self.assertEqual(msg.limits_exceeded, set(['max_decoded_size']))
+
+        # deep nesting
+        depth = 200
+        raw = ''
+        for i in range(depth):
+            raw += 'Content-Type: multipart/mixed; boundary=b%d\n\n--b%d\n' % (i, i)
+        raw += 'Content-Type: text/plain\n\ndeep\n'
+        for i in reversed(range(depth)):
+            raw += '--b%d--\n' % (i,)
+
+        msg = PyzMessage.factory(raw)
+        self.assertEqual(len(msg.mailparts), 1)
+        self.assertEqual(msg.text_part.get_payload(), b'deep')
+
+        msg = PyzMessage.factory(raw, max_depth=10)
+        self.assertEqual(msg.mailparts, [])
+        self.assertEqual(msg.text_part, None)
+        self.assertEqual(msg.limits_exceeded, set(['max_depth']))
+
+    def test_profiler(self):
+        """test the instrumentation of the parsing"""
+        recorded = []
+        with pyzmail.instrument.Profiler(
+            callback=lambda stage, seconds: recorded.append(stage)
+        ) as profiler:
+            msg = PyzMessage.factory(self.raw_1)
+            msg.get_subject()
+        self.assertEqual(pyzmail.instrument.current_profiler(), None)
+        PyzMessage.factory(self.raw_1)
+
+        self.assertEqual(
+            recorded,
+            [
+                'smart_parser',
+                'get_mail_parts',
+                'sanitize_filenames',
+                'decode_mail_header',
+            ],
+        )
+        counters = profiler.as_counters(prefix='pz', separator='_')
+        self.assertEqual(counters['pz_smart_parser_count'], 1)
+        self.assertEqual(counters['pz_decode_mail_header_count'], 1)
+        self.assertTrue(counters['pz_get_mail_parts_seconds'] >= 0)
+        self.assertEqual(len(counters), 8)
+
+    def test_header_index(self):
+        """test the header lookups through the index"""
+        raw = (
+            'Received: from a\nreceived: from b\nSubject: =?utf-8?q?Caf=C3=A9?=\n'
+            'To: A <a@foo.com>\nTo: B <b@foo.com>\n\nThe text.\n'
+        )
+        msg = PyzMessage.factory(raw)
+        self.assertEqual(msg.get_all('RECEIVED'), ['from a', 'from b'])
+        self.assertEqual(msg.get_all('cc', []), [])
+        self.assertEqual(msg['subject'], '=?utf-8?q?Caf=C3=A9?=')
+        self.assertEqual(
+            msg.get_addresses('to'), [(u'A', 'a@foo.com'), (u'B', 'b@foo.com')]
+        )
+        self.assertEqual(
+            msg.decoded_headers(['Subject', 'X-Unknown']), {'Subject': u'Caf\xe9'}
+        )
+        self.assertEqual(sorted(msg.decoded_headers()), ['received', 'subject', 'to'])
+
+        # the index follows the changes
+        del msg['subject']
+        msg['Subject'] = 'new'
+        self.assertEqual(msg.get_subject(), u'new')
+        msg.replace_header('subject', 'newer')
+        self.assertEqual(msg.get_subject(), u'newer')
+        msg.add_header('X-Spam', 'no')
+        self.assertTrue('x-spam' in msg)
+        if six.PY3:
+            msg.set_raw('Cc', 'C <c@foo.com>')
+            self.assertEqual(msg.get_address('cc'), (u'C', 'c@foo.com'))
+        msg.add_header('Content-Type', 'multipart/mixed', boundary='old')
+        msg.set_boundary('frontier')
+        self.assertEqual(msg.get_param('boundary'), 'frontier')
+        self.assertEqual(msg.get_all('to'), ['A <a@foo.com>', 'B <b@foo.com>'])
+
+    def test_parse_cache(self):
+        """test the persistent cache of the parsing results"""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'cache.db')
+        try:
+            raw = self.raw_2
+            with ParseCache(path) as cache:
+                parsed = cache.parse(raw)
+                self.assertFalse(parsed.from_cache)
+                self.assertEqual(cache.get(self.raw_1), None)
+            msg = PyzMessage.factory(raw)
+
+            with ParseCache(path) as cache:
+                with pyzmail.instrument.Profiler() as profiler:
+                    cached = cache.parse(raw)
+                # the MIME parsing is skipped
+                self.assertEqual(profiler.stats, {})
+                self.assertEqual((cache.hits, cache.misses), (1, 0))
+            self.assertTrue(cached.from_cache)
+            self.assertEqual(cached.digest, parsed.digest)
+            self.assertEqual(cached.get_subject(), msg.get_subject())
+            self.assertEqual(
+                cached.get_decoded_header('X-Unknown', None),
+                msg.get_decoded_header('X-Unknown', None),
+            )
+            for name in ('from', 'to', 'cc', 'x-unknown'):
+                self.assertEqual(cached.get_addresses(name), msg.get_addresses(name))
+            self.assertEqual(cached.get_address('from'), msg.get_address('from'))
+            self.assertEqual(
+                [(part.type, part.sanitized_filename) for part in cached.mailparts],
+                [(part.type, part.sanitized_filename) for part in msg.mailparts],
+            )
+            self.assertEqual(cached.text_part.type, msg.text_part.type)
+            self.assertEqual(
+                cached.get_message().text_part.get_payload(),
+                msg.text_part.get_payload(),
+            )
+
+            # the entries computed with other limits are ignored
+            with ParseCache(path, max_parts=1) as cache:
+                self.assertEqual(cache.get(raw), None)
+                self.assertEqual(len(cache.parse(raw).mailparts), 1)
+
+            # the new entries are visible at once to the other connections,
+            # and they don't keep the database locked
+            with ParseCache(path, timeout=1) as cache:
+                with ParseCache(path, timeout=1) as other:
+                    cache.parse(self.raw_1)
+                    self.assertTrue(other.get(self.raw_1) is not None)
+                    self.assertFalse(other.parse(self.raw_3).from_cache)
+                    self.assertTrue(cache.get(self.raw_3) is not None)
+        finally:
+            shutil.rmtree(directory)
+
     def test_pyzmessage_factories(self):
         """test PyzMessage class different sources"""
         self.check_pyzmessage_factories(self.raw_1, self.check_message_1)
@@ -389,6 +706,7 @@ bo\xc3\xaete mail = mailbox
 
 # Add doctest
 def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(pyzmail.instrument))
     if six.PY2:
         tests.addTests(doctest.DocTestSuite(pyzmail.parse))
     return tests
@@ -1,7 +1,11 @@
 import threading, smtpd, asyncore, time
+import socket
+import tempfile
 import unittest
 
-from pyzmail import compose_mail, send_mail
+import six
+
+from pyzmail import compose_mail, send_mail, send_mail_file, SendStats
 
 smtpd_addr = '127.0.0.1'
 smtpd_port = 32525
@@ -26,10 +30,42 @@ class SMTPServer(smtpd.SMTPServer):
         ret = None
         if mail_from.startswith('data_error'):
             ret = '552 Requested mail action aborted: exceeded storage allocation'
+        elif mail_from.startswith('second_data_error') and self.received:
+            ret = '554 Transaction failed'
         self.received.append((ret, peer, mail_from, rcpt_to, data))
         return ret
 
 
+class LimitedSMTPChannel(smtpd.SMTPChannel):
+    """accept 2 recipients per transaction"""
+
+    def smtp_RCPT(self, arg):
+        if len(self.rcpttos) >= 2:
+            self.push('452 4.5.3 Too many recipients')
+            return
+        smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class BusySMTPChannel(smtpd.SMTPChannel):
+    """refuse the first recipient of the first transaction"""
+
+    busy = True
+
+    def smtp_RCPT(self, arg):
+        if self.busy:
+            self.busy = False
+            self.push('452 4.3.1 Insufficient system storage')
+            return
+        smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class FullSMTPChannel(smtpd.SMTPChannel):
+    """refuse all the recipients"""
+
+    def smtp_RCPT(self, arg):
+        self.push('452 4.3.1 Insufficient system storage')
+
+
 class TestSend(unittest.TestCase):
     def setUp(self):
         self.received = []
@@ -78,6 +114,161 @@ class TestSend(unittest.TestCase):
         self.assertEqual(self.rcpt_to, rcpt_to)
         self.assertEqual('127.0.0.1', peer[0])
 
+    def test_send_stats(self):
+        """send with the stats of the SMTP session"""
+        stats = SendStats()
+        ret = send_mail(
+            self.payload,
+            self.mail_from,
+            self.rcpt_to,
+            smtpd_addr,
+            smtpd_port,
+            smtp_mode=smtp_mode,
+            smtp_login=smtp_login,
+            smtp_password=smtp_password,
+            stats=stats,
+        )
+        self.assertEqual(ret, dict())
+        self.assertEqual(stats.refused, dict())
+        self.assertTrue(stats.bytes_sent > len(self.payload))
+        self.assertTrue(stats.connect > 0)
+        self.assertTrue(stats.envelope > 0)
+        self.assertTrue(stats.data > 0)
+        self.assertTrue(stats.total >= stats.connect + stats.data)
+
+    def test_send_stats_connect_error(self):
+        """the connection time is recorded when the connection fails"""
+        sock = socket.socket()
+        sock.bind((smtpd_addr, 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        stats = SendStats()
+        ret = send_mail(
+            self.payload, self.mail_from, self.rcpt_to, smtpd_addr, port, stats=stats
+        )
+        self.assertTrue(isinstance(ret, str))
+        self.assertTrue(stats.connect > 0)
+        self.assertEqual(stats.data, 0)
+
+    @unittest.skipIf(six.PY2, 'smtpd of Python 2 has no channel_class')
+    def test_send_many_recipients(self):
+        """send to more recipients than accepted in one transaction"""
+        self.smtp_server.channel_class = LimitedSMTPChannel
+        rcpt_to = ['a@foo.com', 'b@foo.com', 'A@FOO.com', 'c@foo.com', 'd@foo.com']
+        ret = send_mail(
+            self.payload,
+            self.mail_from,
+            rcpt_to + ['e@foo.com'],
+            smtpd_addr,
+            smtpd_port,
+            smtp_mode=smtp_mode,
+            smtp_login=smtp_login,
+            smtp_password=smtp_password,
+            max_recipients=3,
+        )
+        self.assertEqual(ret, dict())
+        self.assertEqual(
+            [received[3] for received in self.received],
+            [['a@foo.com', 'b@foo.com'], ['c@foo.com', 'd@foo.com'], ['e@foo.com']],
+        )
+
+    @unittest.skipIf(six.PY2, 'smtpd of Python 2 has no channel_class')
+    def test_send_partially_delivered(self):
+        """the recipients not reached after a delivery are returned as refused"""
+        self.smtp_server.channel_class = LimitedSMTPChannel
+        rcpt_to = ['a@foo.com', 'b@foo.com', 'c@foo.com', 'd@foo.com']
+        ret = send_mail(
+            self.payload,
+            'second_data_error@foo.com',
+            rcpt_to,
+            smtpd_addr,
+            smtpd_port,
+            smtp_mode=smtp_mode,
+            smtp_login=smtp_login,
+            smtp_password=smtp_password,
+        )
+        self.assertEqual(sorted(ret), ['c@foo.com', 'd@foo.com'])
+        self.assertEqual(ret['c@foo.com'][0], 554)
+        self.assertEqual(self.received[0][3], ['a@foo.com', 'b@foo.com'])
+
+    @unittest.skipIf(six.PY2, 'smtpd of Python 2 has no channel_class')
+    def test_send_busy(self):
+        """a 452 to the first recipient is retried in a new transaction"""
+        self.smtp_server.channel_class = BusySMTPChannel
+        ret = send_mail(
+            self.payload,
+            self.mail_from,
+            ['a@foo.com', 'b@foo.com'],
+            smtpd_addr,
+            smtpd_port,
+            smtp_mode=smtp_mode,
+            smtp_login=smtp_login,
+            smtp_password=smtp_password,
+        )
+        self.assertEqual(ret, dict())
+        self.assertEqual(self.received[0][3], ['a@foo.com', 'b@foo.com'])
+
+        self.smtp_server.channel_class = FullSMTPChannel
+        stats = SendStats()
+        ret = send_mail(
+            self.payload,
+            self.mail_from,
+            ['a@foo.com', 'b@foo.com'],
+            smtpd_addr,
+            smtpd_port,
+            smtp_mode=smtp_mode,
+            smtp_login=smtp_login,
+            smtp_password=smtp_password,
+            stats=stats,
+        )
+        self.assertEqual(type(ret), str)
+        self.assertEqual(sorted(stats.refused), ['a@foo.com', 'b@foo.com'])
+        self.assertEqual(len(self.received), 1)
+
+    @unittest.skipIf(six.PY2, 'smtpd of Python 2 does not announce SIZE')
+    def test_send_too_large(self):
+        """the size announced by the server is checked before to send"""
+        self.smtp_server.data_size_limit = 100
+        stats = SendStats()
+        ret = send_mail(
+            self.payload,
+            self.mail_from,
+            self.rcpt_to,
+            smtpd_addr,
+            smtpd_port,
+            smtp_mode=smtp_mode,
+            smtp_login=smtp_login,
+            smtp_password=smtp_password,
+            stats=stats,
+        )
+        self.assertEqual(type(ret), str)
+        self.assertTrue('message too large' in ret)
+        self.assertTrue(stats.bytes_sent < 100)
+        self.assertEqual(self.received, [])
+
+    def test_send_file(self):
+        """send a message spooled to disk"""
+        payload = self.payload + '\n.a line starting with a dot'
+        stats = SendStats()
+        with tempfile.TemporaryFile() as fp:
+            fp.write(payload.replace('\n.', '\n..').replace('\n', '\r\n').encode())
+            size = fp.tell()
+            fp.seek(0)
+            ret = send_mail_file(
+                fp,
+                self.mail_from,
+                self.rcpt_to,
+                smtpd_addr,
+                smtpd_port,
+                smtp_mode=smtp_mode,
+                smtp_login=smtp_login,
+                smtp_password=smtp_password,
+                stats=stats,
+            )
+        self.assertEqual(ret, dict())
+        self.assertTrue(stats.bytes_sent > size)
+        self.assertEqual(self.received[0][2:], (self.mail_from, self.rcpt_to, payload))
+
     def test_send_to_a_wrong_port(self):
         """send to a wrong port"""
         ret = send_mail(